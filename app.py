@@ -9,6 +9,7 @@ from utils.progress import ProgressStore
 from services.document_upload_service import DocumentUploadService
 from extension import db
 from models.response import Response
+from services.job_queue import JobQueue
 
 
 
@@ -46,14 +47,26 @@ app.config.update({
     "EXPORT_FOLDER": EXPORT_FOLDER
 })
 
+# Coda di processing: numero di worker configurabile (JOB_WORKERS), stato su Postgres
+job_queue = JobQueue(app)
+
 document_controller = DocumentController(
     upload_folder=UPLOAD_FOLDER,
-    export_folder=EXPORT_FOLDER
+    export_folder=EXPORT_FOLDER,
+    job_queue=job_queue
 )
 
 progress_store = ProgressStore(document_controller.file_manager.UPLOAD_FOLDER)
 upload_service = DocumentUploadService(document_controller, UPLOAD_FOLDER)
 
+# Avvio worker e recupero dei job rimasti incompleti (es. dopo un restart)
+try:
+    with app.app_context():
+        db.create_all()
+except Exception as e:
+    app.logger.error(f"Impossibile creare/verificare le tabelle database: {e}")
+job_queue.start()
+
 def log_route(route_name):
     app.logger.info(f"Endpoint chiamato: {route_name}")
 
@@ -294,23 +307,72 @@ def upload_document():
         
         # Processa ogni file usando il servizio
         results = []
+        queued = False
         for file in validated_files:
             # Usa secure_filename per sanitizzare il nome file
             file.filename = secure_filename(file.filename)
             result = upload_service.process_upload(file, user_id)
             results.append(result.to_dict())
 
-            #Popoliamo il db con le response
-            response_db=Response.add_response(
-                id_document=result.document_id,
-            )
-            app.logger.debug(f"Risposta db: {response_db}")
+            # I documenti accodati (OCR, n_cartella) ricevono il document_id a fine job
+            if result.status == "queued":
+                queued = True
+                continue
 
-        return jsonify(results[0] if len(results) == 1 else results)
+            #Popoliamo il db con le response
+            if result.document_id:
+                response_db=Response.add_response(
+                    id_document=result.document_id,
+                )
+                app.logger.debug(f"Risposta db: {response_db}")
+
+        # 202: almeno un documento è stato accodato (OCR o lettura di n_cartella, stato su /api/jobs/<job_id>)
+        status_code = 202 if queued else 200
+        return jsonify(results[0] if len(results) == 1 else results), status_code
     except Exception as e:
         app.logger.exception("Errore in upload_document")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job_status(job_id):
+    """Stato di un job di processing (queued/running/done/failed)."""
+    log_route("get_job_status")
+    job = job_queue.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job non trovato"}), 404
+    return jsonify(job)
+
+@app.route("/api/dedup-stats", methods=["GET"])
+def get_dedup_stats():
+    """Statistiche della cache dei contenuti (upload duplicati, hit di parsing/OCR)."""
+    log_route("get_dedup_stats")
+    return jsonify(document_controller.content_cache.get_stats())
+
+@app.route("/api/llm-cache-stats", methods=["GET"])
+def get_llm_cache_stats():
+    """Statistiche della cache delle risposte LLM (hit/miss, bypass, eviction)."""
+    log_route("get_llm_cache_stats")
+    return jsonify(document_controller.llm.response_cache.get_stats())
+
+@app.route("/api/llm-metrics", methods=["GET"])
+def get_llm_metrics():
+    """Time-to-first-token, latenza e token di prefisso in cache per tipo di documento."""
+    log_route("get_llm_metrics")
+    return jsonify(document_controller.llm.metrics.get_stats())
+
+@app.route("/api/llm-routes", methods=["GET"])
+def get_llm_routes():
+    """Per rotta (tipo di documento + modello piccolo/grande): chiamate, latenza media ed escalation."""
+    log_route("get_llm_routes")
+    return jsonify(document_controller.llm.router.get_stats())
+
+@app.route("/api/llm-usage", methods=["GET"])
+def get_llm_usage():
+    """Ultime chiamate LLM: token di input stimati prima dell'invio, max_tokens richiesto e usage reale."""
+    log_route("get_llm_usage")
+    limit = request.args.get("limit", default=50, type=int)
+    return jsonify(document_controller.llm.metrics.get_calls(limit))
+
 @app.route('/uploads/<path:filename>', methods=['GET', 'HEAD'])
 def uploaded_file(filename):
     log_route("uploaded_file")
@@ -0,0 +1,66 @@
+"""
+Regressione dell'estrazione anagrafica deterministica (utils/anagraphic_extractor.py).
+
+Esegue l'estrattore su testi noti e confronta i campi riconosciuti con quelli attesi.
+Un campo assente tra gli attesi non deve essere estratto: un valore sbagliato finisce
+nella verifica di coerenza pre-LLM e tra le entità salvate, un campo mancante no.
+
+Termina con codice 1 se almeno un caso non corrisponde.
+
+Uso:
+    python -m benchmarks.anagraphic_regression
+"""
+
+import sys
+from typing import Dict, List, Tuple
+
+from utils.anagraphic_extractor import AnagraphicExtractor
+
+CASES: List[Tuple[str, Dict[str, str]]] = [
+    (
+        "Si dimette in data 02/09/2019\n"
+        "il Sig. BERTOLOTTI FRANCO\n"
+        "Nato il 27/03/1939 telefono 3479927663\n"
+        "ricoverato presso questo ospedale dal 27/08/2019\n"
+        "Numero Cartella 2019034139",
+        {
+            "n_cartella": "2019034139", "cognome": "BERTOLOTTI", "nome": "FRANCO",
+            "data_di_nascita": "27/03/1939", "data_dimissione_cch": "02/09/2019",
+            "data_ingresso_cch": "27/08/2019",
+        },
+    ),
+    # Due etichette sulla stessa riga: il cognome non include l'etichetta successiva
+    ("COGNOME: ROSSI NOME: MARIO", {"cognome": "ROSSI", "nome": "MARIO"}),
+    ("Cognome: DE LUCA Nome: ANNA MARIA Data: 01/02/1950", {"cognome": "DE LUCA", "nome": "ANNA MARIA"}),
+    # Etichette senza due punti dopo il nome: il nome si ferma alla parola dell'etichetta
+    ("COGNOME: ROSSI NOME: MARIO DATA DI NASCITA: 01/01/1950", {"cognome": "ROSSI", "nome": "MARIO"}),
+    ("COGNOME: ROSSI NOME: MARIO NATO IL 01/01/1950", {"cognome": "ROSSI", "nome": "MARIO", "data_di_nascita": "01/01/1950"}),
+    ("COGNOME: ROSSI\nNOME: MARIO SESSO: M", {"cognome": "ROSSI", "nome": "MARIO"}),
+    ("Cognome: ROSSI Nome: MARIO ETA' 70", {"cognome": "ROSSI", "nome": "MARIO"}),
+    ("Cognome: ROSSI Nome: MARIO LUOGO DI NASCITA MILANO", {"cognome": "ROSSI", "nome": "MARIO"}),
+    # Al più 3 token per nome
+    ("Cognome: ROSSI Nome: MARIO LUIGI GIUSEPPE ANTONIO", {"cognome": "ROSSI", "nome": "MARIO LUIGI GIUSEPPE"}),
+    # Formula di cortesia fuori dal modello della lettera: ordine non determinabile
+    ("Paziente: Sig. MARIO ROSSI", {}),
+    # ... a meno che un'etichetta indichi quale token è il cognome
+    ("Paziente: Sig. MARIO ROSSI\nCognome: ROSSI", {"cognome": "ROSSI", "nome": "MARIO"}),
+]
+
+
+def run() -> int:
+    extractor = AnagraphicExtractor()
+    failures = 0
+    for text, expected in CASES:
+        found = extractor.extract(text)
+        ok = found == expected
+        failures += not ok
+        label = text.splitlines()[0][:40]
+        print(f"{'ok' if ok else 'ERRORE':<7} {label:<40}")
+        if not ok:
+            print(f"        atteso  {expected}\n        trovato {found}", file=sys.stderr)
+    print(f"\n{len(CASES) - failures}/{len(CASES)} casi corretti")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,74 @@
+"""
+Benchmark dell'estrazione LLM a fan-out (LLM_EXTRACTION_MODE=fanout).
+
+Per ogni PDF esegue l'estrazione in modalità "single" (una chiamata per chunk) e
+"fanout" (una chiamata per chunk e gruppo di campi), senza cache delle risposte,
+e confronta la latenza end-to-end e i campi valorizzati.
+
+Uso:
+    python -m benchmarks.llm_fanout <cartella_o_pdf> [...] [--document-type lettera_dimissione]
+"""
+
+import sys
+import time
+import argparse
+from typing import Dict, List
+
+from benchmarks.text_engines import collect_pdfs
+from llm.extractor import LLMExtractor
+from utils.entity_extractor import EntityExtractor
+from utils.parsed_document import ParsedDocument
+
+MODES = ("single", "fanout")
+
+
+def run(pdfs: List[str], document_type: str, model: str) -> int:
+    llm = LLMExtractor()
+    explicit_keys = llm.prompt_manager.get_spec_for(document_type)["entities"]
+    print(f"Gruppi di campi: {[len(g) for g in llm.prompt_manager.get_field_groups(document_type)]}\n")
+
+    totals: Dict[str, float] = {mode: 0.0 for mode in MODES}
+    print(f"{'documento':<40} {'modo':<7} {'chiamate':>8} {'secondi':>9} {'campi':>6} {'diversi':>8}")
+    for path in pdfs:
+        pages = [page.text for page in ParsedDocument.from_path(path).pages]
+        results: Dict[str, Dict] = {}
+        for mode in MODES:
+            start = time.perf_counter()
+            try:
+                texts, responses = llm.get_responses_for_document(
+                    pages, document_type, model, use_cache=False, mode=mode
+                )
+            except Exception as e:
+                print(f"  [{mode}] errore su {path}: {e}", file=sys.stderr)
+                continue
+            elapsed = time.perf_counter() - start
+            totals[mode] += elapsed
+            results[mode] = EntityExtractor(explicit_keys).parse_llm_responses(responses, texts)
+            filled = sum(1 for v in results[mode].values() if v not in (None, "", []))
+            diff = ""
+            if mode != MODES[0] and MODES[0] in results:
+                diff = sum(1 for k in explicit_keys if results[MODES[0]].get(k) != results[mode].get(k))
+            print(f"{path[-40:]:<40} {mode:<7} {len(responses):>8} {elapsed:>9.2f} {filled:>6} {diff:>8}")
+
+    speedup = totals["single"] / totals["fanout"] if totals["fanout"] else 0.0
+    print(f"\nTotale: single {totals['single']:.2f}s, fanout {totals['fanout']:.2f}s (speedup {speedup:.2f}x)")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Latenza dell'estrazione LLM single vs fanout")
+    parser.add_argument("paths", nargs="+", help="PDF o cartelle contenenti PDF")
+    parser.add_argument("--document-type", default="lettera_dimissione")
+    parser.add_argument("--model", default="deepseek-ai/DeepSeek-V3")
+    args = parser.parse_args()
+
+    pdfs = collect_pdfs(args.paths)
+    if not pdfs:
+        print("Nessun PDF trovato", file=sys.stderr)
+        return 1
+    print(f"Corpus: {len(pdfs)} PDF")
+    return run(pdfs, args.document_type, args.model)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+Benchmark del formato di output delle risposte LLM (LLM_OUTPUT_FORMAT).
+
+Per ogni PDF e tipo di documento esegue l'estrazione nel formato "full" (nomi dello
+schema) e "compact" (oggetto piatto a chiavi brevi), senza cache delle risposte, e
+riporta token generati, latenza e campi diversi tra i due formati.
+
+Uso:
+    python -m benchmarks.llm_output_format <cartella_o_pdf> [...] --document-types coronarografia
+"""
+
+import sys
+import argparse
+from collections import defaultdict
+from typing import Dict, List
+
+from benchmarks.text_engines import collect_pdfs
+from llm.extractor import LLMExtractor
+from llm.prompts import OUTPUT_COMPACT, OUTPUT_FULL
+from utils.entity_extractor import EntityExtractor
+from utils.parsed_document import ParsedDocument
+
+FORMATS = (OUTPUT_FULL, OUTPUT_COMPACT)
+
+
+def extract(llm: LLMExtractor, chunks: List[str], document_type: str, model: str, output_format: str):
+    """Estrae i chunk in sequenza; restituisce (risposte, token generati, secondi)."""
+    responses: List[str] = []
+    tokens = 0
+    elapsed = 0.0
+    for chunk in chunks:
+        messages, params = llm.build_request(chunk, document_type, output_format=output_format)
+        completion = llm.run(llm.acomplete(model, messages, label=f"{document_type} [{output_format}]", **params))
+        responses.append(completion.content)
+        tokens += getattr(completion.usage, "completion_tokens", 0) or 0
+        elapsed += completion.latency
+    return responses, tokens, elapsed
+
+
+def run(pdfs: List[str], document_types: List[str], model: str) -> int:
+    llm = LLMExtractor()
+    totals: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+
+    print(f"{'documento':<32} {'tipo':<20} {'formato':<8} {'token out':>9} {'secondi':>8} {'diversi':>8}")
+    for path in pdfs:
+        chunks = llm.chunk_document([page.text for page in ParsedDocument.from_path(path).pages])
+        for document_type in document_types:
+            explicit_keys = llm.prompt_manager.get_spec_for(document_type)["entities"]
+            results: Dict[str, Dict] = {}
+            for output_format in FORMATS:
+                try:
+                    responses, tokens, elapsed = extract(llm, chunks, document_type, model, output_format)
+                except Exception as e:
+                    print(f"  [{output_format}] errore su {path}: {e}", file=sys.stderr)
+                    continue
+                results[output_format] = EntityExtractor(explicit_keys).parse_llm_responses(responses, chunks)
+                totals[document_type][output_format][0] += tokens
+                totals[document_type][output_format][1] += elapsed
+                diff = ""
+                if output_format != OUTPUT_FULL and OUTPUT_FULL in results:
+                    diff = sum(
+                        1 for key in explicit_keys
+                        if results[OUTPUT_FULL].get(key) != results[output_format].get(key)
+                    )
+                print(f"{path[-32:]:<32} {document_type:<20} {output_format:<8} {tokens:>9} {elapsed:>8.2f} {diff:>8}")
+
+    print(f"\n{'tipo':<20} {'formato':<8} {'token out':>9} {'secondi':>8}")
+    for document_type, formats in totals.items():
+        for output_format in FORMATS:
+            tokens, elapsed = formats[output_format]
+            print(f"{document_type:<20} {output_format:<8} {tokens:>9} {elapsed:>8.2f}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Token generati e latenza: formato full vs compact")
+    parser.add_argument("paths", nargs="+", help="PDF o cartelle contenenti PDF")
+    parser.add_argument("--document-types", nargs="+", default=["lettera_dimissione"])
+    parser.add_argument("--model", default="deepseek-ai/DeepSeek-V3")
+    args = parser.parse_args()
+
+    pdfs = collect_pdfs(args.paths)
+    if not pdfs:
+        print("Nessun PDF trovato", file=sys.stderr)
+        return 1
+    print(f"Corpus: {len(pdfs)} PDF\n")
+    return run(pdfs, args.document_types, args.model)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
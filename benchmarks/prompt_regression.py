@@ -0,0 +1,150 @@
+"""
+Regressione dei prompt compilati (LLM_PROMPT_SOURCE=compiled) rispetto a quelli scritti a mano.
+
+Riporta sempre i token stimati di ogni prompt. Con dei PDF esegue l'estrazione con
+entrambe le sorgenti, senza cache delle risposte, e confronta:
+- concordanza dei campi tra prompt compilato e scritto a mano;
+- accuratezza rispetto ai valori attesi, se presenti in --expected
+  (<cartella>/<nome_pdf>.json con {"<tipo_documento>": {"<entità>": <valore>}}).
+
+Termina con codice 1 se un prompt compilato ha più token di quello scritto a mano, o se
+l'accuratezza (o, senza valori attesi, la concordanza) del prompt compilato scende oltre
+la tolleranza.
+
+Uso:
+    python -m benchmarks.prompt_regression                      # solo conteggio token
+    python -m benchmarks.prompt_regression <cartella_o_pdf> [...] --document-types coronarografia \\
+        [--expected attesi/] [--tolerance 0.02] [--min-agreement 0.9]
+"""
+
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+from typing import Any, Dict, Optional
+
+from benchmarks.text_engines import collect_pdfs
+from llm.extractor import LLMExtractor
+from llm.prompts import PROMPT_COMPILED, PROMPT_HANDWRITTEN, PromptManager
+from llm.rate_limiter import estimate_tokens
+from utils.entity_extractor import EntityExtractor
+from utils.parsed_document import ParsedDocument
+
+SOURCES = (PROMPT_HANDWRITTEN, PROMPT_COMPILED)
+
+
+def print_token_report() -> int:
+    """Stampa i token per tipo; 1 se un prompt compilato è più lungo di quello scritto a mano."""
+    larger = []
+    print(f"{'tipo':<28} {'scritto a mano':>14} {'compilato':>10} {'riduzione':>10}")
+    for row in PromptManager().compiler.token_report():
+        print(
+            f"{row['document_type']:<28} {row['handwritten_tokens']:>14} "
+            f"{row['compiled_tokens']:>10} {row['reduction'] * 100:>9.1f}%"
+        )
+        if row["compiled_tokens"] > row["handwritten_tokens"]:
+            larger.append(row["document_type"])
+    if larger:
+        print(f"REGRESSIONE: prompt compilati più lunghi di quelli scritti a mano: {', '.join(larger)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def _same(a: Any, b: Any) -> bool:
+    return str(a).strip().lower() == str(b).strip().lower() if a is not None and b is not None else a == b
+
+
+def load_expected(folder: Optional[str], path: str) -> Dict[str, Dict[str, Any]]:
+    if not folder:
+        return {}
+    expected_path = os.path.join(folder, os.path.splitext(os.path.basename(path))[0] + ".json")
+    if not os.path.exists(expected_path):
+        return {}
+    with open(expected_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def run(args) -> int:
+    llm = LLMExtractor()
+    managers = {source: PromptManager(prompt_source=source) for source in SOURCES}
+    stats: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    for path in collect_pdfs(args.paths):
+        pages = [page.text for page in ParsedDocument.from_path(path).pages]
+        expected_all = load_expected(args.expected, path)
+        for document_type in args.document_types:
+            explicit_keys = managers[PROMPT_HANDWRITTEN].get_spec_for(document_type)["entities"]
+            results: Dict[str, Dict[str, Any]] = {}
+            for source in SOURCES:
+                llm.prompt_manager = managers[source]
+                try:
+                    texts, responses = llm.get_responses_for_document(
+                        pages, document_type, args.model, use_cache=False
+                    )
+                except Exception as e:
+                    print(f"  [{source}] errore su {path}: {e}", file=sys.stderr)
+                    continue
+                results[source] = EntityExtractor(explicit_keys).parse_llm_responses(responses, texts)
+                stats[source]["documents"] += 1
+                system_prompt = llm.build_request("", document_type)[0][0]["content"]
+                stats[source]["prompt_tokens"] += estimate_tokens(system_prompt)
+
+                expected = expected_all.get(document_type, {})
+                for key, value in expected.items():
+                    stats[source]["expected"] += 1
+                    stats[source]["correct"] += _same(results[source].get(key), value)
+
+            if len(results) == len(SOURCES):
+                agree = sum(_same(results[SOURCES[0]].get(k), results[SOURCES[1]].get(k)) for k in explicit_keys)
+                stats[PROMPT_COMPILED]["fields"] += len(explicit_keys)
+                stats[PROMPT_COMPILED]["agree"] += agree
+                print(f"{path[-40:]:<40} {document_type:<24} concordanza {agree}/{len(explicit_keys)}")
+
+    print(f"\n{'sorgente':<12} {'documenti':>9} {'token prefisso':>18} {'accuratezza':>12}")
+    accuracy: Dict[str, Optional[float]] = {}
+    for source in SOURCES:
+        s = stats[source]
+        accuracy[source] = s["correct"] / s["expected"] if s["expected"] else None
+        avg_tokens = s["prompt_tokens"] / s["documents"] if s["documents"] else 0
+        acc = f"{accuracy[source] * 100:.1f}%" if accuracy[source] is not None else "-"
+        print(f"{source:<12} {int(s['documents']):>9} {avg_tokens:>18.0f} {acc:>12}")
+
+    compiled = stats[PROMPT_COMPILED]
+    agreement = compiled["agree"] / compiled["fields"] if compiled["fields"] else None
+    if agreement is not None:
+        print(f"\nConcordanza compilato/scritto a mano: {agreement * 100:.1f}%")
+
+    if accuracy[PROMPT_COMPILED] is not None and accuracy[PROMPT_HANDWRITTEN] is not None:
+        if accuracy[PROMPT_COMPILED] < accuracy[PROMPT_HANDWRITTEN] - args.tolerance:
+            print("REGRESSIONE: accuratezza del prompt compilato oltre la tolleranza", file=sys.stderr)
+            return 1
+    elif agreement is not None and agreement < args.min_agreement:
+        print("REGRESSIONE: concordanza del prompt compilato sotto la soglia", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Token e qualità: prompt compilati vs scritti a mano")
+    parser.add_argument("paths", nargs="*", help="PDF o cartelle contenenti PDF (nessuno: solo token)")
+    parser.add_argument("--document-types", nargs="+", default=["lettera_dimissione"])
+    parser.add_argument("--model", default="deepseek-ai/DeepSeek-V3")
+    parser.add_argument("--expected", help="Cartella con i valori attesi per PDF")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="Calo massimo di accuratezza ammesso")
+    parser.add_argument("--min-agreement", type=float, default=0.9, help="Concordanza minima senza valori attesi")
+    args = parser.parse_args()
+
+    if print_token_report():
+        return 1
+    if not args.paths:
+        return 0
+    if not collect_pdfs(args.paths):
+        print("Nessun PDF trovato", file=sys.stderr)
+        return 1
+    print()
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
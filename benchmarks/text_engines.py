@@ -0,0 +1,107 @@
+"""
+Benchmark dei motori di estrazione del testo (utils/text_engines.py).
+
+Per ogni motore misura pagine/secondo su un corpus di PDF e confronta l'output
+con il motore di riferimento (pdfplumber): similarità del testo per pagina,
+numero di word e pagine classificate diversamente per l'OCR.
+
+Uso:
+    python -m benchmarks.text_engines <cartella_o_pdf> [...] [--engines pdfplumber pypdfium2]
+"""
+
+import os
+import sys
+import time
+import argparse
+from typing import Dict, List
+
+from rapidfuzz import fuzz
+
+from utils.parsed_document import ParsedDocument
+from utils.text_engines import ENGINES
+
+
+def collect_pdfs(paths: List[str]) -> List[str]:
+    pdfs: List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                pdfs.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(".pdf"))
+        elif path.lower().endswith(".pdf"):
+            pdfs.append(path)
+    return pdfs
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def run(pdfs: List[str], engines: List[str], reference: str) -> int:
+    documents: Dict[str, Dict[str, ParsedDocument]] = {name: {} for name in engines}
+
+    print(f"{'motore':<12} {'pagine':>8} {'secondi':>9} {'pag/s':>9}")
+    for name in engines:
+        pages = 0
+        elapsed = 0.0
+        for path in pdfs:
+            with open(path, "rb") as f:
+                data = f.read()
+            start = time.perf_counter()
+            try:
+                parsed = ParsedDocument.from_bytes(data, engine=name)
+            except Exception as e:
+                print(f"  [{name}] errore su {path}: {e}", file=sys.stderr)
+                continue
+            elapsed += time.perf_counter() - start
+            pages += parsed.page_count
+            documents[name][path] = parsed
+        rate = pages / elapsed if elapsed else 0.0
+        print(f"{name:<12} {pages:>8} {elapsed:>9.2f} {rate:>9.1f}")
+
+    if reference not in documents:
+        return 0
+
+    print(f"\nParità rispetto a {reference}")
+    print(f"{'motore':<12} {'sim. media':>10} {'sim. min':>9} {'word %':>8} {'ocr diff':>9}")
+    for name in engines:
+        if name == reference:
+            continue
+        similarities: List[float] = []
+        ref_words = 0
+        words = 0
+        ocr_mismatch = 0
+        for path, ref_doc in documents[reference].items():
+            doc = documents[name].get(path)
+            if doc is None:
+                continue
+            for ref_page, page in zip(ref_doc.pages, doc.pages):
+                similarities.append(fuzz.ratio(_normalize(ref_page.text), _normalize(page.text)))
+                ref_words += len(ref_page.words)
+                words += len(page.words)
+            if ref_doc.pages_needing_ocr() != doc.pages_needing_ocr():
+                ocr_mismatch += 1
+        if not similarities:
+            continue
+        mean = sum(similarities) / len(similarities)
+        word_ratio = 100 * words / ref_words if ref_words else 0.0
+        print(f"{name:<12} {mean:>10.1f} {min(similarities):>9.1f} {word_ratio:>8.1f} {ocr_mismatch:>9}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark dei motori di estrazione del testo")
+    parser.add_argument("paths", nargs="+", help="PDF o cartelle contenenti PDF")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument("--reference", default="pdfplumber", choices=list(ENGINES))
+    args = parser.parse_args()
+
+    pdfs = collect_pdfs(args.paths)
+    if not pdfs:
+        print("Nessun PDF trovato", file=sys.stderr)
+        return 1
+    print(f"Corpus: {len(pdfs)} PDF\n")
+    return run(pdfs, args.engines, args.reference)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,30 +1,35 @@
 import os
 import json
-import pdfplumber
-import numpy as np
 import logging
 import time
 from llm.extractor import LLMExtractor, logger
 from utils.excel_manager import ExcelManager
 from utils.file_manager import FileManager
-from utils.entity_extractor import EntityExtractor
+from utils.entity_extractor import EntityExtractor, compact_keys
 from llm.prompts import PromptManager
+from llm.stream_parser import PartialEntities
 from utils.table_parser import TableParser
 from utils.progress import ProgressStore
 from utils.metadata_coherence_manager import MetadataCoherenceManager
+from utils.anagraphic_extractor import AnagraphicExtractor
 from utils.pdf_position_extractor import PDFPositionExtractor
+from utils.parsed_document import ParsedDocument
+from utils.content_cache import ContentCache
+from services.job_queue import JobQueue, PermanentJobError
 
 from datetime import datetime
 
 class DocumentController:
     def __init__(
         self,
+        job_queue: JobQueue,
         #model_name: str = "openai/gpt-oss-120b",
-        model_name: str = "deepseek-ai/DeepSeek-V3",
+        model_name: str | None = None,
         upload_folder: str | None = None,
         export_folder: str | None = None,
     ):
-        self.model_name = model_name
+        # modello grande: i referti brevi possono andare a LLM_SMALL_MODEL (vedi ModelRouter)
+        self.model_name = model_name or os.getenv("LLM_MODEL", "deepseek-ai/DeepSeek-V3")
         self.llm = LLMExtractor()
         self.excel_manager = ExcelManager()
         self.file_manager = FileManager()
@@ -42,7 +47,18 @@ class DocumentController:
             self.excel_manager.EXPORT_PATH = os.path.join(export_folder, "output.xlsx")
         
         # Inizializza il gestore di coerenza dei metadati
-        self.coherence_manager = MetadataCoherenceManager(self.upload_folder)        
+        self.coherence_manager = MetadataCoherenceManager(self.upload_folder)
+        # Estrazione anagrafica a regole (n_cartella, nome, cognome) prima dell'LLM
+        self.anagraphic_extractor = AnagraphicExtractor()
+
+        # Cache indirizzata per contenuto (parsing/OCR e risposte LLM dei PDF già visti)
+        self.content_cache = ContentCache()
+
+        # Coda dei job di processing in background (obbligatoria: upload, cambio tipo
+        # e ri-estrazione accodano il lavoro)
+        self.job_queue = job_queue
+        job_queue.register("process_document", self.run_process_document)
+        job_queue.register("re_extract_entities", self.run_re_extraction)
 
 
     def validate_upload_request(self, files, patient_id: str = None, process_as_packet: bool = False) -> tuple[bool, str, list]:
@@ -99,30 +115,6 @@ class DocumentController:
         
         return True, "", validated_files
 
-    def get_text_to_remove(self, all_tables: list[list[list[str]]]) -> list[str]:
-        text_to_remove: list[str] = []
-        for table in all_tables:
-            arr = np.array(table)
-            for row in arr:
-                norm = "".join(str(cell) for cell in row).replace(" ", "").replace("\n", "")
-                if norm:
-                    text_to_remove.append(norm)
-        return text_to_remove
-
-    def remove_tables(self, all_text: str, text_to_remove: list[str]) -> str:
-        clean_lines: list[str] = []
-        for line in all_text.splitlines():
-            norm = line.replace(" ", "").replace("\n", "")
-            if norm not in text_to_remove:
-                clean_lines.append(line)
-        return "\n".join(clean_lines)
-
-    def get_cleaned_text(self, all_text: str, all_tables: list[list[list[str]]]) -> str:
-        if all_tables:
-            text_to_remove = self.get_text_to_remove(all_tables)
-            return self.remove_tables(all_text, text_to_remove)
-        return all_text 
-
     def extract_from_tables(self, tables: list[list[list[str]]]) -> dict:
         entities: dict[str, str] = {}
         for table in tables:
@@ -145,25 +137,56 @@ class DocumentController:
         patient_id: str,
         document_type: str,
         provided_anagraphic: dict = None,
-        text: str = None
+        text: str = None,
+        parsed_document: ParsedDocument = None,
+        content_hash: str = None,
+        use_cache: bool = True,
+        llm_responses: list = None
     ) -> dict:
         try:
-            # 1. Estrai testo se non fornito
-            #TO DO non credo serva perchè se non lo ha estratto vuol dire che c'è stato un errore nel caricamento del documento
+            # 1. Testo per pagina: dall'upload, altrimenti quello salvato all'ingestione
+            #    (riprocessamento o job recuperato); il PDF viene riparsato solo come ultima risorsa
+            if content_hash is None:
+                content_hash = self.file_manager.read_content_hash(filepath)
+            if parsed_document is None:
+                parsed_document = self._load_parsed_document(filepath, content_hash)
             if text is None:
-                with pdfplumber.open(filepath) as pdf:
-                    text = "\n".join(page.extract_text() or "" for page in pdf.pages)
+                text = parsed_document.text
 
-            # 2. Prepara prompt
-            prompt = self.prompt_manager.get_prompt_for(document_type)
-            full_prompt = prompt + "\n```\n" + text + "\n```"
+            # 2. Entità attese per il tipo di documento (il prompt è composto da LLMExtractor)
             spec = self.prompt_manager.get_spec_for(document_type)
             explicit_keys = spec['entities']
 
-            # 3. Richiesta al modello
-            response_str = self.llm.get_response_from_document(
-                text, document_type, model=self.model_name
-            )
+            # 2.5 Verifica di coerenza preliminare con l'anagrafica estratta a regole:
+            #     solo un n_cartella con etichetta diverso dal riferimento rifiuta il documento
+            #     senza chiamare il modello; le differenze sui nomi sono lasciate al passo 6
+            anagraphic = self.anagraphic_extractor.extract(text)
+            precheck = self.coherence_manager.precheck_document_coherence(patient_id, document_type, anagraphic)
+            if precheck.status == "rejected":
+                logger.info(f"Documento {filepath} rifiutato dalla verifica preliminare: {precheck.reason}")
+                return self._coherence_rejection(filepath, patient_id, document_type, precheck)
+            if precheck.incoerenti:
+                logger.info(f"Verifica preliminare di {filepath}: {precheck.reason} {precheck.incoerenti}")
+
+            # 3. Richiesta al modello, a chunk per i documenti lunghi: riusa le risposte già
+            #    ottenute all'upload (n_cartella delle lettere di dimissione); la cache delle
+            #    risposte è gestita da LLMExtractor
+            pages = [page.text for page in parsed_document.pages]
+            if llm_responses:
+                try:
+                    chunks = self.llm.align_texts(self.llm.chunk_document(pages, document_type), llm_responses)
+                except ValueError as e:
+                    logger.warning(f"Risposte dell'upload non riutilizzabili per {filepath}, nuova estrazione: {e}")
+                    llm_responses = None
+            if not llm_responses:
+                # Entità parziali nel progress del job mentre la risposta arriva in streaming
+                partial = self._partial_entities(explicit_keys)
+                chunks, llm_responses = self.llm.get_responses_for_document(
+                    pages, document_type, model=self.model_name, use_cache=use_cache,
+                    on_items=partial.add if partial else None
+                )
+                if partial:
+                    partial.flush()
         except RuntimeError as e:
             # API key mancante o altri errori runtime
             logging.error(f"Errore runtime nel processing del documento {filepath}: {e}")
@@ -175,20 +198,35 @@ class DocumentController:
             self._save_processing_error(patient_id, document_type, str(e))
             raise
 
-        # 4. Parsifica risposta
-        logger.debug(f"RISPOSTA: {response_str}")
+        # 4. Parsifica le risposte e unisci i chunk (primo valore non nullo, conflitti a parte)
+        logger.debug(f"RISPOSTE: {llm_responses}")
         extractor = EntityExtractor(explicit_keys)
-        entities = extractor.parse_llm_response(response_str, text)
+        entities = extractor.parse_llm_responses(llm_responses, chunks)
+        if extractor.conflicts:
+            logger.info(f"Valori discordanti tra i chunk di {filepath}: {list(extractor.conflicts)}")
+
+        # 4.5 Completa i campi anagrafici che il modello non ha restituito con quelli a regole
+        for key, value in anagraphic.items():
+            if key in explicit_keys and not entities.get(key):
+                entities[key] = value
 
         # 5. Sovrascrivi anagrafica se fornita
+        provided = {}
         if provided_anagraphic:
-            for key in ("n_cartella", "nome", "cognome"):
-                if provided_anagraphic.get(key):
-                    entities[key] = provided_anagraphic[key]
+            provided = {
+                key: provided_anagraphic[key]
+                for key in ("n_cartella", "nome", "cognome")
+                if provided_anagraphic.get(key)
+            }
+            entities.update(provided)
+
+        # 5.1 Nuova richiesta solo per i campi ancora nulli o non validi rispetto allo schema,
+        #     esclusi quelli forniti che sovrascriverebbero comunque la risposta
+        entities = self._requery_fields(entities, chunks, document_type, use_cache=use_cache, skip=provided)
 
         # 5.5 Estrai posizioni delle entità dal PDF
         try:
-            position_extractor = PDFPositionExtractor(filepath)
+            position_extractor = PDFPositionExtractor(filepath, parsed_document=parsed_document)
             entities_with_positions = position_extractor.extract_entities_positions(entities)
             # Converte il formato per mantenere compatibilità con il resto del codice
             entities_for_save = {}
@@ -211,29 +249,12 @@ class DocumentController:
         coherence_result = self.coherence_manager.check_document_coherence(patient_id, document_type, entities_for_save)
         
         if coherence_result.status == "rejected":
-            # Rimuovi il file e la cartella del paziente se necessario
-            os.remove(filepath)
-            if document_type == "lettera_dimissione":
-                self.file_manager.remove_patient_folder_if_exists(patient_id)
-            
-            # Prepara la risposta di errore
-            error_response = {
-                "error": coherence_result.reason,
-                "coherence_check": {
-                    "status": coherence_result.status,
-                    "reason": coherence_result.reason,
-                    "diff": coherence_result.diff,
-                    "references": coherence_result.references,
-                    "incoerenti": coherence_result.incoerenti
-                }
-            }
-            
-            return error_response, 400
+            return self._coherence_rejection(filepath, patient_id, document_type, coherence_result)
 
         # 7. Controlli obbligatori (mantenuti per compatibilità)
         if document_type in ("lettera_dimissione", "eco_preoperatorio"):
             if not entities_for_save.get("n_cartella"):
-                os.remove(filepath)
+                self.file_manager.remove_file(filepath)
                 self.file_manager.remove_patient_folder_if_exists(patient_id)
                 return {"error": f"Numero di cartella mancante per {document_type}."}, 400
 
@@ -249,6 +270,8 @@ class DocumentController:
             "entities": entities_for_save,
             "positions": positions_data
         }
+        if extractor.conflicts:
+            entities_with_metadata["conflicts"] = extractor.conflicts
         metadata_path = os.path.join(output_dir, "entities_metadata.json")
         with open(metadata_path, "w", encoding="utf-8") as f:
             json.dump(entities_with_metadata, f, indent=2, ensure_ascii=False)
@@ -259,6 +282,58 @@ class DocumentController:
         return entities_for_save
 
 
+    def run_process_document(self, **payload) -> None:
+        """
+        Handler del job "process_document": un documento rifiutato (coerenza o
+        n_cartella mancante) è già stato rimosso, quindi il job fallisce senza retry
+        con il motivo del rifiuto invece di risultare completato.
+        """
+        result = self.process_document_and_entities(**payload)
+        if isinstance(result, tuple):
+            raise PermanentJobError(result[0].get("error"))
+
+
+    def _coherence_rejection(self, filepath: str, patient_id: str, document_type: str, coherence_result) -> tuple:
+        """Rimuove il documento rifiutato per incoerenza e prepara la risposta di errore."""
+        # Rimuovi il file e la cartella del paziente se necessario
+        self.file_manager.remove_file(filepath)
+        if document_type == "lettera_dimissione":
+            self.file_manager.remove_patient_folder_if_exists(patient_id)
+        
+        # Prepara la risposta di errore
+        error_response = {
+            "error": coherence_result.reason,
+            "coherence_check": {
+                "status": coherence_result.status,
+                "reason": coherence_result.reason,
+                "diff": coherence_result.diff,
+                "references": coherence_result.references,
+                "incoerenti": coherence_result.incoerenti
+            }
+        }
+        
+        return error_response, 400
+
+
+    def _load_parsed_document(self, filepath: str, content_hash: str = None) -> ParsedDocument:
+        """
+        Carica testo e word per pagina salvati all'ingestione (che includono l'OCR),
+        poi dalla cache dei contenuti; solo per i documenti più vecchi riparsa il PDF
+        e salva il risultato per le volte successive.
+        """
+        parsed = self.file_manager.load_parsed_document(filepath)
+        if parsed is not None:
+            return parsed
+        if content_hash:
+            cached = self.content_cache.load_document(content_hash)
+            if cached is not None:
+                parsed = cached[0]
+        if parsed is None:
+            parsed = ParsedDocument.from_path(filepath)
+        self.file_manager.save_parsed_document(filepath, parsed)
+        return parsed
+
+
     def _extract_entities_for_section(self, section_text: str, doc_type: str) -> dict:
         """Estrae entità da una sezione usando il prompt dedicato."""
         try:
@@ -266,21 +341,16 @@ class DocumentController:
             spec = self.prompt_manager.get_spec_for(doc_type)
             explicit_keys = spec['entities']
             
-            # Limita input per LLM
-            MAX_CHARS = 40000
-            if len(section_text) > MAX_CHARS:
-                section_text = section_text[:MAX_CHARS]
-            
-            # Estrazione con LLM
-            response_str = self.llm.get_response_from_document(
-                section_text, doc_type, model=self.model_name
+            # Estrazione con LLM: le sezioni lunghe sono divise in chunk invece che troncate
+            chunks, responses = self.llm.get_responses_for_document(
+                [section_text], doc_type, model=self.model_name
             )
             
-            # Parsing della risposta
+            # Parsing e unione delle risposte
             extractor = EntityExtractor(explicit_keys)
-            entities = extractor.parse_llm_response(response_str, section_text)
+            entities = extractor.parse_llm_responses(responses, chunks)
             
-            return entities
+            return self._requery_fields(entities, chunks, doc_type)
             
         except Exception as e:
             logging.error(f"Errore estrazione entità per {doc_type}: {e}")
@@ -288,6 +358,73 @@ class DocumentController:
 
 
     
+    def _requery_fields(
+        self,
+        entities: dict,
+        chunks: list,
+        document_type: str,
+        use_cache: bool = True,
+        skip: dict | None = None,
+    ) -> dict:
+        """
+        Ripete la richiesta solo per i campi non validi rispetto allo schema e per gli
+        obbligatori mancanti (prompt e schema ridotti a quei campi) e unisce le risposte al
+        risultato: molto più economico di una ri-estrazione. Gli altri campi nulli, di solito
+        assenti dal documento, solo con LLM_REQUERY_NULLS=true.
+        Un valore esistente viene sostituito solo da uno valido; gli errori non bloccano il documento.
+        I campi in `skip` (es. l'anagrafica fornita) non vengono richiesti.
+        """
+        if os.getenv("LLM_REQUERY_ENABLED", "true").lower() != "true":
+            return entities
+        validation = self.llm.validator.validate_values(entities, document_type)
+        # Prima i non validi, poi gli obbligatori mancanti, poi (se richiesto) gli altri nulli
+        fields = list(validation.invalid) + validation.missing_required
+        if os.getenv("LLM_REQUERY_NULLS", "false").lower() == "true":
+            fields += [key for key, value in entities.items() if value is None]
+        fields = [key for key in dict.fromkeys(fields) if key not in (skip or {})]
+        fields = fields[:int(os.getenv("LLM_REQUERY_MAX_FIELDS", "40"))]
+        if not fields:
+            return entities
+
+        try:
+            texts, responses = self.llm.get_responses_for_fields(
+                chunks, document_type, self.model_name, fields, use_cache=use_cache
+            )
+        except Exception as e:
+            logger.warning(f"Nuova richiesta per {len(fields)} campi di {document_type} fallita: {e}")
+            return entities
+
+        # Le chiavi brevi del formato compatto sono quelle dello schema completo
+        short_keys = compact_keys(self.prompt_manager.get_spec_for(document_type)["entities"])
+        answers = EntityExtractor(fields, short_keys).parse_llm_responses(responses, texts)
+        answers = {key: value for key, value in answers.items() if value is not None}
+        recheck = self.llm.validator.validate_values(answers, document_type, fields)
+        merged = dict(entities)
+        recovered = [key for key in answers if key not in recheck.invalid]
+        for key in recovered:
+            merged[key] = answers[key]
+        logger.info(
+            f"Nuova richiesta per {len(fields)} campi nulli o non validi di {document_type}: "
+            f"{len(recovered)} valorizzati"
+        )
+        return merged
+
+    def _partial_entities(self, explicit_keys: list) -> PartialEntities | None:
+        """
+        Raccoglitore delle entità parziali del job corrente, pubblicate nel suo progress
+        (stage "extracting", visibile su /api/jobs/<job_id>). None fuori da un worker.
+        """
+        report = self.job_queue.progress_reporter()
+        if report is None:
+            return None
+        return PartialEntities(
+            explicit_keys,
+            lambda entities: report(
+                stage="extracting", partial_entities=entities, fields_received=len(entities)
+            ),
+            interval=float(os.getenv("LLM_PARTIAL_INTERVAL", "1")),
+        )
+
     def _save_processing_error(self, patient_id: str, document_type: str, error_message: str):
         """Salva informazioni sull'errore di processing per debug."""
         try:
@@ -340,7 +477,12 @@ class DocumentController:
         return self.file_manager.get_document_detail(document_id)
 
     def delete_document(self, document_id: str) -> dict:
-        return self.file_manager.delete_document(document_id)
+        result = self.file_manager.delete_document(document_id)
+        # Testo e PDF OCRizzato del documento cancellato non restano nella cache dei contenuti
+        content_hash = result.pop("content_hash", None)
+        if content_hash:
+            self.content_cache.invalidate(content_hash)
+        return result
 
     def get_available_document_types(self) -> list:
         """
@@ -389,18 +531,17 @@ class DocumentController:
                 patient_id, "lettera_dimissione"
             )
         
-        # Avvia processing in background
-        from threading import Thread
-        
-        def process_with_error_logging():
-            try:
-                self.process_document_and_entities(
-                    filepath, patient_id, new_document_type, provided_anagraphic
-                )
-            except Exception as e:
-                logging.exception(f"Errore critico nel processing di {filepath}: {e}")
-        
-        Thread(target=process_with_error_logging, daemon=True).start()
+        # Accoda il processing in background
+        job_id = self.job_queue.enqueue(
+            "process_document",
+            {
+                "filepath": filepath,
+                "patient_id": patient_id,
+                "document_type": new_document_type,
+                "provided_anagraphic": provided_anagraphic,
+            },
+            document_id=new_document_id,
+        )
         
         return {
             "success": True,
@@ -410,6 +551,7 @@ class DocumentController:
             "patient_id": patient_id,
             "old_document_type": "altro",
             "new_document_type": new_document_type,
+            "job_id": job_id,
             "status": "processing"
         }
 
@@ -463,53 +605,18 @@ class DocumentController:
         except ValueError as e:
             return {"success": False, "error": f"Tipo documento '{extraction_type}' non supportato: {str(e)}"}
         
-        # Avvia processing in background
-        from threading import Thread
-        
-        def process_in_background():
-            try:
-                # Leggi anagrafica esistente se disponibile (solo se non è lettera_dimissione)
-                provided_anagraphic = None
-                if extraction_type != "lettera_dimissione":
-                    provided_anagraphic = self.file_manager.read_existing_entities(
-                        patient_id, "lettera_dimissione"
-                    )
-                
-                # Esegui l'estrazione (usando il tipo specificato per il prompt)
-                entities_result = self.process_document_and_entities(
-                    filepath,
-                    patient_id,
-                    extraction_type,  # Usa il tipo specificato per il prompt
-                    provided_anagraphic
-                )
-                
-                # Se il risultato è una tupla con codice di errore, gestiscilo
-                if isinstance(entities_result, tuple):
-                    logging.error(f"Errore durante estrazione: {entities_result[0].get('error')}")
-                    return
-                
-                # Se il tipo di estrazione è diverso dal tipo originale, sposta le entità nella cartella originale
-                if extraction_type != current_document_type:
-                    # Salva le entità nella cartella del documento originale (sovrascrivendo quelle esistenti)
-                    self.file_manager.save_entities_json(patient_id, current_document_type, entities_result)
-                    
-                    # Aggiorna anche l'Excel con il tipo originale
-                    self.excel_manager.update_excel(patient_id, current_document_type, entities_result)
-                    
-                    # Rimuovi le entità salvate nella cartella del tipo di estrazione (se diversa)
-                    extraction_dir = os.path.join(self.file_manager.UPLOAD_FOLDER, patient_id, extraction_type)
-                    extraction_entities_path = os.path.join(extraction_dir, "entities.json")
-                    if os.path.exists(extraction_entities_path) and extraction_dir != os.path.join(self.file_manager.UPLOAD_FOLDER, patient_id, current_document_type):
-                        try:
-                            os.remove(extraction_entities_path)
-                        except Exception as e:
-                            logging.warning(f"Impossibile rimuovere entities.json dalla cartella {extraction_type}: {e}")
-                
-            except Exception as e:
-                logging.exception(f"Errore durante la ri-estrazione in background di {document_id}: {e}")
-        
-        # Avvia il thread in background
-        Thread(target=process_in_background, daemon=True).start()
+        # Accoda la ri-estrazione in background
+        job_id = self.job_queue.enqueue(
+            "re_extract_entities",
+            {
+                "document_id": document_id,
+                "filepath": filepath,
+                "patient_id": patient_id,
+                "extraction_type": extraction_type,
+                "current_document_type": current_document_type,
+            },
+            document_id=document_id,
+        )
         
         # Ritorna immediatamente
         return {
@@ -519,5 +626,56 @@ class DocumentController:
             "patient_id": patient_id,
             "extraction_document_type": extraction_type,
             "original_document_type": current_document_type,
+            "job_id": job_id,
             "status": "processing"
         }
+
+    def run_re_extraction(
+        self,
+        document_id: str,
+        filepath: str,
+        patient_id: str,
+        extraction_type: str,
+        current_document_type: str
+    ) -> None:
+        """
+        Esegue la ri-estrazione accodata da re_extract_entities (handler del job "re_extract_entities").
+        Le eccezioni vengono propagate alla coda, che gestisce i retry.
+        """
+        # Leggi anagrafica esistente se disponibile (solo se non è lettera_dimissione)
+        provided_anagraphic = None
+        if extraction_type != "lettera_dimissione":
+            provided_anagraphic = self.file_manager.read_existing_entities(
+                patient_id, "lettera_dimissione"
+            )
+        
+        # Esegui l'estrazione (usando il tipo specificato per il prompt)
+        entities_result = self.process_document_and_entities(
+            filepath,
+            patient_id,
+            extraction_type,  # Usa il tipo specificato per il prompt
+            provided_anagraphic,
+            use_cache=False  # ri-estrazione esplicita: interroga sempre il modello
+        )
+        
+        # Documento rifiutato: il job fallisce con il motivo, senza retry
+        if isinstance(entities_result, tuple):
+            logging.error(f"Errore durante estrazione di {document_id}: {entities_result[0].get('error')}")
+            raise PermanentJobError(entities_result[0].get("error"))
+        
+        # Se il tipo di estrazione è diverso dal tipo originale, sposta le entità nella cartella originale
+        if extraction_type != current_document_type:
+            # Salva le entità nella cartella del documento originale (sovrascrivendo quelle esistenti)
+            self.file_manager.save_entities_json(patient_id, current_document_type, entities_result)
+            
+            # Aggiorna anche l'Excel con il tipo originale
+            self.excel_manager.update_excel(patient_id, current_document_type, entities_result)
+            
+            # Rimuovi le entità salvate nella cartella del tipo di estrazione (se diversa)
+            extraction_dir = os.path.join(self.file_manager.UPLOAD_FOLDER, patient_id, extraction_type)
+            extraction_entities_path = os.path.join(extraction_dir, "entities.json")
+            if os.path.exists(extraction_entities_path) and extraction_dir != os.path.join(self.file_manager.UPLOAD_FOLDER, patient_id, current_document_type):
+                try:
+                    os.remove(extraction_entities_path)
+                except Exception as e:
+                    logging.warning(f"Impossibile rimuovere entities.json dalla cartella {extraction_type}: {e}")
@@ -0,0 +1,59 @@
+"""
+Suddivisione token-aware del testo di un documento per l'estrazione map-reduce.
+
+I chunk seguono i confini naturali del documento: pagine, poi paragrafi e righe
+per le pagine troppo lunghe; solo una singola riga oltre il budget viene spezzata.
+"""
+
+from typing import List
+
+from .rate_limiter import CHARS_PER_TOKEN, estimate_tokens
+
+
+def _split_oversized(text: str, max_tokens: int) -> List[str]:
+    """Divide un blocco oltre il budget per paragrafi, poi righe, poi caratteri."""
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    for separator in ("\n\n", "\n"):
+        parts = [p for p in text.split(separator) if p.strip()]
+        if len(parts) > 1:
+            pieces: List[str] = []
+            for part in parts:
+                pieces.extend(_split_oversized(part, max_tokens))
+            return _pack(pieces, max_tokens, separator)
+
+    max_chars = int(max_tokens * CHARS_PER_TOKEN)
+    return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+
+
+def _pack(pieces: List[str], max_tokens: int, separator: str) -> List[str]:
+    """Raggruppa pezzi consecutivi finché restano entro il budget."""
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(separator.join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append(separator.join(current))
+    return chunks
+
+
+def split_into_chunks(pages: List[str], max_tokens: int) -> List[str]:
+    """
+    Raggruppa le pagine in chunk di al più `max_tokens` token stimati,
+    mantenendo l'ordine del documento.
+
+    Returns:
+        Lista di chunk (almeno uno, eventualmente vuoto)
+    """
+    pieces: List[str] = []
+    for page in pages:
+        if page.strip():
+            pieces.extend(_split_oversized(page, max_tokens))
+    return _pack(pieces, max_tokens, "\n") or [""]
@@ -1,13 +1,100 @@
 import os
+import json
 import time
+import random
+import asyncio
 import logging
-from together import Together, error
+import threading
+import email.utils
+import weakref
+from dataclasses import dataclass
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+from together import AsyncTogether, error
 from dotenv import load_dotenv
-from .prompts import PromptManager
+from utils.entity_extractor import compact_keys
+from utils.page_selector import PageSelector
+from utils.text_compactor import TextCompactor
+from .prompts import OUTPUT_COMPACT, PromptManager
+from .rate_limiter import RateLimiter, estimate_tokens
+from .token_budget import ContextOverflowError, OutputTruncatedError, TokenBudget
+from .model_router import ROUTE_LARGE, ROUTE_SMALL, ModelRouter, Route
+from .output_validator import OutputValidator
+from .response_cache import LLMResponseCache
+from .chunker import split_into_chunks
+from .metrics import LLMMetrics
+from .stream_parser import IncrementalEntityParser, Item
+
+# Riceve le coppie (entità, valore) appena chiuse nella risposta in streaming
+ItemsCallback = Callable[[List[Item]], None]
 
 logger = logging.getLogger(__name__)
 
+
+@dataclass
+class LLMCompletion:
+    """Esito di una chat completion (in streaming o meno), con i tempi misurati."""
+    content: str
+    usage: Any = None
+    ttft: Optional[float] = None
+    latency: float = 0.0
+    estimated_prompt_tokens: Optional[int] = None
+    max_tokens: Optional[int] = None
+    finish_reason: Optional[str] = None
+
+    @property
+    def cached_tokens(self) -> Optional[int]:
+        """Token di input serviti dalla cache di prefisso del provider, se riportati."""
+        details = getattr(self.usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) if details is not None else None
+        return cached if cached is not None else getattr(self.usage, "cached_tokens", None)
+
+
 class LLMExtractor:
+    """
+    Client LLM asincrono (AsyncTogether).
+
+    - Tutte le richieste girano su un unico event loop condiviso (thread dedicato):
+      molti documenti possono essere in volo senza un thread del SO per ciascuno.
+    - Un semaforo condiviso limita le richieste contemporanee (LLM_MAX_CONCURRENCY).
+    - I retry usano backoff esponenziale con jitter e rispettano l'header Retry-After.
+    - LLM_REQUEST_TIMEOUT limita il singolo tentativo, LLM_DEADLINE l'intera chiamata
+      (retry inclusi); la deadline è configurabile anche per chiamata.
+    - Ogni tentativo passa dal rate limiter RPM/TPM condiviso tra processi (LLM_RPM, LLM_TPM).
+    - Le risposte sono salvate in una cache persistente (modello + versione prompt/schema
+      + hash del testo); `use_cache=False` la bypassa per le ri-estrazioni forzate.
+    - Prima del chunking il testo è compattato (TextCompactor: intestazioni e piè di pagina
+      ripetuti, numeri di pagina, righe identiche consecutive, spazi).
+    - I documenti lunghi sono divisi in chunk (LLM_CHUNK_TOKENS token stimati) estratti
+      in parallelo con lo stesso schema (map); l'unione è in EntityExtractor (reduce).
+    - Con LLM_EXTRACTION_MODE=fanout gli schemi grandi (PromptManager.FIELD_GROUPS) sono
+      divisi in gruppi di campi: una richiesta per gruppo con prompt e schema ridotti,
+      in parallelo, unite come i chunk.
+    - Ogni richiesta ha un prefisso statico (system: prompt + schema) seguito dal documento
+      (user), riusabile dalla cache di prefisso del provider; con LLM_STREAM=true (default)
+      si misura il time-to-first-token per tipo di documento (self.metrics) e, con
+      `on_items`, le entità sono consegnate man mano che il JSON della risposta si chiude.
+    - Con LLM_OUTPUT_FORMAT=compact il modello restituisce un oggetto piatto a chiavi brevi,
+      senza le entità assenti (meno token generati); EntityExtractor lo riconduce allo schema.
+    - I token di input sono contati prima dell'invio (TokenBudget); max_tokens è proporzionale
+      ai campi dello schema richiesto e i chunk sono limitati allo spazio libero nel contesto
+      del modello, così un input troppo lungo viene diviso invece di fallire a ogni retry.
+      Una risposta troncata a max_tokens è ritentata con un budget maggiore e non finisce
+      mai in cache, come le risposte non parsabili come JSON.
+    - Con LLM_SMALL_MODEL i referti brevi dei tipi configurati vanno a un modello più piccolo
+      (ModelRouter); se la risposta non supera la validazione sullo schema si ripete la
+      richiesta con il modello grande.
+
+    I chiamanti sincroni (worker della coda) usano get_responses_for_document e
+    get_responses_for_fields, quelli asincroni aget_response_from_document.
+    """
+
+    # Errori per cui ritentare è inutile
+    NON_RETRYABLE = (error.AuthenticationError, error.InvalidRequestError)
+
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _loop_lock = threading.Lock()
+    _semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
     def __init__(self):
         load_dotenv()
         api_key = os.getenv("TOGETHER_API_KEY")
@@ -16,48 +103,579 @@ class LLMExtractor:
                 "TOGETHER_API_KEY non configurata. "
                 "Assicurati di impostare la variabile d'ambiente TOGETHER_API_KEY"
             )
-        self.async_client = Together(api_key=api_key)
+        # I retry sono gestiti qui (jitter, Retry-After, deadline), non dall'SDK
+        self.async_client = AsyncTogether(api_key=api_key, max_retries=0)
         self.prompt_manager = PromptManager()
 
-    def get_response_from_document(self, document_text, document_type, model):
-        prompt = self.prompt_manager.get_prompt_for(document_type) + "\n\n" + document_text
-        schema = self.prompt_manager.get_schema_for(document_type)
+        self.max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+        self.max_attempts = int(os.getenv("LLM_MAX_ATTEMPTS", "4"))
+        self.retry_base = float(os.getenv("LLM_RETRY_BASE", "1"))
+        self.retry_max = float(os.getenv("LLM_RETRY_MAX", "30"))
+        self.request_timeout = float(os.getenv("LLM_REQUEST_TIMEOUT", "180"))
+        self.deadline = float(os.getenv("LLM_DEADLINE", "600"))
+        self.chunk_tokens = int(os.getenv("LLM_CHUNK_TOKENS", "16000"))
+        self.extraction_mode = os.getenv("LLM_EXTRACTION_MODE", "single").lower()
+        self.stream = os.getenv("LLM_STREAM", "true").lower() == "true"
+        self.output_format = os.getenv("LLM_OUTPUT_FORMAT", "full").lower()
+        self.rate_limiter = RateLimiter()
+        self.response_cache = LLMResponseCache()
+        self.metrics = LLMMetrics()
+        self.text_compactor = TextCompactor()
+        self.page_selector = PageSelector(self.prompt_manager.SCHEMAS)
+        self.token_budget = TokenBudget()
+        self.router = ModelRouter()
+        self.validator = OutputValidator(self.prompt_manager)
+
+    # ------------------------------------------------------------------ #
+    # Event loop condiviso
+    # ------------------------------------------------------------------ #
+
+    @classmethod
+    def _get_loop(cls) -> asyncio.AbstractEventLoop:
+        with cls._loop_lock:
+            if cls._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+                cls._loop = loop
+            return cls._loop
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Semaforo del loop corrente (il limite è globale per il loop condiviso)."""
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    def run(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        """
+        Esegue una coroutine sul loop condiviso e ne attende il risultato.
+        Da non chiamare dall'interno del loop stesso (usare direttamente await).
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+    # ------------------------------------------------------------------ #
+    # Retry
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def _retry_after(exc: Exception) -> Optional[float]:
+        """Secondi indicati dal provider (retry-after-ms, retry-after in secondi o come data)."""
+        headers = getattr(exc, "headers", None)
+        if not isinstance(headers, dict):
+            return None
+        headers = {str(k).lower(): v for k, v in headers.items()}
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers["retry-after-ms"]) / 1000
+        except (TypeError, ValueError):
+            pass
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            parsed = email.utils.parsedate_tz(str(value))
+            if parsed is None:
+                return None
+            return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+    def _retry_delay(self, attempt: int, exc: Exception) -> float:
+        """Retry-After se presente, altrimenti backoff esponenziale con full jitter."""
+        retry_after = self._retry_after(exc)
+        if retry_after is not None:
+            return min(retry_after, self.retry_max)
+        return random.uniform(0, min(self.retry_max, self.retry_base * 2 ** (attempt - 1)))
+
+    async def _pace(self, estimated_tokens: int, label: str, deadline_at: float) -> None:
+        """Attende finché il rate limiter concede la richiesta (entro la deadline)."""
+        loop = asyncio.get_running_loop()
+        while True:
+            wait = await asyncio.to_thread(self.rate_limiter.try_acquire, estimated_tokens)
+            if wait <= 0:
+                return
+            if loop.time() + wait >= deadline_at:
+                raise RuntimeError(f"Budget RPM/TPM non disponibile entro la deadline per {label}")
+            logger.debug(f"Rate limiter: attesa di {wait:.1f}s per {label}")
+            await asyncio.sleep(wait)
 
-        response = None
-        last_error = None
-        
-        for attempt, sleep_time in enumerate([0, 1, 2, 4], start=1):
+    # ------------------------------------------------------------------ #
+    # Completions
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    async def _deliver(on_items: Optional[ItemsCallback], parser: Optional[IncrementalEntityParser], text: str) -> None:
+        """Passa al parser incrementale un pezzo di risposta e consegna le coppie completate."""
+        if on_items is None or parser is None:
+            return
+        items = parser.feed(text)
+        if items:
+            # Il callback può scrivere su DB: fuori dall'event loop
+            await asyncio.to_thread(on_items, items)
+
+    async def _create(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        on_items: Optional[ItemsCallback] = None,
+        **params: Any
+    ) -> LLMCompletion:
+        """Singola richiesta al provider; in streaming registra l'arrivo del primo token."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        parser = IncrementalEntityParser() if on_items is not None else None
+        if not self.stream:
+            response = await self.async_client.chat.completions.create(
+                model=model, messages=messages, **params
+            )
+            content = response.choices[0].message.content
+            await self._deliver(on_items, parser, content or "")
+            return LLMCompletion(
+                content=content,
+                usage=getattr(response, "usage", None),
+                latency=loop.time() - started,
+                finish_reason=getattr(response.choices[0], "finish_reason", None),
+            )
+
+        stream = await self.async_client.chat.completions.create(
+            model=model, messages=messages, stream=True, **params
+        )
+        parts: List[str] = []
+        usage = None
+        ttft: Optional[float] = None
+        finish_reason: Optional[str] = None
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            choices = getattr(chunk, "choices", None) or []
+            if choices and getattr(choices[0], "finish_reason", None):
+                finish_reason = choices[0].finish_reason
+            text = getattr(choices[0].delta, "content", None) if choices else None
+            if text:
+                if ttft is None:
+                    ttft = loop.time() - started
+                parts.append(text)
+                await self._deliver(on_items, parser, text)
+        return LLMCompletion(
+            content="".join(parts), usage=usage, ttft=ttft, latency=loop.time() - started,
+            finish_reason=finish_reason,
+        )
+
+    async def _create_limited(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        on_items: Optional[ItemsCallback] = None,
+        **params: Any
+    ) -> LLMCompletion:
+        """_create entro il limite globale di richieste contemporanee (LLM_MAX_CONCURRENCY)."""
+        async with self._get_semaphore():
+            return await self._create(model, messages, on_items=on_items, **params)
+
+    async def acomplete(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        label: str = "",
+        deadline: Optional[float] = None,
+        metrics_key: Optional[str] = None,
+        on_items: Optional[ItemsCallback] = None,
+        **params: Any
+    ) -> LLMCompletion:
+        """
+        Chat completion con limite di concorrenza, retry non bloccanti e deadline.
+        TTFT e latenza delle chiamate riuscite sono registrati sotto `metrics_key`;
+        `on_items` riceve le entità parziali (anche dei tentativi poi ritentati).
+        Una risposta troncata a max_tokens (finish_reason "length") è ritentata con
+        max_tokens raddoppiato, entro lo spazio libero nel contesto.
+
+        Returns:
+            LLMCompletion con testo, usage, tempi e token stimati
+
+        Raises:
+            ContextOverflowError: se input e max_tokens non stanno nel contesto del modello
+            OutputTruncatedError: se la risposta è troncata e max_tokens non può crescere
+        """
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + (deadline or self.deadline)
+        last_error: Optional[Exception] = None
+        attempt = 0
+        estimated_tokens = self.token_budget.count_messages(messages)
+        max_tokens = params.get("max_tokens") or 0
+        if not self.token_budget.fits(estimated_tokens, max_tokens):
+            raise ContextOverflowError(
+                f"Richiesta {label} oltre il contesto del modello: {estimated_tokens} token di input "
+                f"+ {max_tokens} di output > {self.token_budget.usable_context}"
+            )
+
+        while attempt < self.max_attempts:
+            attempt += 1
+            # Attesa del budget RPM/TPM: se non arriva entro la deadline la chiamata fallisce
+            await self._pace(estimated_tokens, label, deadline_at)
+            remaining = deadline_at - loop.time()
+            if remaining <= 0:
+                break
             try:
-                if sleep_time > 0:
-                    logger.warning(f"Retry {attempt}/4 dopo {sleep_time}s per {document_type}")
-                    time.sleep(sleep_time)
-                
-                response = self.async_client.chat.completions.create(
-                    model=model,
-                    messages=[{"role": "user", "content": prompt}],
-                    response_format={
-                        "type": "json_schema",
-                        "schema": schema
-                    },
-                    temperature=0.7,
-                    top_p=0.2,
-                    max_tokens=8192
+                # Un'unica scadenza per l'attesa del semaforo e la richiesta: il tempo in coda
+                # sotto carico conta per LLM_REQUEST_TIMEOUT e per la deadline
+                completion = await asyncio.wait_for(
+                    self._create_limited(model, messages, on_items=on_items, **params),
+                    timeout=min(self.request_timeout, remaining)
                 )
-                logger.info(f"Estrazione completata per {document_type} (tentativo {attempt})")
-                break
+                ttft = f", TTFT {completion.ttft:.2f}s" if completion.ttft is not None else ""
+                logger.info(
+                    f"Estrazione completata per {label} (tentativo {attempt}, "
+                    f"{completion.latency:.2f}s{ttft})"
+                )
+                usage = completion.usage
+                completion.estimated_prompt_tokens = estimated_tokens
+                completion.max_tokens = max_tokens or None
+                self.metrics.record(
+                    metrics_key or label, completion.ttft, completion.latency,
+                    prompt_tokens=getattr(usage, "prompt_tokens", None),
+                    cached_tokens=completion.cached_tokens,
+                    completion_tokens=getattr(usage, "completion_tokens", None),
+                    estimated_prompt_tokens=estimated_tokens,
+                    max_tokens=max_tokens or None,
+                    label=label,
+                )
+                if usage is not None and getattr(usage, "total_tokens", None) is not None:
+                    await asyncio.to_thread(
+                        self.rate_limiter.settle, estimated_tokens, usage.total_tokens
+                    )
+                if completion.finish_reason == "length":
+                    raise OutputTruncatedError(
+                        f"Risposta per {label} troncata a max_tokens={max_tokens or 'default'}"
+                    )
+                return completion
+            except self.NON_RETRYABLE:
+                raise
+            except OutputTruncatedError as e:
+                grown = self.token_budget.grow_output(estimated_tokens, max_tokens) if max_tokens else None
+                if grown is None:
+                    raise
+                last_error = e
+                logger.warning(f"{e}: nuovo tentativo con max_tokens={grown}")
+                params["max_tokens"] = max_tokens = grown
+                # Non è un errore del provider: si ritenta subito, senza backoff
+                continue
+            except asyncio.TimeoutError as e:
+                last_error = e
+                logger.error(f"Timeout tentativo {attempt}/{self.max_attempts} per {label}")
             except error.RateLimitError as e:
                 last_error = e
-                logger.error(f"Rate limit error tentativo {attempt}/4: {e}")
+                await asyncio.to_thread(self.rate_limiter.penalize)
+                logger.error(f"Rate limit error tentativo {attempt}/{self.max_attempts}: {e}")
             except Exception as e:
                 last_error = e
-                logger.error(f"Errore tentativo {attempt}/4 per {document_type}: {e}")
-                if attempt == 4:
-                    raise
-        
-        if response is None:
-            raise RuntimeError(
-                f"Impossibile ottenere risposta dall'LLM dopo 4 tentativi. "
-                f"Ultimo errore: {last_error}"
+                logger.error(f"Errore tentativo {attempt}/{self.max_attempts} per {label}: {e}")
+
+            if attempt >= self.max_attempts:
+                break
+            delay = self._retry_delay(attempt, last_error)
+            if loop.time() + delay >= deadline_at:
+                logger.error(f"Deadline raggiunta per {label}, nessun ulteriore tentativo")
+                break
+            logger.warning(f"Retry {attempt + 1}/{self.max_attempts} tra {delay:.1f}s per {label}")
+            await asyncio.sleep(delay)
+
+        raise RuntimeError(
+            f"Impossibile ottenere risposta dall'LLM dopo {attempt} tentativi. "
+            f"Ultimo errore: {last_error}"
+        )
+
+    def build_request(
+        self,
+        document_text: str,
+        document_type: str,
+        fields: Optional[List[str]] = None,
+        output_format: Optional[str] = None
+    ) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        Messaggi e parametri di una richiesta di estrazione: prefisso statico (prompt + schema)
+        nel messaggio di sistema, documento in coda.
+        """
+        output_format = output_format or self.output_format
+        messages = self.prompt_manager.build_messages(document_type, document_text, fields, output_format)
+        schema = self.prompt_manager.get_output_schema(document_type, fields, output_format)
+        # Nomi dello schema originale: nel formato compatto le proprietà hanno chiavi brevi
+        properties = self.prompt_manager.get_schema_for(document_type, fields).get("properties", {})
+        text_fields = sum(
+            1 for name, prop in properties.items()
+            if prop.get("type") == "string" and self.token_budget.is_free_text(name)
+        )
+        params = {
+            "response_format": {"type": "json_schema", "schema": schema},
+            "temperature": 0.7,
+            "top_p": 0.2,
+            "max_tokens": self.token_budget.output_budget(len(properties), text_fields),
+        }
+        return messages, params
+
+    def max_input_tokens(self, document_type: str, field_groups: Optional[List[List[str]]] = None) -> int:
+        """Token di documento ammessi per richiesta: il minimo tra i gruppi di campi (o lo schema intero)."""
+        limits = []
+        for fields in field_groups or [None]:
+            messages, params = self.build_request("", document_type, fields)
+            limits.append(self.token_budget.input_budget(
+                self.token_budget.count_messages(messages), params["max_tokens"]
+            ))
+        return min(limits)
+
+    def _expand_items(self, document_type: str, on_items: Optional[ItemsCallback]) -> Optional[ItemsCallback]:
+        """Nel formato compatto riconduce le chiavi brevi delle entità parziali ai nomi dello schema."""
+        if on_items is None or self.output_format != OUTPUT_COMPACT:
+            return on_items
+        entities = self.prompt_manager.get_spec_for(document_type)["entities"]
+        names = {short: name for name, short in compact_keys(entities).items()}
+        return lambda items: on_items([(names.get(key, key), value) for key, value in items])
+
+    async def aget_response_from_document(
+        self, document_text, document_type, model, deadline=None, use_cache=True, fields=None, on_items=None,
+        input_tokens=None
+    ):
+        """
+        `fields` limita prompt e schema a un gruppo di campi (estrazione a fan-out);
+        `on_items` riceve le coppie (entità, valore) man mano che arrivano.
+        `model` è il modello grande; `input_tokens` (default: il testo di questa richiesta)
+        è la dimensione del documento usata per scegliere la rotta.
+        """
+        on_items = self._expand_items(document_type, on_items)
+        if input_tokens is None:
+            input_tokens = self.token_budget.count(document_text)
+        route = self.router.select(document_type, input_tokens, model)
+        large = Route(ROUTE_LARGE, model)
+        prompt_version = self.prompt_manager.get_prompt_version(document_type, fields, self.output_format)
+        # Chiave per il modello che ha prodotto la risposta: cambiando la rotta le risposte
+        # del modello piccolo non vengono servite come risposte del modello grande
+        cache_keys = {
+            r.model: self.response_cache.make_key(r.model, prompt_version, document_text)
+            for r in (route, large)
+        }
+        if self.response_cache.enabled:
+            if use_cache:
+                # Sulla rotta piccola vale anche una risposta già ottenuta dal modello grande (escalation)
+                for cache_key in dict.fromkeys(cache_keys.values()):
+                    cached = await asyncio.to_thread(self.response_cache.get, cache_key)
+                    if cached is not None:
+                        logger.info(f"Risposta LLM da cache per {document_type}")
+                        await self._deliver(on_items, IncrementalEntityParser(), cached)
+                        return cached
+            else:
+                self.response_cache.record_bypass()
+
+        messages, params = self.build_request(document_text, document_type, fields)
+        label = document_type if fields is None else f"{document_type} ({len(fields)} campi)"
+
+        completion = None
+        if route.name == ROUTE_SMALL:
+            # Entità parziali trattenute finché la risposta del modello piccolo non è validata
+            buffered: List[Item] = []
+            try:
+                completion = await self.acomplete(
+                    model=route.model, messages=messages, label=f"{label} [{route.model}]",
+                    deadline=deadline, metrics_key=document_type,
+                    on_items=buffered.extend if on_items else None, **params
+                )
+                validation = self.validator.validate(completion.content, document_type, fields)
+                if not validation.valid:
+                    logger.warning(
+                        f"Risposta di {route.model} per {label} non valida, escalation a {model}: "
+                        f"{'; '.join(validation.reasons()[:5])}"
+                    )
+                    self.router.record(document_type, route, completion.latency, escalated=True)
+                    completion = None
+                else:
+                    self.router.record(document_type, route, completion.latency)
+                    if on_items and buffered:
+                        await asyncio.to_thread(on_items, buffered)
+            except ContextOverflowError:
+                raise
+            except Exception as e:
+                logger.warning(f"Errore di {route.model} per {label}, escalation a {model}: {e}")
+                self.router.record(document_type, route, 0.0, escalated=True)
+            if completion is None:
+                route = large
+
+        if completion is None:
+            completion = await self.acomplete(
+                model=route.model,
+                messages=messages,
+                label=label,
+                deadline=deadline,
+                metrics_key=document_type,
+                on_items=on_items,
+                **params
+            )
+            self.router.record(document_type, route, completion.latency)
+        content = completion.content
+        if self.response_cache.enabled and self._is_json(content):
+            await asyncio.to_thread(
+                self.response_cache.put, cache_keys[route.model], content,
+                model=route.model, document_type=document_type
+            )
+        return content
+
+    @staticmethod
+    def _is_json(content: Optional[str]) -> bool:
+        """Solo le risposte JSON complete vanno in cache (un errore non deve essere servito di nuovo)."""
+        try:
+            json.loads(content or "")
+            return True
+        except ValueError:
+            logger.warning("Risposta LLM non parsabile come JSON: non salvata in cache")
+            return False
+
+    def compact_pages(self, pages: List[str], label: str = "") -> List[str]:
+        """Compattazione del testo per pagina, con la riduzione di token stimata nei log."""
+        compacted = self.text_compactor.compact(pages)
+        before = sum(estimate_tokens(page) for page in pages)
+        after = sum(estimate_tokens(page) for page in compacted)
+        if before and after < before:
+            logger.info(
+                f"Compattazione testo {label}: {before} -> {after} token stimati "
+                f"(-{100 * (before - after) / before:.1f}%)"
+            )
+        return compacted
+
+    def chunk_document(
+        self, pages: List[str], document_type: str = "", field_groups: Optional[List[List[str]]] = None
+    ) -> List[str]:
+        """
+        Chunk deterministici del testo per pagina compattato (stesso input, stessi chunk).
+        Con `document_type` i documenti oltre il budget passano prima per la selezione delle
+        pagine rilevanti e ogni chunk è limitato allo spazio libero nel contesto del modello.
+        """
+        pages = self.compact_pages(pages, document_type)
+        if not document_type:
+            return split_into_chunks(pages, self.chunk_tokens)
+        pages = self.page_selector.select(pages, document_type)
+        limit = self.max_input_tokens(document_type, field_groups)
+        if limit <= 0:
+            raise ContextOverflowError(f"Il prefisso di {document_type} non lascia spazio al documento nel contesto")
+        chunks = split_into_chunks(pages, min(self.chunk_tokens, limit))
+        return self.fit_chunks(chunks, limit, document_type)
+
+    def fit_chunks(self, chunks: List[str], limit: int, label: str = "") -> List[str]:
+        """
+        Ridivide i chunk che, contati con il tokenizer, superano `limit`
+        (il chunker usa la stima a caratteri).
+        """
+        fitted: List[str] = []
+        for chunk in chunks:
+            tokens = self.token_budget.count(chunk)
+            if tokens <= limit:
+                fitted.append(chunk)
+                continue
+            target = max(1, int(estimate_tokens(chunk) * limit / tokens * 0.9))
+            logger.info(
+                f"Chunk {label} di {tokens} token oltre il contesto disponibile ({limit}): diviso"
+            )
+            fitted.extend(self.fit_chunks(split_into_chunks([chunk], target), limit, label))
+        return fitted
+
+    @staticmethod
+    def align_texts(chunks: List[str], responses: List[str]) -> List[str]:
+        """
+        Testi allineati a risposte già ottenute (es. all'upload): in modalità fanout
+        ogni chunk ha una risposta per gruppo di campi, consecutive.
+
+        Raises:
+            ValueError: se le risposte non corrispondono ai chunk (chunking cambiato
+                tra upload e processing): vanno richieste di nuovo
+        """
+        if not chunks or not responses or len(responses) % len(chunks):
+            raise ValueError(f"{len(responses)} risposte non allineabili a {len(chunks)} chunk")
+        per_chunk = len(responses) // len(chunks)
+        return [chunk for chunk in chunks for _ in range(per_chunk)]
+
+    async def aget_responses_for_chunks(
+        self, chunks, document_type, model, deadline=None, use_cache=True, field_groups=None, on_items=None
+    ) -> List[str]:
+        """
+        Estrae tutti i chunk in parallelo (limitati dal semaforo e dal rate limiter).
+        Con `field_groups` ogni chunk è estratto una volta per gruppo; l'ordine delle
+        risposte è chunk per chunk, gruppo per gruppo.
+        """
+        groups = field_groups or [None]
+        # La rotta dipende dalla dimensione dell'intero documento, non del singolo chunk
+        input_tokens = sum(self.token_budget.count(chunk) for chunk in chunks)
+        return list(await asyncio.gather(*(
+            self.aget_response_from_document(
+                chunk, document_type, model, deadline=deadline, use_cache=use_cache, fields=fields,
+                on_items=on_items, input_tokens=input_tokens
+            )
+            for chunk in chunks
+            for fields in groups
+        )))
+
+    def get_responses_for_fields(
+        self,
+        texts: List[str],
+        document_type: str,
+        model: str,
+        fields: List[str],
+        deadline: Optional[float] = None,
+        use_cache: bool = True
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Richiesta mirata a un sottoinsieme di campi (prompt e schema ridotti) sui chunk
+        già estratti, ad es. per i campi rimasti nulli o non validi.
+        Con use_cache=False la cache delle risposte viene ignorata, come per il documento.
+
+        Returns:
+            (testi, risposte LLM): liste allineate, una risposta per chunk
+        """
+        chunks = list(dict.fromkeys(texts))
+        responses = self.run(
+            self.aget_responses_for_chunks(
+                chunks, document_type, model, deadline=deadline, use_cache=use_cache, field_groups=[fields]
+            )
+        )
+        return chunks, responses
+
+    def get_responses_for_document(
+        self,
+        pages: List[str],
+        document_type: str,
+        model: str,
+        deadline: Optional[float] = None,
+        use_cache: bool = True,
+        mode: Optional[str] = None,
+        on_items: Optional[ItemsCallback] = None
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Estrazione map-reduce: divide il testo (per pagine) in chunk entro il budget di token
+        e li estrae in parallelo. Un documento che sta in un chunk richiede una sola chiamata
+        in modalità "single", una per gruppo di campi in modalità "fanout".
+        `on_items` riceve le entità parziali di tutte le richieste mentre sono in corso.
+
+        Returns:
+            (testi, risposte LLM): liste allineate, un testo per ogni risposta
+        """
+        mode = (mode or self.extraction_mode).lower()
+        field_groups = None
+        if mode == "fanout":
+            field_groups = self.prompt_manager.get_field_groups(document_type)
+            if len(field_groups) < 2:
+                field_groups = None
+
+        chunks = self.chunk_document(pages, document_type, field_groups)
+        if len(chunks) > 1:
+            logger.info(f"Documento {document_type} diviso in {len(chunks)} chunk per l'estrazione")
+
+        started = time.monotonic()
+        responses = self.run(
+            self.aget_responses_for_chunks(
+                chunks, document_type, model, deadline=deadline, use_cache=use_cache,
+                field_groups=field_groups, on_items=on_items
             )
-        
-        return response.choices[0].message.content
+        )
+        logger.info(
+            f"Estrazione {document_type} in modalità {'fanout' if field_groups else 'single'}: "
+            f"{len(responses)} chiamate in {time.monotonic() - started:.2f}s"
+        )
+        texts = [chunk for chunk in chunks for _ in (field_groups or [None])]
+        return texts, responses
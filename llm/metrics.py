@@ -0,0 +1,119 @@
+"""
+Metriche delle chiamate LLM per tipo di documento.
+
+Per ogni tipo si tengono le ultime LLM_METRICS_WINDOW chiamate riuscite: time-to-first-token
+(TTFT), latenza totale, token di input, token di input serviti dalla cache del provider
+(quando riportati nell'usage) e token generati. Servono a misurare l'effetto del prefisso
+di prompt stabile e del formato di output compatto.
+
+Per verificare il budget di token ogni chiamata registra anche i token di input stimati
+prima dell'invio e il max_tokens richiesto; le ultime chiamate sono consultabili una per
+una con get_calls.
+"""
+
+import os
+import time
+import threading
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, List, Optional
+
+
+def _percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class LLMMetrics:
+
+    def __init__(self, window: Optional[int] = None):
+        self.window = window or int(os.getenv("LLM_METRICS_WINDOW", "200"))
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[Dict[str, float]]] = defaultdict(lambda: deque(maxlen=self.window))
+        self._calls: Dict[str, int] = defaultdict(int)
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=self.window)
+
+    def record(
+        self,
+        document_type: str,
+        ttft: Optional[float],
+        latency: float,
+        prompt_tokens: Optional[int] = None,
+        cached_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        estimated_prompt_tokens: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        label: Optional[str] = None,
+    ) -> None:
+        sample = {
+            "ttft": ttft if ttft is not None else latency,
+            "latency": latency,
+            "prompt_tokens": prompt_tokens or 0,
+            "cached_tokens": cached_tokens or 0,
+            "completion_tokens": completion_tokens or 0,
+            "estimated_prompt_tokens": estimated_prompt_tokens or 0,
+            "max_tokens": max_tokens or 0,
+        }
+        call = {
+            "timestamp": round(time.time(), 3),
+            "document_type": document_type,
+            "label": label or document_type,
+            "estimated_prompt_tokens": estimated_prompt_tokens,
+            "prompt_tokens": prompt_tokens,
+            "max_tokens": max_tokens,
+            "completion_tokens": completion_tokens,
+            "latency": round(latency, 3),
+        }
+        with self._lock:
+            self._samples[document_type].append(sample)
+            self._calls[document_type] += 1
+            self._recent.append(call)
+
+    def get_calls(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Ultime chiamate (più recenti per prime): token stimati, richiesti e usati."""
+        with self._lock:
+            calls = list(self._recent)
+        calls.reverse()
+        return calls[:limit] if limit else calls
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Statistiche per tipo di documento sulla finestra di campioni recenti."""
+        with self._lock:
+            snapshot = {doc_type: list(samples) for doc_type, samples in self._samples.items()}
+            calls = dict(self._calls)
+
+        stats: Dict[str, Any] = {}
+        for doc_type, samples in snapshot.items():
+            ttfts = [s["ttft"] for s in samples]
+            latencies = [s["latency"] for s in samples]
+            prompt_tokens = sum(s["prompt_tokens"] for s in samples)
+            cached_tokens = sum(s["cached_tokens"] for s in samples)
+            completion_tokens = sum(s["completion_tokens"] for s in samples)
+            # Solo i campioni con usage e stima: rapporto tra token reali e stimati
+            estimated = [s for s in samples if s["estimated_prompt_tokens"] and s["prompt_tokens"]]
+            estimated_tokens = sum(s["estimated_prompt_tokens"] for s in estimated)
+            budgeted = [s for s in samples if s["max_tokens"] and s["completion_tokens"]]
+            stats[doc_type] = {
+                "calls": calls.get(doc_type, 0),
+                "window": len(samples),
+                "ttft_avg": round(sum(ttfts) / len(ttfts), 3),
+                "ttft_p95": round(_percentile(ttfts, 0.95), 3),
+                "latency_avg": round(sum(latencies) / len(latencies), 3),
+                "latency_p95": round(_percentile(latencies, 0.95), 3),
+                "prompt_tokens": prompt_tokens,
+                "cached_prompt_tokens": cached_tokens,
+                "prefix_cache_ratio": round(cached_tokens / prompt_tokens, 3) if prompt_tokens else 0.0,
+                "completion_tokens_avg": round(completion_tokens / len(samples), 1),
+                "prompt_estimate_ratio": (
+                    round(sum(s["prompt_tokens"] for s in estimated) / estimated_tokens, 3)
+                    if estimated_tokens else None
+                ),
+                "max_tokens_avg": round(sum(s["max_tokens"] for s in samples) / len(samples), 1),
+                "output_budget_used_max": (
+                    round(max(s["completion_tokens"] / s["max_tokens"] for s in budgeted), 3)
+                    if budgeted else None
+                ),
+            }
+        return stats
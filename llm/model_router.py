@@ -0,0 +1,82 @@
+"""
+Instradamento delle richieste di estrazione tra un modello piccolo e quello grande.
+
+I referti brevi (per tipo: LLM_SMALL_MODEL_TYPES, entro LLM_SMALL_MODEL_MAX_TOKENS token
+di documento) vanno al modello piccolo LLM_SMALL_MODEL, più veloce; tutto il resto al
+modello richiesto dal chiamante. La risposta del modello piccolo è validata sullo schema
+(OutputValidator): se non è valida la richiesta è ripetuta sul modello grande.
+
+Senza LLM_SMALL_MODEL tutte le richieste vanno al modello grande.
+Per ogni rotta (tipo di documento + modello) si contano chiamate, latenza ed escalation.
+"""
+
+import os
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict
+
+ROUTE_SMALL = "small"
+ROUTE_LARGE = "large"
+
+
+@dataclass(frozen=True)
+class Route:
+    name: str
+    model: str
+
+
+class ModelRouter:
+
+    def __init__(self):
+        self.small_model = os.getenv("LLM_SMALL_MODEL", "").strip()
+        self.small_types = {
+            t.strip() for t in os.getenv(
+                "LLM_SMALL_MODEL_TYPES", "coronarografia,eco_preoperatorio,eco_postoperatorio,tc_cuore"
+            ).split(",") if t.strip()
+        }
+        self.small_max_tokens = int(os.getenv("LLM_SMALL_MODEL_MAX_TOKENS", "6000"))
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.small_model)
+
+    def select(self, document_type: str, input_tokens: int, model: str) -> Route:
+        """Rotta per un documento di `input_tokens` token; `model` è il modello grande richiesto."""
+        if (
+            self.enabled
+            and document_type in self.small_types
+            and input_tokens <= self.small_max_tokens
+            and self.small_model != model
+        ):
+            return Route(ROUTE_SMALL, self.small_model)
+        return Route(ROUTE_LARGE, model)
+
+    # ------------------------------------------------------------------ #
+    # Contatori
+    # ------------------------------------------------------------------ #
+
+    def record(self, document_type: str, route: Route, latency: float, escalated: bool = False) -> None:
+        key = f"{document_type}:{route.name}"
+        with self._lock:
+            stats = self._stats[key]
+            stats["calls"] += 1
+            stats["latency_total"] += latency
+            stats["escalations"] += int(escalated)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Per rotta: chiamate, latenza media e quota di escalation al modello grande."""
+        with self._lock:
+            snapshot = {key: dict(stats) for key, stats in self._stats.items()}
+        result: Dict[str, Any] = {}
+        for key, stats in snapshot.items():
+            calls = int(stats["calls"])
+            result[key] = {
+                "calls": calls,
+                "latency_avg": round(stats["latency_total"] / calls, 3) if calls else 0.0,
+                "escalations": int(stats["escalations"]),
+                "escalation_rate": round(stats["escalations"] / calls, 3) if calls else 0.0,
+            }
+        return result
@@ -0,0 +1,120 @@
+"""
+Validazione delle risposte di estrazione rispetto allo schema del tipo di documento.
+
+La risposta (lista di {entità, valore} o oggetto piatto, anche a chiavi brevi) è
+ricondotta ai nomi dello schema; per ogni campo si verifica che il valore sia
+compatibile con tipo ed enum dello schema e che i campi obbligatori siano presenti.
+La validazione è tollerante sulla forma (numeri come stringa, "true"/"false"), perché
+EntityExtractor e la normalizzazione a valle li accettano.
+"""
+
+import re
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from utils.entity_extractor import compact_keys
+
+_NUMBER = re.compile(r"^\s*-?\d+(?:[.,]\d+)?\s*$")
+_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+
+@dataclass
+class ValidationResult:
+    """Esito della validazione: valori per nome di campo, obbligatori mancanti e campi non validi."""
+    values: Optional[Dict[str, Any]]
+    missing_required: List[str] = field(default_factory=list)
+    invalid: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def parsed(self) -> bool:
+        return self.values is not None
+
+    @property
+    def valid(self) -> bool:
+        return self.parsed and not self.missing_required and not self.invalid
+
+    def reasons(self) -> List[str]:
+        if not self.parsed:
+            return ["risposta non in JSON valido"]
+        reasons = [f"obbligatorio mancante: {name}" for name in self.missing_required]
+        reasons += [f"{name}: {reason}" for name, reason in self.invalid.items()]
+        return reasons
+
+
+class OutputValidator:
+
+    def __init__(self, prompt_manager):
+        self.prompt_manager = prompt_manager
+
+    def parse(self, content: str, document_type: str) -> Optional[Dict[str, Any]]:
+        """Coppie entità/valore della risposta con i nomi dello schema; None se non è JSON valido."""
+        try:
+            data = json.loads(_FENCE.sub("", content or ""))
+        except json.JSONDecodeError:
+            return None
+
+        if isinstance(data, list):
+            values: Dict[str, Any] = {}
+            for item in data:
+                if not isinstance(item, dict) or "entità" not in item:
+                    return None
+                values[item["entità"]] = item.get("valore")
+            return values
+
+        if isinstance(data, dict):
+            entities = self.prompt_manager.get_spec_for(document_type)["entities"]
+            names = {short: name for name, short in compact_keys(entities).items()}
+            return {names.get(key, key): value for key, value in data.items()}
+        return None
+
+    @staticmethod
+    def check_value(prop: dict, value: Any) -> Optional[str]:
+        """Motivo per cui `value` non è compatibile con la proprietà, o None se lo è."""
+        if value is None:
+            return None
+        if "enum" in prop:
+            if str(value).strip().lower() not in {str(v).lower() for v in prop["enum"]}:
+                return f"valore {value!r} non ammesso"
+            return None
+
+        expected = prop.get("type")
+        if expected in ("number", "integer"):
+            if isinstance(value, bool) or not (
+                isinstance(value, (int, float)) or (isinstance(value, str) and _NUMBER.match(value))
+            ):
+                return f"atteso un numero, ricevuto {value!r}"
+        elif expected == "boolean":
+            if not isinstance(value, bool) and str(value).strip().lower() not in ("true", "false"):
+                return f"atteso un booleano, ricevuto {value!r}"
+        elif expected == "string":
+            if isinstance(value, (list, dict)):
+                return "atteso un testo, ricevuta una struttura"
+            if prop.get("format") == "date" and not re.search(r"\d", str(value)):
+                return f"data non valida {value!r}"
+        return None
+
+    def validate(
+        self, content: str, document_type: str, fields: Optional[List[str]] = None
+    ) -> ValidationResult:
+        values = self.parse(content, document_type)
+        if values is None:
+            return ValidationResult(values=None)
+        return self.validate_values(values, document_type, fields)
+
+    def validate_values(
+        self, values: Dict[str, Any], document_type: str, fields: Optional[List[str]] = None
+    ) -> ValidationResult:
+        """Valida valori già ricondotti ai nomi dello schema (es. il risultato unito di più chunk)."""
+        schema = self.prompt_manager.get_schema_for(document_type, fields)
+        properties = schema.get("properties", {})
+        result = ValidationResult(values=values)
+        result.missing_required = [
+            name for name in schema.get("required", [])
+            if values.get(name) in (None, "", [])
+        ]
+        for name, prop in properties.items():
+            reason = self.check_value(prop, values.get(name))
+            if reason:
+                result.invalid[name] = reason
+        return result
@@ -0,0 +1,251 @@
+"""
+Compilatore dei prompt di estrazione.
+
+Genera il prompt di ogni tipo di documento a partire dallo schema JSON invece che dai
+prompt scritti a mano (PromptManager.PROMPTS), che ripetono per quasi tutti i tipi lo
+stesso lungo esempio della lettera di dimissione:
+
+- ruolo: la prima riga del prompt scritto a mano;
+- tabella delle entità senza padding: tipo dallo schema (valori ammessi inclusi) e
+  descrizione ripresa dal prompt scritto a mano, se presente;
+- regole comuni in forma breve, più quelle specifiche del tipo;
+- un esempio di input/output pertinente al tipo, con i nomi di entità dello schema.
+
+Se il prompt generato non è più corto di quello scritto a mano si usa quest'ultimo.
+
+Il risultato mantiene il formato a tabella "| Entità | Tipo | Descrizione |", così la
+riduzione per gruppi di campi (PromptManager.get_prompt_for con `fields`) resta valida.
+"""
+
+import re
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from .rate_limiter import estimate_tokens
+
+COMMON_RULES = [
+    "Estrai solo le entità della tabella; se un'entità non è nel documento non inventarla e omettila.",
+    "Le entità possono comparire come acronimi o abbreviazioni: riconducile al nome in tabella.",
+    "Usa le date del documento (ingresso, intervento, dimissione, esami) per distinguere i dati pre-operatori da quelli post-operatori.",
+    "Numeri senza unità di misura; date nel formato del documento; Boolean = true/false.",
+    "Tabelle, elenchi e parametri non previsti dalla tabella vanno in **parametri** come \"chiave: valore\" separati da \"; \" (se l'entità esiste).",
+    "Output: solo una lista JSON di oggetti {\"entità\": <nome>, \"valore\": <valore>}, senza altro testo.",
+]
+
+TYPE_RULES: Dict[str, List[str]] = {
+    "lettera_dimissione": [
+        "Valori con data < data dell'intervento → campi pre_; con data ≥ data dell'intervento → campi post_.",
+        "Applica le regole derivate da esami e terapia indicate in descrizione (es. diabete, dislipidemia, insufficienza_renale_cronica, ipertensione, LCOS) solo se nel testo ci sono dati coerenti.",
+        "Se più entità sono riportate insieme in un campo che le raggruppa, valorizza anche le singole entità.",
+    ],
+    "eco_preoperatorio": [
+        "In **parametri** anteponi il nome della sezione (Ventricolo_sinistro, Valvola_aortica, ...) alla variabile: \"Sezione_variabile: valore\".",
+        "Se un valore è anche un'entità della tabella, valorizza anche l'entità.",
+    ],
+    "eco_postoperatorio": [
+        "In **parametri** anteponi il nome della sezione (Ventricolo_sinistro, Valvola_aortica, ...) alla variabile: \"Sezione_variabile: valore\".",
+        "Se un valore è anche un'entità della tabella, valorizza anche l'entità.",
+    ],
+    "anamnesi": [
+        "Considera solo le informazioni riferite alla fase preoperatoria.",
+    ],
+    "epicrisi_ti": [
+        "Considera il periodo post-operatorio immediato in Terapia Intensiva.",
+    ],
+}
+
+# Esempi brevi per tipo: (testo di input, coppie entità/valore attese)
+EXAMPLES: Dict[str, Tuple[str, List[Tuple[str, Any]]]] = {
+    "lettera_dimissione": (
+        "Si dimette in data 02/09/2019 il Sig. BERTOLOTTI FRANCO\n"
+        "Nato il 27/03/1939 telefono 3479927663\n"
+        "ricoverato presso questo ospedale dal 27/08/2019\n"
+        "Numero Cartella 2019034139\n"
+        "Cenni Anamnestici: Ex fumatore. Diabete mellito in tp ipoglicemizzante orale.",
+        [
+            ("data_dimissione_cch", "02/09/2019"), ("cognome", "BERTOLOTTI"), ("nome", "FRANCO"),
+            ("data_di_nascita", "27/03/1939"), ("numero_di_telefono", "3479927663"),
+            ("data_ingresso_cch", "27/08/2019"), ("n_cartella", 2019034139),
+            ("fumo", 1), ("diabete", True),
+        ],
+    ),
+    "coronarografia": (
+        "Coronarografia del 12/03/2021. Paziente ROSSI MARIO, cartella 2021001234.\n"
+        "Tronco comune indenne. IVA: stenosi 70% al tratto prossimale. CX: irregolarità parietali.\n"
+        "CDx: stenosi critica 90% al tratto medio.",
+        [
+            ("data_esame", "12/03/2021"), ("cognome", "ROSSI"), ("nome", "MARIO"),
+            ("n_cartella", 2021001234), ("coro_tc_stenosi50", False), ("coro_iva_stenosi50", True),
+            ("coro_cx_stenosi50", False), ("coro_dx_stenosi50", True),
+        ],
+    ),
+    "tc_cuore": (
+        "TC cuore del 05/05/2022. Annulus aortico 23 x 27 mm, perimetro 78 mm.\n"
+        "Aorta ascendente 41 mm. IVA: stenosi 60% prossimale; CDx senza stenosi significative.",
+        [
+            ("data_esame", "05/05/2022"), ("dimaorta_anulus", 23), ("dimaorta_perimetro", 78),
+            ("dimaorta_asc", 41), ("tc_iva_stenosi50", True), ("tc_dx_stenosi50", False),
+        ],
+    ),
+    "eco_preoperatorio": (
+        "Ecocardiogramma del 10/01/2023. Altezza 172 cm, peso 80 kg.\n"
+        "VS: DTD 58 mm, FE 40%. VD: TAPSE 17 mm, PAPs 45 mmHg.\n"
+        "Valvola aortica: stenosi severa, Vmax 4.5 m/s, gradiente medio 48 mmHg, AVA 0.7 cm2.",
+        [
+            ("data_esame", "10/01/2023"), ("altezza", 172), ("peso", 80),
+            ("Ventricolo_sinistro_diametro_telediastolico", 58), ("Ventricolo_sinistro_FE", 40),
+            ("Ventricolo_destro_TAPSE", 17), ("Ventricolo_destro_PAPs", 45),
+            ("Valvola_aortica_stenosi", True), ("Valvola_aortica_velocita_massima", 4.5),
+            ("Valvola_aortica_gradiente_medio", 48), ("Valvola_aortica_AVA", 0.7),
+        ],
+    ),
+    "eco_postoperatorio": (
+        "Eco di controllo del 20/01/2023. FE 50%. Protesi aortica normofunzionante,\n"
+        "gradiente medio 12 mmHg, non leak paravalvolari. Insufficienza mitralica lieve.",
+        [
+            ("data_esame", "20/01/2023"), ("VSX_FE", "50"), ("Valvola_aortica_gradiente_med", "12"),
+            ("Valvola_aortica_PVL", "no"), ("Valvola_mitrale_insufficienza", "lieve"),
+        ],
+    ),
+    "intervento": (
+        "Intervento del 15/01/2023, cartella 2023000456. Primo operatore: Dott. VERDI LUCA.\n"
+        "Sternotomia mediana, CEC con cannulazione aortica. Entrata in sala 08:05, inizio CEC 09:10,\n"
+        "fine CEC 10:40. Sostituzione valvolare aortica con protesi biologica.",
+        [
+            ("data_intervento", "15/01/2023"), ("n_cartella", 2023000456),
+            ("primo operatore cognome", "VERDI"), ("primo operatore nome", "LUCA"),
+            ("approcciochirurgico", "sternotomia mediana"), ("cec", True),
+            ("cannulazionearteriosa", "aortica"), ("entratainsala", "08:05"),
+            ("iniziocec", "09:10"), ("finecec", "10:40"), ("intervento 1", "sostituzione valvolare aortica"),
+            ("protesi 1", "biologica"),
+        ],
+    ),
+    "anamnesi": (
+        "Anamnesi: iperteso, dislipidemico, ex fumatore. Nega allergie.\n"
+        "Terapia domiciliare: cardioaspirina 100 mg, bisoprololo 2.5 mg, atorvastatina 40 mg.",
+        [
+            ("ipertensione", True), ("dislipidemia", True), ("fumo", 1), ("Allergie", "nega allergie"),
+            ("Terapia", "cardioaspirina 100 mg, bisoprololo 2.5 mg, atorvastatina 40 mg"),
+            ("antiaggregante", True), ("betabloc", True), ("statine", True),
+        ],
+    ),
+    "epicrisi_ti": (
+        "Giunge in TI il 15/01/2023 dopo SVAo. Estubato in I giornata, supporto con dobutamina\n"
+        "sospeso in II giornata. Non IABP. Dimesso dalla TI in buone condizioni.",
+        [
+            ("data_intervento", "15/01/2023"), ("Inotropi", True), ("IABP_ECMO_IMPELLA", False),
+            ("Decorso_post_operatorio", "estubato in I giornata, dobutamina sospesa in II giornata"),
+        ],
+    ),
+    "cartellino_anestesiologico": (
+        "Data intervento 15/01/2023. Ingresso in sala 07:50, inizio tempo chirurgico 08:30.\n"
+        "Inizio CEC 09:10, clampaggio Ao 09:20, declampaggio 10:25, fine CEC 10:40.\n"
+        "Cardioplegia ematica fredda anterograda.",
+        [
+            ("data_intervento", "15/01/2023"), ("INGRESSO_IN_SALA", "07:50"),
+            ("INIZIO_TEMPO_CHIRURGICO", "08:30"), ("TEMPI_CCH_Inizio_CEC", "09:10"),
+            ("TEMPI_CCH_Clamp_Ao", "09:20"), ("TEMPI_CCH_Declamp_Ao", "10:25"),
+            ("TEMPI_CCH_fine_CEC", "10:40"), ("cec", True), ("Cardioplegia", "ematica fredda anterograda"),
+        ],
+    ),
+}
+
+_TABLE_ROW = re.compile(r"^\s*\|\s*([^|]+?)\s*\|\s*([^|]*?)\s*\|\s*(.*?)\s*\|?\s*$")
+_LIST_ROW = re.compile(r"^\s*-\s*([A-Za-z_][\w ]*?)\s*\(([^)]*)\)\s*#\s*(.+?)\s*$")
+
+
+class PromptCompiler:
+    """Genera i prompt compatti dagli schemi; le descrizioni vengono dai prompt scritti a mano."""
+
+    def __init__(self, schemas: Dict[str, dict], prompts: Dict[str, str]):
+        self.schemas = schemas
+        self.prompts = prompts
+
+    # ------------------------------------------------------------------ #
+    # Sorgenti
+    # ------------------------------------------------------------------ #
+
+    def field_descriptions(self, document_type: str) -> Dict[str, str]:
+        """Descrizioni dei campi dalla tabella (o dall'elenco commentato) del prompt scritto a mano."""
+        descriptions: Dict[str, str] = {}
+        for line in self.prompts.get(document_type, "").splitlines():
+            match = _TABLE_ROW.match(line) or _LIST_ROW.match(line)
+            if not match:
+                continue
+            name, description = match.group(1).strip(), " ".join(match.group(3).split())
+            if name and description and not set(description) <= set("-: "):
+                descriptions.setdefault(name, description)
+        return descriptions
+
+    def role(self, document_type: str) -> str:
+        for line in self.prompts.get(document_type, "").splitlines():
+            if line.strip():
+                return line.strip()
+        return "Sei un medico. Estrai le seguenti entità dal documento clinico."
+
+    @staticmethod
+    def field_type(prop: dict) -> str:
+        if "enum" in prop:
+            return "Enum " + "/".join(str(v) for v in prop["enum"])
+        if prop.get("format") == "date":
+            return "Date"
+        return {"number": "Number", "boolean": "Boolean", "integer": "Number"}.get(prop.get("type"), "Text")
+
+    # ------------------------------------------------------------------ #
+    # Compilazione
+    # ------------------------------------------------------------------ #
+
+    def compile(self, document_type: str) -> str:
+        """
+        Prompt compilato per il tipo, o quello scritto a mano se il compilato non è più corto
+        (es. anamnesi ed epicrisi_ti, i cui prompt a mano non hanno tabella né esempio).
+        """
+        compiled = self.generate(document_type)
+        handwritten = self.prompts.get(document_type)
+        if handwritten and estimate_tokens(compiled) >= estimate_tokens(handwritten):
+            return handwritten
+        return compiled
+
+    def generate(self, document_type: str) -> str:
+        """Prompt generato dallo schema, senza confronto con quello scritto a mano."""
+        if document_type not in self.schemas:
+            raise ValueError(f"Schema non definito per {document_type}")
+        properties = self.schemas[document_type].get("properties", {})
+        descriptions = self.field_descriptions(document_type)
+
+        lines = [self.role(document_type), "", "### Entità", "| Entità | Tipo | Descrizione |", "|---|---|---|"]
+        for name, prop in properties.items():
+            # Senza descrizione il nome del campo basta: nessun token in più
+            description = descriptions.get(name, "")
+            lines.append(f"| {name} | {self.field_type(prop)} | {description} |")
+
+        lines += ["", "### Regole"]
+        lines += [f"- {rule}" for rule in COMMON_RULES + TYPE_RULES.get(document_type, [])]
+
+        example = EXAMPLES.get(document_type)
+        if example:
+            text, pairs = example
+            output = [{"entità": name, "valore": value} for name, value in pairs if name in properties]
+            lines += [
+                "", "### Esempio (solo per il formato)", "Input:", "```", text, "```", "Output:",
+                json.dumps(output, ensure_ascii=False),
+            ]
+        return "\n".join(lines) + "\n"
+
+    def compile_all(self) -> Dict[str, str]:
+        return {document_type: self.compile(document_type) for document_type in self.schemas}
+
+    def token_report(self, compiled: Optional[Dict[str, str]] = None) -> List[Dict[str, Any]]:
+        """Token stimati per tipo: prompt scritto a mano vs compilato."""
+        compiled = compiled or self.compile_all()
+        report = []
+        for document_type, prompt in compiled.items():
+            handwritten = estimate_tokens(self.prompts.get(document_type, ""))
+            tokens = estimate_tokens(prompt)
+            report.append({
+                "document_type": document_type,
+                "handwritten_tokens": handwritten,
+                "compiled_tokens": tokens,
+                "reduction": round(1 - tokens / handwritten, 3) if handwritten else 0.0,
+            })
+        return report
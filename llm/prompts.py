@@ -1,6 +1,28 @@
 # llm/prompts.py
 
-from typing import Dict, List
+import os
+import json
+import hashlib
+import fnmatch
+from typing import Dict, List, Optional
+
+from utils.entity_extractor import compact_keys
+from .prompt_compiler import PromptCompiler
+
+# Sorgenti dei prompt: scritti a mano (PROMPTS) o generati dagli schemi (PromptCompiler)
+PROMPT_HANDWRITTEN = "handwritten"
+PROMPT_COMPILED = "compiled"
+
+# Formati di output: lista/oggetto con i nomi dello schema, oppure oggetto piatto a chiavi brevi
+OUTPUT_FULL = "full"
+OUTPUT_COMPACT = "compact"
+
+COMPACT_INSTRUCTIONS = (
+    "FORMATO DI OUTPUT COMPATTO (prevale su quanto indicato sopra): restituisci un unico "
+    "oggetto JSON piatto che usa come chiavi le chiavi brevi dello schema seguente; il "
+    "\"title\" di ogni chiave è il nome dell'entità corrispondente. Ometti le entità non "
+    "presenti nel documento."
+)
 
 
 class PromptManager:
@@ -1533,21 +1555,118 @@ Questo esempio serve per capire solamente il formato di input/output
 
     }
 
-    def get_schema_for(self, document_type: str) -> dict:
+    # Gruppi di campi per l'estrazione a fan-out (richieste parallele, una per gruppo).
+    # I campi legati da regole derivate (es. diabete <-> insulina/metformina) stanno nello
+    # stesso gruppo; sono ammessi pattern fnmatch. I campi non elencati finiscono nel primo gruppo.
+    FIELD_GROUPS: Dict[str, Dict[str, List[str]]] = {
+        "lettera_dimissione": {
+            "anagrafica_e_ricovero": [
+                "n_cartella", "data_ingresso_cch", "data_dimissione_cch", "nome", "cognome",
+                "sesso", "numero_di_telefono", "eta_al_momento_dell_intervento", "data_di_nascita",
+                "Diagnosi", "Anamnesi", "Motivo_ricovero", "elettivo_urgenza_emergenza",
+            ],
+            "fattori_di_rischio_e_terapia": [
+                "classe_nyha", "angor", "STEMI_NSTEMI", "scompenso_cardiaco_nei_3_mesi_precedenti",
+                "fumo", "diabete", "ipertensione", "dislipidemia", "BPCO", "stroke_pregresso",
+                "TIA_pregresso", "vasculopatiaperif", "neoplasia_pregressa", "irradiazionetoracica",
+                "insufficienza_renale_cronica", "familiarita_cardiovascolare", "limitazione_mobilita",
+                "endocardite", "ritmo_all_ingresso", "fibrillazione_atriale", "dialisi", "pm", "crt",
+                "icd", "pci_pregressa", "REDO", "Anno_REDO", "Tipo_di_REDO",
+                "intervento_cardiochirurgico_pregresso", "intervento_transcatetere_pregresso",
+                "intervento_pregresso_descrizione", "edemi_declivi", "ascite",
+                "Terapia", "lasix", "lasix_dosaggio", "nitrati", "antiaggregante", "dapt",
+                "anticoagorali", "aceinib", "betabloc", "sartanici", "caantag", "altri_diuretici",
+                "statine", "insulina", "metformina", "anti_SGLT2", "ARNI",
+            ],
+            "decorso_e_dimissione": [
+                "Decorso_post_operatorio", "IABP_ECMO_IMPELLA", "Inotropi", "secondo_intervento",
+                "Tipo_secondo_intervento", "II_Run", "Causa_II_Run_CEC", "LCOS",
+                "Impianto_PM_post_intervento", "Stroke_TIA_post_op", "Necessita_di_trasfusioni",
+                "IRA", "Insufficienza_respiratoria", "FA_di_nuova_insorgenza", "Ritmo_alla_dimissione",
+                "H_Stay_giorni_da_intervento_a_dimissione", "Morte", "Causa_morte", "data_morte",
+                "esami_alla_dimissione", "terapia_alla_dimissione",
+            ],
+            "esami_laboratorio": ["esami_all_ingresso", "pre_*", "post_*"],
+        },
+    }
+
+    def __init__(self, prompt_source: Optional[str] = None):
+        # LLM_PROMPT_SOURCE=compiled usa i prompt generati dagli schemi (meno token di input)
+        self.prompt_source = (prompt_source or os.getenv("LLM_PROMPT_SOURCE", PROMPT_HANDWRITTEN)).lower()
+        self.compiler = PromptCompiler(self.SCHEMAS, self.PROMPTS)
+        self._compiled: Dict[str, str] = {}
+        # Prefissi di sistema già composti, per tipo di documento e gruppo di campi
+        self._system_prompts: Dict[tuple, str] = {}
+
+    def get_schema_for(self, document_type: str, fields: Optional[List[str]] = None) -> dict:
         """
-        Restituisce lo schema JSON per il tipo di documento.
+        Restituisce lo schema JSON per il tipo di documento,
+        eventualmente ristretto ai soli `fields`.
         """
         if document_type not in self.SCHEMAS:
             raise ValueError(f"Schema non definito per {document_type}")
-        return self.SCHEMAS[document_type]
-
-    def get_prompt_for(self, document_type: str) -> str:
+        schema = self.SCHEMAS[document_type]
+        if fields is None:
+            return schema
+
+        subset = dict(schema)
+        subset["properties"] = {
+            key: value for key, value in schema.get("properties", {}).items() if key in fields
+        }
+        if "required" in schema:
+            subset["required"] = [key for key in schema["required"] if key in fields]
+        return subset
+
+    def get_prompt_for(self, document_type: str, fields: Optional[List[str]] = None) -> str:
         """
         Restituisce il prompt testuale per il tipo di documento.
+        Con `fields` la tabella delle entità mantiene solo le righe di quei campi
+        (intestazione, istruzioni ed esempi restano invariati).
         """
         if document_type not in self.PROMPTS:
             raise ValueError(f"Prompt non definito per {document_type}")
-        return self.PROMPTS[document_type]
+        if self.prompt_source == PROMPT_COMPILED:
+            if document_type not in self._compiled:
+                self._compiled[document_type] = self.compiler.compile(document_type)
+            prompt = self._compiled[document_type]
+        else:
+            prompt = self.PROMPTS[document_type]
+        if fields is None:
+            return prompt
+
+        wanted = set(fields)
+        lines = []
+        for line in prompt.splitlines():
+            cells = [c.strip() for c in line.strip().strip("|").split("|")] if line.lstrip().startswith("|") else []
+            is_entity_row = (
+                len(cells) >= 2
+                and cells[0] not in ("Entità", "")
+                and not set(cells[0]) <= set("-: ")
+            )
+            if is_entity_row and cells[0] not in wanted:
+                continue
+            lines.append(line)
+        return "\n".join(lines)
+
+    def get_field_groups(self, document_type: str) -> List[List[str]]:
+        """
+        Partizione dei campi dello schema per l'estrazione a fan-out.
+        Un solo gruppo (tutti i campi) se per il tipo non sono definiti gruppi.
+        """
+        entities = self.get_spec_for(document_type)["entities"]
+        groups_spec = self.FIELD_GROUPS.get(document_type)
+        if not groups_spec:
+            return [entities]
+
+        groups: List[List[str]] = [[] for _ in groups_spec]
+        for entity in entities:
+            for index, patterns in enumerate(groups_spec.values()):
+                if any(fnmatch.fnmatchcase(entity, pattern) for pattern in patterns):
+                    groups[index].append(entity)
+                    break
+            else:
+                groups[0].append(entity)
+        return [group for group in groups if group]
 
     def get_spec_for(self, document_type: str) -> Dict[str, List[str]]:
         """
@@ -1557,3 +1676,71 @@ Questo esempio serve per capire solamente il formato di input/output
         schema = self.get_schema_for(document_type)
         entities = list(schema.get("properties", {}).keys())
         return { "entities": entities }
+
+    def get_output_schema(
+        self, document_type: str, fields: Optional[List[str]] = None, output_format: str = OUTPUT_FULL
+    ) -> dict:
+        """
+        Schema richiesto al modello. Nel formato compatto le proprietà usano le chiavi brevi
+        (EntityExtractor le riconduce ai nomi dello schema) e nessun campo è obbligatorio,
+        così le entità assenti non generano token.
+        """
+        schema = self.get_schema_for(document_type, fields)
+        if output_format != OUTPUT_COMPACT:
+            return schema
+
+        short_keys = compact_keys(self.get_spec_for(document_type)["entities"])
+        compact = {key: value for key, value in schema.items() if key not in ("properties", "required")}
+        compact["properties"] = {
+            short_keys[name]: {**prop, "title": name}
+            for name, prop in schema.get("properties", {}).items()
+        }
+        return compact
+
+    def get_system_prompt(
+        self, document_type: str, fields: Optional[List[str]] = None, output_format: str = OUTPUT_FULL
+    ) -> str:
+        """
+        Prefisso statico della richiesta: prompt del tipo di documento + schema JSON.
+        È identico byte per byte tra documenti dello stesso tipo (schema serializzato
+        con chiavi ordinate), così il provider può riusarne la KV cache.
+        """
+        cache_key = (document_type, tuple(fields) if fields is not None else None, output_format)
+        system_prompt = self._system_prompts.get(cache_key)
+        if system_prompt is None:
+            schema = json.dumps(
+                self.get_output_schema(document_type, fields, output_format),
+                sort_keys=True, ensure_ascii=False, separators=(",", ":")
+            )
+            instructions = "\n\n" + COMPACT_INSTRUCTIONS if output_format == OUTPUT_COMPACT else ""
+            system_prompt = (
+                self.get_prompt_for(document_type, fields).rstrip()
+                + instructions
+                + "\n\nSchema JSON dell'output:\n" + schema
+                + "\n\nIl testo del documento da analizzare è nel messaggio dell'utente."
+            )
+            self._system_prompts[cache_key] = system_prompt
+        return system_prompt
+
+    def build_messages(
+        self,
+        document_type: str,
+        document_text: str,
+        fields: Optional[List[str]] = None,
+        output_format: str = OUTPUT_FULL
+    ) -> List[Dict[str, str]]:
+        """Messaggi della richiesta: prefisso statico (system) e documento (user) in coda."""
+        return [
+            {"role": "system", "content": self.get_system_prompt(document_type, fields, output_format)},
+            {"role": "user", "content": document_text},
+        ]
+
+    def get_prompt_version(
+        self, document_type: str, fields: Optional[List[str]] = None, output_format: str = OUTPUT_FULL
+    ) -> str:
+        """
+        Impronta del prefisso (prompt + schema + formato di output) per il tipo di documento
+        o per un gruppo di campi: cambia ad ogni modifica e invalida le risposte LLM in cache.
+        """
+        payload = self.get_system_prompt(document_type, fields, output_format)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
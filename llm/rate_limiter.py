@@ -0,0 +1,143 @@
+"""
+Rate limiter lato client per il provider LLM.
+
+Due token bucket (richieste/minuto e token/minuto) con stato in un piccolo file JSON
+protetto da flock: il budget è condiviso da tutti i chiamanti di LLMExtractor, anche
+tra worker gunicorn diversi sullo stesso host.
+"""
+
+import os
+import json
+import math
+import time
+import logging
+import tempfile
+import threading
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non POSIX: limite solo per processo
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Stima prudente per testo italiano/JSON con tokenizer BPE
+CHARS_PER_TOKEN = 3.5
+
+
+def estimate_tokens(text: str) -> int:
+    """Stima veloce dei token di un testo, senza tokenizer."""
+    return int(math.ceil(len(text or "") / CHARS_PER_TOKEN))
+
+
+class RateLimiter:
+    """
+    Token bucket su RPM (LLM_RPM) e TPM (LLM_TPM); 0 disabilita il relativo limite.
+    I bucket si riempiono in modo continuo: capacità = budget al minuto.
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        state_path: Optional[str] = None,
+    ):
+        self.rpm = rpm if rpm is not None else float(os.getenv("LLM_RPM", "60"))
+        self.tpm = tpm if tpm is not None else float(os.getenv("LLM_TPM", "200000"))
+        self.state_path = state_path or os.getenv(
+            "LLM_RATE_LIMIT_FILE",
+            os.path.join(tempfile.gettempdir(), "hsr_llm_rate_limit.json"),
+        )
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0
+
+    # ------------------------------------------------------------------ #
+    # Stato condiviso
+    # ------------------------------------------------------------------ #
+
+    def _update(self, mutate) -> float:
+        """Legge lo stato sotto lock (thread + file), lo ricarica nel tempo e applica `mutate`."""
+        with self._lock:
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+            with open(self.state_path, "a+", encoding="utf-8") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or "{}")
+                    except ValueError:
+                        state = {}
+                    now = time.time()
+                    self._refill(state, now)
+                    result = mutate(state)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    def _refill(self, state: Dict[str, float], now: float) -> None:
+        elapsed = max(0.0, now - state.get("updated", now))
+        state["requests"] = min(self.rpm, state.get("requests", self.rpm) + elapsed * self.rpm / 60)
+        state["tokens"] = min(self.tpm, state.get("tokens", self.tpm) + elapsed * self.tpm / 60)
+        state["updated"] = now
+
+    # ------------------------------------------------------------------ #
+    # API
+    # ------------------------------------------------------------------ #
+
+    def try_acquire(self, tokens: int) -> float:
+        """
+        Preleva una richiesta e `tokens` token se disponibili.
+
+        Returns:
+            0 se il prelievo è riuscito, altrimenti i secondi da attendere prima di riprovare
+        """
+        if not self.enabled:
+            return 0.0
+        # Una richiesta più grande dell'intero budget passa a bucket pieno
+        tokens = min(tokens, self.tpm) if self.tpm > 0 else 0
+
+        def mutate(state: Dict[str, float]) -> float:
+            wait = 0.0
+            if self.rpm > 0 and state["requests"] < 1:
+                wait = max(wait, (1 - state["requests"]) * 60 / self.rpm)
+            if self.tpm > 0 and state["tokens"] < tokens:
+                wait = max(wait, (tokens - state["tokens"]) * 60 / self.tpm)
+            if wait == 0.0:
+                if self.rpm > 0:
+                    state["requests"] -= 1
+                if self.tpm > 0:
+                    state["tokens"] -= tokens
+            return wait
+
+        return self._update(mutate)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Corregge il bucket TPM con i token effettivi riportati dal provider."""
+        if self.tpm <= 0 or actual_tokens is None:
+            return
+        delta = actual_tokens - estimated_tokens
+
+        def mutate(state: Dict[str, float]) -> None:
+            state["tokens"] = min(self.tpm, state["tokens"] - delta)
+
+        self._update(mutate)
+
+    def penalize(self) -> None:
+        """Dopo un 429 svuota il bucket delle richieste: tutti i chiamanti rallentano."""
+        if self.rpm <= 0:
+            return
+
+        def mutate(state: Dict[str, float]) -> None:
+            state["requests"] = min(state["requests"], 0.0)
+
+        self._update(mutate)
@@ -0,0 +1,163 @@
+"""
+Cache persistente delle risposte LLM.
+
+Chiave: modello + versione di prompt/schema del tipo documento + hash del testo.
+Ogni voce è un file JSON in LLM_CACHE_FOLDER; il mtime è aggiornato ad ogni hit,
+così l'eviction per dimensione (LLM_CACHE_MAX_MB) rimuove le voci usate meno di recente,
+mentre le voci più vecchie di LLM_CACHE_MAX_AGE_DAYS non vengono più servite.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LLMResponseCache:
+
+    # Intervallo minimo (secondi) tra due scansioni di eviction
+    EVICTION_INTERVAL = 60
+
+    def __init__(
+        self,
+        cache_folder: Optional[str] = None,
+        max_mb: Optional[float] = None,
+        max_age_days: Optional[float] = None,
+    ):
+        self.cache_folder = cache_folder or os.getenv("LLM_CACHE_FOLDER", "./cache_llm")
+        self.max_bytes = (max_mb if max_mb is not None else float(os.getenv("LLM_CACHE_MAX_MB", "500"))) * 1024 * 1024
+        self.max_age = (
+            max_age_days if max_age_days is not None
+            else float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "30"))
+        ) * 86400
+        self.enabled = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._last_eviction = 0.0
+        self._stats = {"hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(model: str, prompt_version: str, text: str) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{model}|{prompt_version}|{text_hash}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_folder, key[:2], f"{key}.json")
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += n
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            self._count("misses")
+            return None
+        except Exception as e:
+            logger.warning(f"Voce di cache LLM non leggibile ({path}): {e}")
+            self._count("misses")
+            return None
+
+        if time.time() - record.get("created_at", 0) > self.max_age:
+            self._remove(path)
+            self._count("misses")
+            return None
+
+        # Aggiorna l'ultimo accesso per l'eviction LRU
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self._count("hits")
+        return record["response"]
+
+    def put(self, key: str, response: str, **metadata: Any) -> None:
+        path = self._path(key)
+        record = {"created_at": time.time(), "response": response, **metadata}
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(record, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Impossibile salvare la risposta LLM in cache: {e}")
+            return
+        self._count("stores")
+        self._maybe_evict()
+
+    def record_bypass(self) -> None:
+        self._count("bypassed")
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _maybe_evict(self) -> None:
+        now = time.time()
+        with self._lock:
+            if now - self._last_eviction < self.EVICTION_INTERVAL:
+                return
+            self._last_eviction = now
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        Rimuove le voci scadute e, se la cache supera la dimensione massima,
+        quelle con accesso meno recente.
+
+        Returns:
+            Numero di voci rimosse
+        """
+        entries = []
+        now = time.time()
+        removed = 0
+        for root, _, files in os.walk(self.cache_folder):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # Voci non più lette da oltre max_age (l'età dalla creazione è verificata in get)
+                if now - stat.st_mtime > self.max_age:
+                    self._remove(path)
+                    removed += 1
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                self._remove(path)
+                removed += 1
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+        if removed:
+            self._count("evictions", removed)
+            logger.info(f"Cache LLM: rimosse {removed} voci")
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        stats["enabled"] = self.enabled
+        return stats
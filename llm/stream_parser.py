@@ -0,0 +1,139 @@
+"""
+Parsing incrementale delle risposte LLM in streaming.
+
+IncrementalEntityParser riceve il testo a pezzi e restituisce ogni coppia
+(entità, valore) appena il relativo elemento JSON di primo livello è chiuso:
+un oggetto {"entità": ..., "valore": ...} se la risposta è una lista, una coppia
+"chiave": valore se è un oggetto piatto. Il parsing definitivo resta quello di
+EntityExtractor sul testo completo.
+
+PartialEntities raccoglie le coppie di tutte le richieste di un documento
+(chunk e gruppi di campi) e le pubblica a intervalli limitati.
+"""
+
+import json
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Item = Tuple[str, Any]
+
+
+class IncrementalEntityParser:
+
+    def __init__(self):
+        self._buffer: List[str] = []
+        self._container: Optional[str] = None   # "[" o "{" di primo livello
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._done = False
+
+    def _emit(self, element: str) -> List[Item]:
+        element = element.strip()
+        if not element:
+            return []
+        try:
+            if self._container == "{":
+                return list(json.loads("{" + element + "}").items())
+            data = json.loads(element)
+        except ValueError:
+            return []
+        if isinstance(data, dict) and "entità" in data:
+            return [(data["entità"], data.get("valore"))]
+        return []
+
+    def feed(self, text: str) -> List[Item]:
+        """Aggiunge testo alla risposta; restituisce le coppie completate con questo pezzo."""
+        items: List[Item] = []
+        for char in text:
+            if self._done:
+                break
+            if self._container is None:
+                # Salta eventuali preamboli o blocchi ```json fino al primo contenitore
+                if char in "[{":
+                    self._container = char
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                self._buffer.append(char)
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+            elif char in "]}":
+                self._depth -= 1
+                if self._depth == 0:
+                    items.extend(self._emit("".join(self._buffer)))
+                    self._buffer = []
+                    self._done = True
+                    continue
+                if self._depth == 1 and self._container == "[":
+                    # Oggetto {entità, valore} chiuso: emesso subito, senza attendere la virgola
+                    self._buffer.append(char)
+                    items.extend(self._emit("".join(self._buffer)))
+                    self._buffer = []
+                    continue
+            elif char == "," and self._depth == 1:
+                items.extend(self._emit("".join(self._buffer)))
+                self._buffer = []
+                continue
+            self._buffer.append(char)
+        return items
+
+
+class PartialEntities:
+    """
+    Entità parziali di un documento: primo valore non nullo per chiave (come l'unione
+    dei chunk), pubblicate con `publish(entities)` al massimo ogni `interval` secondi.
+    """
+
+    def __init__(
+        self,
+        explicit_keys: List[str],
+        publish: Callable[[Dict[str, Any]], None],
+        interval: float = 1.0,
+    ):
+        self.explicit = set(explicit_keys)
+        self.publish = publish
+        self.interval = interval
+        self.entities: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._last_publish = 0.0
+
+    def add(self, items: List[Item]) -> None:
+        with self._lock:
+            changed = False
+            for key, value in items:
+                if key in self.explicit and value not in (None, "", []) and key not in self.entities:
+                    self.entities[key] = value
+                    changed = True
+            if not changed or time.monotonic() - self._last_publish < self.interval:
+                return
+            self._last_publish = time.monotonic()
+            snapshot = dict(self.entities)
+        self._safe_publish(snapshot)
+
+    def flush(self) -> None:
+        """Pubblica lo stato finale (a fine streaming)."""
+        with self._lock:
+            snapshot = dict(self.entities)
+        self._safe_publish(snapshot)
+
+    def _safe_publish(self, entities: Dict[str, Any]) -> None:
+        try:
+            self.publish(entities)
+        except Exception as e:
+            logger.warning(f"Impossibile pubblicare le entità parziali: {e}")
@@ -0,0 +1,126 @@
+"""
+Budget di token delle richieste di estrazione.
+
+- Conteggio dei token di input con un tokenizer BPE (tiktoken, encoding LLM_TOKENIZER)
+  prima dell'invio; senza tiktoken si usa la stima a caratteri di estimate_tokens.
+- max_tokens proporzionale al numero di proprietà dello schema richiesto, invece di un
+  valore fisso: LLM_OUTPUT_TOKENS_BASE + LLM_OUTPUT_TOKENS_PER_FIELD per campo, entro
+  [LLM_MIN_OUTPUT_TOKENS, LLM_MAX_OUTPUT_TOKENS]. I campi a testo libero (LLM_FREE_TEXT_FIELDS:
+  testo del referto, decorso, anamnesi...) hanno LLM_OUTPUT_TOKENS_PER_TEXT_FIELD ciascuno,
+  fuori da quel tetto: il loro limite è lo spazio libero nel contesto.
+- Spazio per il documento: contesto del modello (LLM_CONTEXT_TOKENS) meno prefisso,
+  max_tokens e un margine (LLM_CONTEXT_MARGIN) per la differenza tra tokenizer.
+"""
+
+import os
+import fnmatch
+import logging
+from typing import Dict, List, Optional
+
+from .rate_limiter import estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - dipendenza opzionale
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Token di formattazione aggiunti dal template di chat per ogni messaggio
+MESSAGE_OVERHEAD = 4
+
+
+class ContextOverflowError(ValueError):
+    """La richiesta supera il contesto del modello: va divisa in chunk, non ritentata."""
+
+
+class OutputTruncatedError(RuntimeError):
+    """La risposta si è fermata a max_tokens (finish_reason "length"): il JSON è incompleto."""
+
+
+class TokenBudget:
+
+    def __init__(
+        self,
+        encoding: Optional[str] = None,
+        context_tokens: Optional[int] = None,
+        context_margin: Optional[float] = None,
+    ):
+        self.encoding_name = encoding or os.getenv("LLM_TOKENIZER", "cl100k_base")
+        self.context_tokens = context_tokens or int(os.getenv("LLM_CONTEXT_TOKENS", "131072"))
+        self.context_margin = (
+            context_margin if context_margin is not None else float(os.getenv("LLM_CONTEXT_MARGIN", "0.1"))
+        )
+        self.base_output_tokens = int(os.getenv("LLM_OUTPUT_TOKENS_BASE", "256"))
+        self.output_tokens_per_field = int(os.getenv("LLM_OUTPUT_TOKENS_PER_FIELD", "48"))
+        self.min_output_tokens = int(os.getenv("LLM_MIN_OUTPUT_TOKENS", "1024"))
+        self.max_output_tokens = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "8192"))
+        self.output_tokens_per_text_field = int(os.getenv("LLM_OUTPUT_TOKENS_PER_TEXT_FIELD", "1536"))
+        self.free_text_fields = [
+            p.strip() for p in os.getenv(
+                "LLM_FREE_TEXT_FIELDS",
+                "*_text,Decorso_*,Anamnesi,Diagnosi,Terapia,terapia_*,esami_*,parametri,"
+                "intervento_pregresso_descrizione"
+            ).split(",") if p.strip()
+        ]
+        self._encoding = self._load_encoding()
+
+    def _load_encoding(self):
+        if tiktoken is None or self.encoding_name.lower() == "none":
+            logger.info("Tokenizer non disponibile: conteggio token stimato dai caratteri")
+            return None
+        try:
+            return tiktoken.get_encoding(self.encoding_name)
+        except Exception as e:
+            logger.warning(f"Tokenizer {self.encoding_name} non caricabile ({e}): conteggio stimato dai caratteri")
+            return None
+
+    @property
+    def tokenizer(self) -> str:
+        return self.encoding_name if self._encoding is not None else "chars"
+
+    # ------------------------------------------------------------------ #
+    # Conteggi
+    # ------------------------------------------------------------------ #
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encoding is None:
+            return estimate_tokens(text)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.count(m.get("content") or "") + MESSAGE_OVERHEAD for m in messages)
+
+    # ------------------------------------------------------------------ #
+    # Budget
+    # ------------------------------------------------------------------ #
+
+    def is_free_text(self, field: str) -> bool:
+        return any(fnmatch.fnmatchcase(field, pattern) for pattern in self.free_text_fields)
+
+    def output_budget(self, field_count: int, text_fields: int = 0) -> int:
+        """
+        max_tokens per uno schema di `field_count` proprietà, di cui `text_fields` a testo
+        libero: questi hanno un budget proprio, non limitato da LLM_MAX_OUTPUT_TOKENS.
+        """
+        budget = self.base_output_tokens + self.output_tokens_per_field * (field_count - text_fields)
+        budget = max(self.min_output_tokens, min(self.max_output_tokens, budget))
+        return budget + self.output_tokens_per_text_field * text_fields
+
+    def grow_output(self, prompt_tokens: int, max_tokens: int) -> Optional[int]:
+        """max_tokens raddoppiato entro lo spazio libero nel contesto; None se non può crescere."""
+        grown = min(2 * max_tokens, self.usable_context - prompt_tokens)
+        return grown if grown > max_tokens else None
+
+    @property
+    def usable_context(self) -> int:
+        return int(self.context_tokens * (1 - self.context_margin))
+
+    def input_budget(self, prefix_tokens: int, max_tokens: int) -> int:
+        """Token disponibili per il documento, dato il prefisso (system) e l'output riservato."""
+        return max(0, self.usable_context - prefix_tokens - max_tokens - 2 * MESSAGE_OVERHEAD)
+
+    def fits(self, prompt_tokens: int, max_tokens: int) -> bool:
+        return prompt_tokens + max_tokens <= self.usable_context
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import uuid
+from datetime import datetime
+from typing import Any
+
+from extension import db
+
+
+class ProcessingJob(db.Model):
+    """
+    Record persistente di un job di processing in background.
+    Stati: queued -> running -> done | failed (con ritorno a queued in caso di retry).
+    """
+
+    __tablename__ = "processing_jobs"
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String(16), nullable=False, default=STATUS_QUEUED, index=True)
+    document_id = db.Column(db.String(255), nullable=True, index=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    max_attempts = db.Column(db.Integer, default=3, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    progress = db.Column(db.JSON, nullable=True)
+    owner = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        nullable=False,
+    )
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "document_id": self.document_id,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "last_error": self.last_error,
+            "progress": self.progress,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+    @classmethod
+    def create(
+        cls,
+        kind: str,
+        payload: dict,
+        document_id: str | None = None,
+        max_attempts: int = 3,
+    ) -> "ProcessingJob":
+        instance = cls(
+            kind=kind,
+            payload=payload,
+            document_id=document_id,
+            max_attempts=max_attempts,
+            status=cls.STATUS_QUEUED,
+            attempts=0,
+        )
+        db.session.add(instance)
+        db.session.commit()
+        return instance
+
+    @classmethod
+    def claim(cls, job_id: str, owner: str) -> "ProcessingJob | None":
+        """
+        Passa atomicamente un job da queued a running.
+        Ritorna None se il job è già stato preso da un altro worker/processo.
+        """
+        updated = (
+            cls.query
+            .filter_by(id=job_id, status=cls.STATUS_QUEUED)
+            .update(
+                {
+                    cls.status: cls.STATUS_RUNNING,
+                    cls.attempts: cls.attempts + 1,
+                    cls.owner: owner,
+                    cls.started_at: datetime.utcnow(),
+                    cls.updated_at: datetime.utcnow(),
+                },
+                synchronize_session=False,
+            )
+        )
+        db.session.commit()
+        if not updated:
+            return None
+        return db.session.get(cls, job_id)
+
+    @classmethod
+    def mark_done(cls, job_id: str) -> None:
+        instance = db.session.get(cls, job_id)
+        if instance is None:
+            return
+        instance.status = cls.STATUS_DONE
+        instance.last_error = None
+        instance.finished_at = datetime.utcnow()
+        db.session.commit()
+
+    @classmethod
+    def mark_failed(cls, job_id: str, error: str, retry: bool) -> None:
+        """Registra l'errore: rimette in coda se retry, altrimenti failed definitivo."""
+        instance = db.session.get(cls, job_id)
+        if instance is None:
+            return
+        instance.last_error = error
+        instance.owner = None
+        if retry:
+            instance.status = cls.STATUS_QUEUED
+        else:
+            instance.status = cls.STATUS_FAILED
+            instance.finished_at = datetime.utcnow()
+        db.session.commit()
+
+    @classmethod
+    def update_progress(cls, job_id: str, progress: dict) -> None:
+        instance = db.session.get(cls, job_id)
+        if instance is None:
+            return
+        merged = dict(instance.progress or {})
+        merged.update(progress)
+        instance.progress = merged
+        db.session.commit()
+
+    @classmethod
+    def set_document_id(cls, job_id: str, document_id: str) -> None:
+        instance = db.session.get(cls, job_id)
+        if instance is None:
+            return
+        instance.document_id = document_id
+        db.session.commit()
+
+    @classmethod
+    def unfinished(cls) -> list["ProcessingJob"]:
+        return (
+            cls.query
+            .filter(cls.status.in_([cls.STATUS_QUEUED, cls.STATUS_RUNNING]))
+            .order_by(cls.created_at)
+            .all()
+        )
+
+    @classmethod
+    def requeue(cls, job_id: str) -> None:
+        instance = db.session.get(cls, job_id)
+        if instance is None:
+            return
+        instance.status = cls.STATUS_QUEUED
+        instance.owner = None
+        db.session.commit()
@@ -23,9 +23,33 @@ class DocumentTypeDetector:
     """
     Servizio per determinare il tipo di documento dal nome del file.
     """
+
+    # Parole chiave testuali per tipo, in ordine di priorità (usate anche per valutare
+    # la rilevanza delle pagine in PageSelector)
+    KEYWORDS = {
+        "lettera_dimissione": ["relazione clinica alla dimissione"],
+        "coronarografia": ["coronarografia"],
+        "intervento": ["intervento chirurgico", "verbale operatorio"],
+        "eco_preoperatorio": ["ecocardiogramma", "pre op"],
+        "eco_postoperatorio": ["ecocardiogramma", "post op"],
+        "tc_cuore": ["tc", "tac"],
+    }
+    # Tipi per cui devono comparire tutte le parole chiave (per gli altri ne basta una)
+    REQUIRE_ALL = {"eco_preoperatorio", "eco_postoperatorio"}
+    # Tipi scartati se nel testo compaiono le parole chiave di un altro tipo
+    EXCLUDED_BY = {"coronarografia": "intervento"}
+
+    @classmethod
+    def keywords_for(cls, document_type: str) -> list:
+        return cls.KEYWORDS.get(document_type, [])
+
+    @classmethod
+    def _matches(cls, document_type: str, text_lower: str) -> bool:
+        found = [keyword in text_lower for keyword in cls.KEYWORDS[document_type]]
+        return all(found) if document_type in cls.REQUIRE_ALL else any(found)
     
-    @staticmethod
-    def detect(filename: str, text: str = None) -> DocumentType:
+    @classmethod
+    def detect(cls, filename: str, text: str = None) -> DocumentType:
         """
         Determina il tipo di documento basandosi sul testo o sul nome del file.
         Prima controlla il testo per le keyword, poi usa il nome del file come fallback.
@@ -40,29 +64,12 @@ class DocumentTypeDetector:
         # Se il testo è fornito, cerca le keyword nel testo
         if text:
             text_lower = text.lower()
-            
-            # Controlla le keyword nel testo
-            if "relazione clinica alla dimissione" in text_lower:
-                return "lettera_dimissione"
-
-            if (
-                "coronarografia" in text_lower
-                and "intervento chirurgico" not in text_lower
-                and "verbale operatorio" not in text_lower
-            ):
-                return "coronarografia"
-
-            if "intervento chirurgico" in text_lower or "verbale operatorio" in text_lower:
-                return "intervento"
-
-            if "ecocardiogramma" in text_lower and "pre op" in text_lower:
-                return "eco_preoperatorio"
-
-            if "ecocardiogramma" in text_lower and "post op" in text_lower:
-                return "eco_postoperatorio"
-
-            if "tc" in text_lower or "tac" in text_lower:
-                return "tc_cuore"
+            for document_type in cls.KEYWORDS:
+                excluded_by = cls.EXCLUDED_BY.get(document_type)
+                if excluded_by and cls._matches(excluded_by, text_lower):
+                    continue
+                if cls._matches(document_type, text_lower):
+                    return document_type
         
         # Se non c'è testo o non si trova nulla nel testo, usa il nome del file come fallback
         name = filename.lower()
@@ -5,16 +5,19 @@ Gestisce la logica di business per l'upload e processing dei documenti.
 
 import os
 import io
-import json
+import uuid
+import shutil
 import logging
-import tempfile
-import pdfplumber
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from werkzeug.datastructures import FileStorage
-import ocrmypdf
 
 from services.document_type_detector import DocumentTypeDetector
+from services.job_queue import PermanentJobError, current_job_is_last_attempt
+from services.ocr_service import OCRInterruptedError, OCRService
 from controller.controller import DocumentController
+from models.response import Response
+from utils.parsed_document import ParsedDocument
+from utils.entity_extractor import EntityExtractor
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +33,8 @@ class DocumentUploadResult:
         document_type: Optional[str] = None,
         filename: Optional[str] = None,
         error: Optional[str] = None,
-        status: str = "processing"
+        status: str = "processing",
+        job_id: Optional[str] = None
     ):
         self.success = success
         self.document_id = document_id
@@ -39,6 +43,7 @@ class DocumentUploadResult:
         self.filename = filename
         self.error = error
         self.status = status
+        self.job_id = job_id
     
     def to_dict(self) -> Dict[str, Any]:
         """Converte il risultato in un dizionario per la risposta JSON."""
@@ -48,6 +53,7 @@ class DocumentUploadResult:
                 "patient_id": self.patient_id,
                 "document_type": self.document_type,
                 "filename": self.filename,
+                "job_id": self.job_id,
                 "status": self.status
             }
         else:
@@ -62,10 +68,22 @@ class DocumentUploadService:
     Servizio per gestire l'upload e il processing dei documenti.
     """
     
-    def __init__(self, controller: DocumentController, upload_folder: str):
+    def __init__(
+        self,
+        controller: DocumentController,
+        upload_folder: str,
+        ocr_service: Optional[OCRService] = None
+    ):
         self.controller = controller
         self.upload_folder = upload_folder
         self.type_detector = DocumentTypeDetector()
+        self.ocr_service = ocr_service or OCRService()
+        # Con il motore OCR "solo testo" il PDF ricercabile può essere generato dopo, in background
+        self.build_searchable_pdf = os.getenv("OCR_SEARCHABLE_PDF", "false").lower() == "true"
+        self.controller.job_queue.register("staged_upload", self.run_staged_upload)
+        # Nome storico del job: mantenuto per i job persistiti prima del rename
+        self.controller.job_queue.register("ocr_upload", self.run_staged_upload)
+        self.controller.job_queue.register("searchable_pdf", self.run_searchable_pdf)
     
     def process_upload(
         self,
@@ -74,6 +92,9 @@ class DocumentUploadService:
     ) -> DocumentUploadResult:
         """
         Processa l'upload di un singolo documento.
+        I PDF senza layer di testo vengono accodati per l'OCR, e le lettere di dimissione
+        senza patient_id per la lettura di n_cartella dal modello: in entrambi i casi
+        il risultato ha status "queued" (document_id noto solo a fine job, vedi job_id).
         
         Args:
             file: File da processare
@@ -89,16 +110,23 @@ class DocumentUploadService:
         file_bytes = file.read()
         file.stream.seek(0)
         
-        # Verifica se il PDF ha un layer di testo senza estrarre tutto il testo
-        has_text_layer = False
+        # Impronta del contenuto: un PDF già visto riusa parsing e OCR dalla cache
+        content_cache = self.controller.content_cache
+        content_hash = self.controller.file_manager.compute_sha256(file_bytes)
+        if content_cache.register_upload(content_hash):
+            cached = content_cache.load_document(content_hash)
+            if cached is not None:
+                parsed, ocr_pdf = cached
+                logger.info(f"Parsing/OCR di {filename} recuperati dalla cache dei contenuti")
+                return self._ingest_or_enqueue(filename, ocr_pdf or file_bytes, parsed, patient_id, content_hash)
+        
+        # Parsing unico del PDF: testo, word con bbox e caratteri per pagina
         try:
-            with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-                # Controlla se almeno una pagina ha caratteri (chars) o oggetti di testo
-                for page in pdf.pages:
-                    if page.chars:  # Se ci sono caratteri, c'è un layer di testo
-                        has_text_layer = True
-                        break
-            logger.debug(f"Layer di testo presente: {has_text_layer} per file {filename}")
+            parsed = ParsedDocument.from_bytes(file_bytes)
+            pages_to_ocr = parsed.pages_needing_ocr()
+            logger.debug(
+                f"Pagine senza layer di testo: {len(pages_to_ocr)}/{parsed.page_count} per file {filename}"
+            )
         except Exception as e:
             logger.error(f"Errore lettura PDF {filename}: {e}")
             return DocumentUploadResult(
@@ -107,77 +135,240 @@ class DocumentUploadService:
                 error=f"Errore lettura PDF: {str(e)}"
             )
         
-        # Se non c'è layer di testo, esegui OCR
-        if not has_text_layer:
-            logger.info(f"Nessun layer di testo rilevato per {filename}, avvio OCR...")
-            try:
-                # Crea file temporanei per input e output OCR
-                with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_input:
-                    temp_input.write(file_bytes)
-                    temp_input_path = temp_input.name
-                
-                with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_output:
-                    temp_output_path = temp_output.name
-                
-                try:
-                    # Esegui OCR con layer OCR
-                    ocrmypdf.ocr(
-                        temp_input_path,
-                        temp_output_path,
-                        language='ita+eng',  # Supporta italiano e inglese
-                        force_ocr=True  # Forza OCR per aggiungere il layer OCR
-                    )
-                    
-                    # Leggi il PDF con OCR
-                    with open(temp_output_path, 'rb') as f:
-                        file_bytes = f.read()
-                    
-                    # Crea un nuovo FileStorage con il contenuto OCRizzato
-                    file = FileStorage(
-                        stream=io.BytesIO(file_bytes),
-                        filename=filename,
-                        content_type=file.content_type
-                    )
-                    
-                finally:
-                    # Pulisci file temporanei
-                    try:
-                        os.unlink(temp_input_path)
-                    except:
-                        pass
-                    try:
-                        os.unlink(temp_output_path)
-                    except:
-                        pass
-                        
-            except Exception as e:
-                logger.error(f"Errore durante OCR per {filename}: {e}")
-                # Continua comunque con il file originale se OCR fallisce
-                logger.warning(f"Continuo con il file originale senza OCR")
+        # Se alcune pagine non hanno layer di testo, l'OCR (solo di quelle) viene eseguito in background
+        if pages_to_ocr:
+            logger.info(f"Pagine {pages_to_ocr} senza layer di testo per {filename}, OCR accodato")
+            return self._enqueue_staged(filename, file_bytes, patient_id, parsed, pages_to_ocr, content_hash)
         
-        # Estrai testo (una sola volta, dopo eventuale OCR)
+        content_cache.store_document(content_hash, parsed)
+        return self._ingest_or_enqueue(filename, file_bytes, parsed, patient_id, content_hash)
+    
+    def _ingest_or_enqueue(
+        self,
+        filename: str,
+        file_bytes: bytes,
+        parsed: ParsedDocument,
+        patient_id: Optional[str],
+        content_hash: Optional[str] = None
+    ) -> DocumentUploadResult:
+        """
+        Ingestione nella richiesta di un PDF con testo già disponibile (parsato o dalla cache),
+        salvo le lettere di dimissione che richiedono il modello per n_cartella.
+        """
+        # Senza patient_id la lettera di dimissione richiede n_cartella: se le regole
+        # anagrafiche non lo trovano serve il modello, chiamato in background invece
+        # che nella richiesta
+        if (
+            not patient_id
+            and self.type_detector.detect(filename, parsed.text) == "lettera_dimissione"
+            and not self.controller.anagraphic_extractor.extract_n_cartella(parsed.text)
+        ):
+            logger.info(f"Lettera di dimissione {filename} senza patient_id, ingestione accodata")
+            return self._enqueue_staged(filename, file_bytes, patient_id, parsed, [], content_hash)
+        
+        return self._ingest(filename, file_bytes, parsed, patient_id, content_hash)
+    
+    def _enqueue_staged(
+        self,
+        filename: str,
+        file_bytes: bytes,
+        patient_id: Optional[str],
+        parsed: ParsedDocument,
+        pages: List[int],
+        content_hash: Optional[str] = None
+    ) -> DocumentUploadResult:
+        """
+        Salva il PDF in un'area di staging e accoda il job di ingestione,
+        con OCR delle pagine indicate (nessuna se `pages` è vuota).
+        """
         try:
-            with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-                text = "\n".join(page.extract_text() or "" for page in pdf.pages)
-            logger.debug(f"Testo estratto, lunghezza: {len(text)}")
+            staging_folder = os.path.join(self.upload_folder, f"_pending_{uuid.uuid4().hex}")
+            os.makedirs(staging_folder, exist_ok=True)
+            staged_path = os.path.join(staging_folder, filename)
+            with open(staged_path, "wb") as f:
+                f.write(file_bytes)
         except Exception as e:
-            logger.error(f"Errore estrazione testo da PDF {filename}: {e}")
+            logger.error(f"Errore salvataggio in staging di {filename}: {e}")
             return DocumentUploadResult(
                 success=False,
                 filename=filename,
-                error=f"Errore estrazione testo: {str(e)}"
+                error=f"Errore salvataggio file: {str(e)}"
             )
         
+        job_id = self.controller.job_queue.enqueue(
+            "staged_upload",
+            {
+                "staged_path": staged_path,
+                "filename": filename,
+                "patient_id": patient_id,
+                "pages": pages,
+                "content_hash": content_hash,
+            },
+            transient={"parsed_document": parsed},
+        )
+        
+        return DocumentUploadResult(
+            success=True,
+            patient_id=patient_id,
+            filename=filename,
+            status="queued",
+            job_id=job_id
+        )
+    
+    def run_staged_upload(
+        self,
+        staged_path: str,
+        filename: str,
+        patient_id: Optional[str] = None,
+        pages: Optional[List[int]] = None,
+        content_hash: Optional[str] = None,
+        parsed_document: Optional[ParsedDocument] = None
+    ) -> None:
+        """
+        Handler del job "staged_upload": OCR in parallelo delle sole pagine senza testo
+        (se presenti), unione dei risultati in ordine di pagina, poi il normale flusso
+        di upload (classificazione, patient_id, salvataggio e job di estrazione).
+        """
+        with open(staged_path, "rb") as f:
+            file_bytes = f.read()
+        
+        parsed = parsed_document
+        if parsed is None:
+            try:
+                parsed = ParsedDocument.from_bytes(file_bytes)
+            except Exception as e:
+                self._remove_staging(staged_path)
+                raise PermanentJobError(f"Errore lettura PDF: {str(e)}")
+        
+        try:
+            if pages:
+                file_bytes = self._run_ocr(filename, file_bytes, parsed, pages, content_hash)
+            result = self._ingest(filename, file_bytes, parsed, patient_id, content_hash)
+        except Exception as e:
+            # Il file in staging serve ai retry: si rimuove solo quando il job non verrà ritentato
+            if isinstance(e, PermanentJobError) or current_job_is_last_attempt():
+                self._remove_staging(staged_path)
+            raise
+        self._remove_staging(staged_path)
+        if not result.success:
+            raise PermanentJobError(result.error)
+        
+        if pages and self.build_searchable_pdf and not self.ocr_service.rewrites_pdf:
+            filepath = os.path.join(
+                self.controller.file_manager.UPLOAD_FOLDER,
+                result.patient_id,
+                result.document_type,
+                filename
+            )
+            self.controller.job_queue.enqueue(
+                "searchable_pdf",
+                {"filepath": filepath, "pages": pages},
+                document_id=result.document_id,
+            )
+        
+        self.controller.job_queue.set_document_id(result.document_id)
+        self.controller.job_queue.report_progress(
+            stage="ocr_completed" if pages else "ingested",
+            document_id=result.document_id,
+            document_type=result.document_type,
+            patient_id=result.patient_id,
+            process_job_id=result.job_id,
+        )
+        Response.add_response(id_document=result.document_id)
+    
+    def _run_ocr(
+        self,
+        filename: str,
+        file_bytes: bytes,
+        parsed: ParsedDocument,
+        pages: List[int],
+        content_hash: Optional[str]
+    ) -> bytes:
+        """
+        OCR delle pagine indicate. Timeout e interruzioni del pool OCR vengono propagati
+        (il job è ritentato con il file in staging); solo un errore dell'OCR del documento
+        stesso fa proseguire con il PDF originale.
+        """
+        self.controller.job_queue.report_progress(stage="ocr", pages=pages)
+        try:
+            ocr_bytes, failed_pages = self.ocr_service.ocr_pages(file_bytes, parsed, pages)
+        except OCRInterruptedError as e:
+            logger.warning(f"OCR interrotto per {filename}, il job verrà ritentato: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Errore durante OCR per {filename}: {e}")
+            # Continua comunque con il file originale se OCR fallisce
+            logger.warning(f"Continuo con il file originale senza OCR")
+            return file_bytes
+        
+        # Solo un OCR riuscito su tutte le pagine finisce in cache (altrimenti il prossimo
+        # upload dello stesso file ritenta le pagine mancanti)
+        if failed_pages:
+            logger.warning(f"OCR fallito per le pagine {failed_pages} di {filename}, risultato non messo in cache")
+        elif content_hash:
+            self.controller.content_cache.store_document(
+                content_hash,
+                parsed,
+                ocr_bytes if ocr_bytes is not file_bytes else None,
+                ocr_engine=self.ocr_service.engine
+            )
+        return ocr_bytes
+    
+    def run_searchable_pdf(self, filepath: str, pages: List[int]) -> None:
+        """
+        Handler del job "searchable_pdf": aggiunge il layer OCR alle pagine indicate
+        del PDF già salvato (sostituzione atomica del file).
+        Il documento può essere rimosso durante l'OCR (rifiuto per coerenza, n_cartella
+        mancante): in quel caso il file non viene ricreato.
+        """
+        if not os.path.exists(filepath):
+            raise PermanentJobError(f"File non trovato: {filepath}")
+        with open(filepath, "rb") as f:
+            pdf_bytes = f.read()
+        
+        searchable = self.ocr_service.build_searchable_pdf(pdf_bytes, pages)
+        tmp_path = filepath + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(searchable)
+        except FileNotFoundError:
+            # cartella del documento (o del paziente) rimossa durante l'OCR
+            logger.info(f"Documento {filepath} rimosso durante l'OCR, PDF ricercabile scartato")
+            return
+        # ricontrollo subito prima della sostituzione: PDF e meta.json vengono rimossi insieme
+        if not (os.path.exists(filepath) and os.path.exists(filepath + ".meta.json")):
+            os.remove(tmp_path)
+            logger.info(f"Documento {filepath} rimosso durante l'OCR, PDF ricercabile scartato")
+            return
+        os.replace(tmp_path, filepath)
+        logger.info(f"PDF ricercabile generato per {filepath}")
+    
+    def _remove_staging(self, staged_path: str) -> None:
+        shutil.rmtree(os.path.dirname(staged_path), ignore_errors=True)
+    
+    def _ingest(
+        self,
+        filename: str,
+        file_bytes: bytes,
+        parsed: ParsedDocument,
+        patient_id: Optional[str],
+        content_hash: Optional[str] = None
+    ) -> DocumentUploadResult:
+        """Classifica, salva e accoda l'estrazione di un documento già parsato."""
+        text = parsed.text
+        logger.debug(f"Testo estratto, lunghezza: {len(text)}")
+        
         # Determina il tipo di documento (dopo l'estrazione del testo)
         document_type = self.type_detector.detect(filename, text)
         logger.debug(f"Tipo documento rilevato: {document_type} per file {filename}")
         
-        # Determina patient_id_final
-        patient_id_final = self._determine_patient_id(
+        # Determina patient_id_final (e le eventuali risposte LLM già ottenute, riusate dall'estrazione)
+        patient_id_final, llm_responses = self._determine_patient_id(
             document_type=document_type,
             patient_id=patient_id,
             text=text,
-            filename=filename
+            filename=filename,
+            pages=[page.text for page in parsed.pages]
         )
         
         if not patient_id_final:
@@ -204,9 +395,12 @@ class DocumentUploadService:
                 patient_id_final,
                 document_type,
                 filename,
-                file
+                io.BytesIO(file_bytes),
+                content_hash=content_hash
             )
             logger.info(f"File salvato in: {filepath}")
+            # Testo per pagina (già OCRizzato) per i riprocessamenti successivi
+            self.controller.file_manager.save_parsed_document(filepath, parsed)
         except Exception as e:
             logger.error(f"Errore salvataggio file {filename}: {e}")
             return DocumentUploadResult(
@@ -222,30 +416,34 @@ class DocumentUploadService:
                 patient_id_final, "lettera_dimissione"
             )
         
-        # Avvia processing in background
-        from threading import Thread
-        
-        def process_with_error_logging():
-            try:
-                self.controller.process_document_and_entities(
-                    filepath, patient_id_final, document_type, provided_anagraphic, text
-                )
-            except Exception as e:
-                logger.exception(f"Errore critico nel processing di {filename}: {e}")
-        
-        Thread(target=process_with_error_logging, daemon=True).start()
-        
         # Costruisci document_id
         file_noext = os.path.splitext(filename)[0]
         document_id = f"doc_{patient_id_final}_{document_type}_{file_noext}"
         
+        # Accoda il processing in background (pool di worker limitato, stato persistito)
+        job_id = self.controller.job_queue.enqueue(
+            "process_document",
+            {
+                "filepath": filepath,
+                "patient_id": patient_id_final,
+                "document_type": document_type,
+                "provided_anagraphic": provided_anagraphic,
+                "text": text,
+                "content_hash": content_hash,
+                "llm_responses": llm_responses,
+            },
+            document_id=document_id,
+            transient={"parsed_document": parsed},
+        )
+        
         return DocumentUploadResult(
             success=True,
             document_id=document_id,
             patient_id=patient_id_final,
             document_type=document_type,
             filename=filename,
-            status="processing"
+            status="processing",
+            job_id=job_id
         )
     
     def _determine_patient_id(
@@ -253,39 +451,52 @@ class DocumentUploadService:
         document_type: str,
         patient_id: Optional[str],
         text: str,
-        filename: str
-    ) -> Optional[str]:
+        filename: str,
+        pages: Optional[List[str]] = None
+    ) -> Tuple[Optional[str], Optional[List[str]]]:
         """
         Determina il patient_id finale per il documento.
         
         Returns:
-            patient_id finale o None se non determinabile
+            (patient_id finale o None se non determinabile,
+             risposte LLM complete, una per chunk, se è stato necessario interrogare il modello)
+        
+        Raises:
+            Gli errori della chiamata LLM (timeout, rate limit, provider non raggiungibile),
+            così il job di ingestione viene ritentato invece di fallire in modo definitivo
         """
         # Per lettera_dimissione: estrai da LLM se necessario
         if document_type == "lettera_dimissione":
             if patient_id:
-                return str(patient_id)
+                return str(patient_id), None
             
-            # Tenta estrazione LLM per n_cartella
-            try:
-                response_str = self.controller.llm.get_response_from_document(
-                    text, document_type, model=self.controller.model_name
-                )
-                extracted_json = json.loads(response_str)
-                extracted_id = extracted_json.get("n_cartella")
-                
-                if extracted_id:
-                    return str(extracted_id)
-                else:
-                    logger.warning(f"Nessun n_cartella trovato in {filename}")
-                    return None
-            except Exception as e:
-                logger.error(f"Errore estrazione patient_id da LLM per {filename}: {e}")
-                return None
+            # Regole deterministiche sulle diciture fisse ("Numero Cartella 2019034139")
+            extracted_id = self.controller.anagraphic_extractor.extract_n_cartella(text)
+            if extracted_id:
+                logger.info(f"n_cartella {extracted_id} estratto senza LLM da {filename}")
+                return extracted_id, None
+            # Un numero dopo "cartella" senza etichetta è solo un indizio: decide l'LLM
+            hint = self.controller.anagraphic_extractor.extract_n_cartella_hint(text)
+            
+            # Fallback: estrazione LLM per n_cartella, la stessa estrazione completa del
+            # job di processing, che riceve le risposte invece di ripetere le chiamate.
+            # Gli errori del modello o della rete si propagano: il job viene ritentato
+            chunks, responses = self.controller.llm.get_responses_for_document(
+                pages or [text], document_type, model=self.controller.model_name
+            )
+            explicit_keys = self.controller.prompt_manager.get_spec_for(document_type)["entities"]
+            extracted = EntityExtractor(explicit_keys).parse_llm_responses(responses, chunks)
+            extracted_id = extracted.get("n_cartella")
+            
+            if extracted_id:
+                if hint and str(extracted_id) != hint:
+                    logger.info(f"n_cartella candidato {hint} non confermato dall'LLM ({extracted_id}) per {filename}")
+                return str(extracted_id), responses
+            logger.warning(f"Nessun n_cartella trovato in {filename}")
+            return None, None
         else:
             # Per altri tipi di documento, patient_id è obbligatorio
             if not patient_id:
                 logger.warning(f"patient_id obbligatorio per tipo {document_type}")
-                return None
-            return str(patient_id)
-
+                return None, None
+            return str(patient_id), None
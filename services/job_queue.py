@@ -0,0 +1,284 @@
+"""
+Job Queue Service
+Coda di processing con pool di worker limitato e stato persistito su Postgres.
+Sostituisce i thread "fire-and-forget" avviati per ogni documento.
+"""
+
+import os
+import queue
+import socket
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from flask import Flask
+
+from extension import db
+from models.job import ProcessingJob
+
+logger = logging.getLogger(__name__)
+
+_current = threading.local()
+
+
+class PermanentJobError(Exception):
+    """Errore non recuperabile: il job viene marcato failed senza ulteriori tentativi."""
+
+
+def current_job_id() -> Optional[str]:
+    """ID del job in esecuzione nel thread corrente (None fuori da un worker)."""
+    return getattr(_current, "job_id", None)
+
+
+def current_job_is_last_attempt() -> bool:
+    """True se il job del thread corrente non verrà ritentato in caso di errore."""
+    return getattr(_current, "last_attempt", False)
+
+
+class JobQueue:
+    """
+    Coda di job in-process con persistenza dello stato.
+
+    - I job vengono salvati in `processing_jobs` prima di essere accodati.
+    - Un numero fisso di worker (JOB_WORKERS) li esegue: il carico resta prevedibile
+      anche con upload di molti file insieme.
+    - In caso di errore il job viene rimesso in coda con backoff esponenziale
+      fino a JOB_MAX_ATTEMPTS tentativi.
+    - All'avvio i job non completati vengono recuperati e rieseguiti.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        max_workers: Optional[int] = None,
+        max_attempts: Optional[int] = None,
+        retry_backoff: Optional[float] = None,
+    ):
+        self.app = app
+        self.max_workers = max_workers or int(os.getenv("JOB_WORKERS", "2"))
+        self.max_attempts = max_attempts or int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+        self.retry_backoff = (
+            retry_backoff if retry_backoff is not None
+            else float(os.getenv("JOB_RETRY_BACKOFF", "5"))
+        )
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._handlers: Dict[str, Callable[..., Any]] = {}
+        # Argomenti non serializzabili (es. documento già parsato) tenuti solo in memoria
+        self._transient: Dict[str, Dict[str, Any]] = {}
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------ #
+    # Registrazione ed enqueue
+    # ------------------------------------------------------------------ #
+
+    def register(self, kind: str, handler: Callable[..., Any]) -> None:
+        """Associa un tipo di job alla funzione che lo esegue (payload passato come kwargs)."""
+        self._handlers[kind] = handler
+
+    def enqueue(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        document_id: Optional[str] = None,
+        transient: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """
+        Persiste un nuovo job e lo mette in coda.
+        Il payload deve essere serializzabile in JSON.
+        `transient` contiene kwargs aggiuntivi passati all'handler solo da questo
+        processo: non vengono persistiti, quindi dopo un restart l'handler deve
+        saperli ricostruire (es. riparsando il PDF).
+
+        Returns:
+            ID del job creato
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"Nessun handler registrato per job di tipo '{kind}'")
+
+        with self.app.app_context():
+            job = ProcessingJob.create(
+                kind=kind,
+                payload=payload,
+                document_id=document_id,
+                max_attempts=self.max_attempts,
+            )
+            job_id = job.id
+
+        if transient:
+            self._transient[job_id] = transient
+        logger.info(f"Job {job_id} ({kind}) accodato per {document_id}")
+        self._queue.put(job_id)
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.app.app_context():
+            job = db.session.get(ProcessingJob, job_id)
+            return job.to_dict() if job else None
+
+    def report_progress(self, **progress: Any) -> None:
+        """Aggiorna il campo progress del job corrente (no-op fuori da un worker)."""
+        job_id = current_job_id()
+        if not job_id:
+            return
+        try:
+            with self.app.app_context():
+                ProcessingJob.update_progress(job_id, progress)
+        except Exception as e:
+            logger.warning(f"Impossibile aggiornare il progresso del job {job_id}: {e}")
+
+    def progress_reporter(self) -> Optional[Callable[..., None]]:
+        """
+        report_progress legato al job corrente, utilizzabile anche da altri thread
+        (es. callback dell'event loop LLM). None fuori da un worker.
+        """
+        job_id = current_job_id()
+        if not job_id:
+            return None
+
+        def report(**progress: Any) -> None:
+            try:
+                with self.app.app_context():
+                    ProcessingJob.update_progress(job_id, progress)
+            except Exception as e:
+                logger.warning(f"Impossibile aggiornare il progresso del job {job_id}: {e}")
+
+        return report
+
+    def set_document_id(self, document_id: str) -> None:
+        """Associa il documento al job corrente, quando è noto solo durante l'esecuzione."""
+        job_id = current_job_id()
+        if not job_id:
+            return
+        with self.app.app_context():
+            ProcessingJob.set_document_id(job_id, document_id)
+
+    # ------------------------------------------------------------------ #
+    # Ciclo di vita
+    # ------------------------------------------------------------------ #
+
+    def start(self) -> None:
+        """Avvia i worker e recupera i job rimasti incompleti da un avvio precedente."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.max_workers):
+                t = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        logger.info(f"JobQueue avviata con {self.max_workers} worker")
+
+        try:
+            self.recover()
+        except Exception as e:
+            logger.error(f"Recupero job non completati fallito: {e}")
+
+    def stop(self) -> None:
+        with self._lock:
+            for _ in self._threads:
+                self._queue.put(None)
+            self._threads = []
+
+    def recover(self) -> int:
+        """
+        Rimette in coda i job queued e i job running il cui processo proprietario non esiste più.
+
+        Returns:
+            Numero di job recuperati
+        """
+        recovered = 0
+        with self.app.app_context():
+            for job in ProcessingJob.unfinished():
+                if job.status == ProcessingJob.STATUS_RUNNING:
+                    if self._owner_alive(job.owner):
+                        continue
+                    ProcessingJob.requeue(job.id)
+                self._queue.put(job.id)
+                recovered += 1
+        if recovered:
+            logger.info(f"Recuperati {recovered} job non completati")
+        return recovered
+
+    def _owner_alive(self, owner: Optional[str]) -> bool:
+        """Verifica se il processo che aveva preso in carico il job è ancora vivo (stesso host)."""
+        if not owner or owner == self.owner:
+            return False
+        host, _, pid = owner.rpartition(":")
+        if host != socket.gethostname():
+            # Processo su un altro host: non possiamo verificarlo, lo lasciamo stare
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except (ValueError, ProcessLookupError):
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    # ------------------------------------------------------------------ #
+    # Worker
+    # ------------------------------------------------------------------ #
+
+    def _worker(self) -> None:
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                self._queue.task_done()
+                return
+            try:
+                self._run(job_id)
+            except Exception as e:
+                logger.exception(f"Errore inatteso nel worker per il job {job_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id: str) -> None:
+        with self.app.app_context():
+            job = ProcessingJob.claim(job_id, self.owner)
+            if job is None:
+                # Già preso da un altro worker o non più in coda
+                return
+
+            kind = job.kind
+            payload = dict(job.payload or {})
+            attempts = job.attempts
+            max_attempts = job.max_attempts
+
+            handler = self._handlers.get(kind)
+            if handler is None:
+                logger.error(f"Job {job_id}: nessun handler per '{kind}'")
+                ProcessingJob.mark_failed(job_id, f"Handler non registrato: {kind}", retry=False)
+                return
+
+            logger.info(f"Job {job_id} ({kind}) avviato, tentativo {attempts}/{max_attempts}")
+            kwargs = {**payload, **self._transient.get(job_id, {})}
+            _current.job_id = job_id
+            _current.last_attempt = attempts >= max_attempts
+            try:
+                handler(**kwargs)
+            except Exception as e:
+                db.session.rollback()
+                retry = attempts < max_attempts and not isinstance(e, PermanentJobError)
+                logger.exception(f"Job {job_id} ({kind}) fallito al tentativo {attempts}/{max_attempts}: {e}")
+                ProcessingJob.mark_failed(job_id, str(e), retry=retry)
+                if retry:
+                    self._schedule_retry(job_id, attempts)
+                else:
+                    self._transient.pop(job_id, None)
+                return
+            finally:
+                _current.job_id = None
+                _current.last_attempt = False
+
+            self._transient.pop(job_id, None)
+            ProcessingJob.mark_done(job_id)
+            logger.info(f"Job {job_id} ({kind}) completato")
+
+    def _schedule_retry(self, job_id: str, attempts: int) -> None:
+        delay = self.retry_backoff * (2 ** (attempts - 1))
+        logger.warning(f"Job {job_id} rimesso in coda tra {delay:.0f}s")
+        timer = threading.Timer(delay, self._queue.put, args=(job_id,))
+        timer.daemon = True
+        timer.start()
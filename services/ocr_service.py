@@ -0,0 +1,348 @@
+"""
+OCR Service
+Esegue l'OCR delle pagine senza layer di testo in un pool di processi separato,
+fuori dal path della richiesta HTTP.
+"""
+
+import io
+import os
+import sys
+import csv
+import time
+import logging
+import tempfile
+import subprocess
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+import pikepdf
+
+from utils.parsed_document import ParsedDocument, ParsedPage
+
+logger = logging.getLogger(__name__)
+
+
+class OCRInterruptedError(RuntimeError):
+    """
+    OCR interrotto da un problema del pool (timeout o riavvio dei processi), non del
+    documento: il chiamante deve ritentare invece di procedere senza OCR.
+    """
+
+
+def _ocr_single_page(page_pdf: bytes, page_number: int, language: str, timeout: float) -> Tuple[bytes, ParsedPage]:
+    """
+    Esegue ocrmypdf su un PDF di una sola pagina e ne estrae testo e word.
+    Gira nel processo figlio: file temporanei locali al worker. ocrmypdf è lanciato
+    come sottoprocesso, così oltre `timeout` secondi viene terminato solo lui e il
+    worker del pool resta disponibile per le altre pagine.
+
+    Returns:
+        (PDF della pagina con layer OCR, pagina parsata con numero originale)
+
+    Raises:
+        subprocess.TimeoutExpired: OCR della pagina oltre `timeout`
+    """
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_input:
+        temp_input.write(page_pdf)
+        temp_input_path = temp_input.name
+
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_output:
+        temp_output_path = temp_output.name
+
+    try:
+        subprocess.run(
+            [
+                sys.executable, "-m", "ocrmypdf", "--quiet", "--language", language,
+                # la pagina è una scansione, al più con poco testo (intestazione, numero di pagina):
+                # con --skip-text verrebbe saltata e il corpo resterebbe senza testo
+                "--force-ocr",
+                temp_input_path, temp_output_path,
+            ],
+            capture_output=True,
+            check=True,
+            timeout=timeout,
+        )
+        with open(temp_output_path, 'rb') as f:
+            ocr_pdf = f.read()
+    finally:
+        for path in (temp_input_path, temp_output_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    page = ParsedDocument.from_bytes(ocr_pdf).pages[0]
+    page.number = page_number
+    return ocr_pdf, page
+
+
+def _tesseract_single_page(
+    page_pdf: bytes, page_number: int, language: str, dpi: int, timeout: float
+) -> Tuple[None, ParsedPage]:
+    """
+    OCR "solo testo": renderizza la pagina con pypdfium2 e passa l'immagine a tesseract
+    (output TSV), senza riscrivere né riparsare il PDF.
+    Le coordinate delle word sono convertite in punti PDF (origine in alto a sinistra,
+    come le word di pdfplumber).
+
+    Returns:
+        (None, pagina parsata con numero originale)
+    """
+    import pypdfium2 as pdfium
+
+    pdf = pdfium.PdfDocument(page_pdf)
+    try:
+        image = pdf[0].render(scale=dpi / 72).to_pil()
+    finally:
+        pdf.close()
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    completed = subprocess.run(
+        ["tesseract", "stdin", "stdout", "-l", language, "--dpi", str(dpi), "tsv"],
+        input=buffer.getvalue(),
+        capture_output=True,
+        check=True,
+        timeout=timeout,
+    )
+
+    scale = 72 / dpi
+    words: List[Dict[str, Any]] = []
+    lines: Dict[Tuple[str, str, str], List[str]] = {}
+    rows = csv.DictReader(
+        io.StringIO(completed.stdout.decode("utf-8", errors="replace")),
+        delimiter="\t",
+        quoting=csv.QUOTE_NONE,
+    )
+    for row in rows:
+        text = (row.get("text") or "").strip()
+        if row.get("level") != "5" or not text:
+            continue
+        left, top = float(row["left"]) * scale, float(row["top"]) * scale
+        width, height = float(row["width"]) * scale, float(row["height"]) * scale
+        words.append({
+            "text": text,
+            "x0": left,
+            "x1": left + width,
+            "top": top,
+            "bottom": top + height,
+        })
+        lines.setdefault((row["block_num"], row["par_num"], row["line_num"]), []).append(text)
+
+    page_text = "\n".join(" ".join(tokens) for tokens in lines.values())
+    return None, ParsedPage(
+        number=page_number,
+        text=page_text,
+        words=words,
+        chars_count=sum(len(w["text"]) for w in words),
+    )
+
+
+class OCRService:
+    """
+    Stadio OCR basato su ProcessPoolExecutor, con OCR selettivo per pagina.
+
+    - OCR_WORKERS: numero di processi OCR paralleli (le pagine sono task indipendenti)
+    - OCR_PAGE_TIMEOUT: tempo massimo (secondi) per l'OCR di una pagina, contato da quando
+      la pagina è in esecuzione (non mentre attende in coda dietro altri documenti)
+    - OCR_LANGUAGE: lingue tesseract (default ita+eng)
+    - OCR_ENGINE: "ocrmypdf" (PDF ricercabile) oppure "tesseract" (solo testo e word,
+      più veloce: nessuna riscrittura del PDF)
+    - OCR_DPI: risoluzione di rendering per il motore "tesseract"
+    """
+
+    ENGINES = ("ocrmypdf", "tesseract")
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        page_timeout: Optional[float] = None,
+        language: Optional[str] = None,
+        engine: Optional[str] = None,
+    ):
+        self.max_workers = max_workers or int(os.getenv("OCR_WORKERS", "2"))
+        self.page_timeout = page_timeout or float(os.getenv("OCR_PAGE_TIMEOUT", "180"))
+        # Margine oltre il timeout del sottoprocesso prima di considerare bloccato il worker
+        self.stuck_grace = float(os.getenv("OCR_STUCK_GRACE", "60"))
+        self.language = language or os.getenv("OCR_LANGUAGE", "ita+eng")
+        self.engine = (engine or os.getenv("OCR_ENGINE", "ocrmypdf")).lower()
+        if self.engine not in self.ENGINES:
+            raise ValueError(f"OCR_ENGINE non valido: {self.engine} (ammessi: {', '.join(self.ENGINES)})")
+        self.dpi = int(os.getenv("OCR_DPI", "300"))
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: il processo padre ha thread attivi (Flask, worker della coda)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _reset_executor(self) -> None:
+        """
+        Termina i processi del pool: un task in esecuzione non può essere cancellato
+        singolarmente. Usato solo per un worker bloccato oltre il timeout del proprio
+        sottoprocesso OCR; gli altri OCR in corso ricevono OCRInterruptedError da
+        _run_pages e il loro job viene ritentato dalla coda.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        processes = list(getattr(executor, "_processes", {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            try:
+                process.terminate()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _split_pages(pdf_bytes: bytes, page_numbers: List[int]) -> Dict[int, bytes]:
+        """Estrae le pagine richieste come PDF di una pagina ciascuno."""
+        pages: Dict[int, bytes] = {}
+        with pikepdf.open(io.BytesIO(pdf_bytes)) as pdf:
+            for number in page_numbers:
+                single = pikepdf.new()
+                single.pages.append(pdf.pages[number - 1])
+                buffer = io.BytesIO()
+                single.save(buffer)
+                pages[number] = buffer.getvalue()
+        return pages
+
+    @staticmethod
+    def _merge_pages(pdf_bytes: bytes, ocr_pages: Dict[int, bytes]) -> bytes:
+        """Sostituisce nel PDF originale le pagine OCRizzate, mantenendo l'ordine."""
+        with pikepdf.open(io.BytesIO(pdf_bytes)) as pdf:
+            sources = [pikepdf.open(io.BytesIO(data)) for data in ocr_pages.values()]
+            try:
+                for number, source in zip(ocr_pages.keys(), sources):
+                    pdf.pages[number - 1] = source.pages[0]
+                buffer = io.BytesIO()
+                pdf.save(buffer)
+            finally:
+                for source in sources:
+                    source.close()
+        return buffer.getvalue()
+
+    @property
+    def rewrites_pdf(self) -> bool:
+        """True se il motore produce un PDF ricercabile (ocrmypdf)."""
+        return self.engine == "ocrmypdf"
+
+    def _run_pages(self, task, pdf_bytes: bytes, page_numbers: List[int], *args) -> Dict[int, Tuple[Any, ParsedPage]]:
+        """
+        Esegue `task` in parallelo su ogni pagina; le pagine il cui OCR fallisce (anche per
+        OCR_PAGE_TIMEOUT, applicato nel worker) vengono omesse.
+        Il tempo in coda dietro le pagine di altri documenti non conta per il timeout.
+
+        Raises:
+            OCRInterruptedError: pool terminato/rotto durante l'OCR, o worker bloccato
+                oltre il timeout della pagina
+        """
+        page_pdfs = self._split_pages(pdf_bytes, page_numbers)
+        executor = self._get_executor()
+        futures: Dict[Future, int] = {}
+        try:
+            for number, page_pdf in page_pdfs.items():
+                future = executor.submit(task, page_pdf, number, self.language, *args, self.page_timeout)
+                futures[future] = number
+        except (BrokenProcessPool, RuntimeError) as e:
+            # pool rotto o già chiuso da un reset concorrente: il prossimo tentativo ne crea uno nuovo
+            self._cancel(futures)
+            self._reset_executor()
+            raise OCRInterruptedError(f"Pool OCR non disponibile: {e}") from e
+
+        # Il timeout di ogni pagina è nel worker (sottoprocesso OCR); qui si controlla solo
+        # che un worker non resti bloccato oltre quel limite, contato dall'avvio della pagina
+        stuck_after = self.page_timeout + self.stuck_grace
+        started: Dict[Future, float] = {}
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future in pending:
+                if future.running():
+                    started.setdefault(future, now)
+            stuck = [futures[f] for f in pending if f in started and now - started[f] > stuck_after]
+            if stuck:
+                logger.error(f"OCR delle pagine {stuck} bloccato oltre {stuck_after:.0f}s, riavvio del pool OCR")
+                self._cancel(futures)
+                self._reset_executor()
+                raise OCRInterruptedError(f"OCR delle pagine {stuck} non completato entro {stuck_after:.0f}s")
+
+        results: Dict[int, Tuple[Any, ParsedPage]] = {}
+        for future, number in futures.items():
+            try:
+                results[number] = future.result()
+            except (BrokenProcessPool, CancelledError) as e:
+                raise OCRInterruptedError(f"OCR della pagina {number} interrotto dal riavvio del pool") from e
+            except subprocess.TimeoutExpired:
+                logger.warning(f"OCR della pagina {number} oltre {self.page_timeout:.0f}s")
+            except Exception as e:
+                logger.warning(f"OCR fallito per la pagina {number}: {e}")
+        return dict(sorted(results.items()))
+
+    @staticmethod
+    def _cancel(futures: Dict[Future, int]) -> None:
+        """Annulla le pagine di questo documento non ancora avviate."""
+        for future in futures:
+            future.cancel()
+
+    def ocr_pages(
+        self,
+        pdf_bytes: bytes,
+        parsed: ParsedDocument,
+        page_numbers: Optional[List[int]] = None,
+    ) -> Tuple[bytes, List[int]]:
+        """
+        OCRizza in parallelo solo le pagine indicate (default: quelle senza layer di testo)
+        e aggiorna `parsed` con testo e word delle pagine OCRizzate.
+        Le pagine il cui OCR fallisce restano invariate e vengono restituite al chiamante.
+
+        Returns:
+            (PDF con le pagine OCRizzate reinserite nell'ordine originale, con il motore
+             "tesseract" il PDF originale invariato; pagine richieste il cui OCR è fallito)
+
+        Raises:
+            OCRInterruptedError: se il pool viene terminato (es. per un worker bloccato
+                su un altro documento) o un worker resta bloccato su questo documento
+        """
+        if page_numbers is None:
+            page_numbers = parsed.pages_needing_ocr()
+        if not page_numbers:
+            return pdf_bytes, []
+
+        logger.info(f"OCR ({self.engine}) di {len(page_numbers)}/{parsed.page_count} pagine")
+        if self.engine == "tesseract":
+            results = self._run_pages(_tesseract_single_page, pdf_bytes, page_numbers, self.dpi)
+        else:
+            results = self._run_pages(_ocr_single_page, pdf_bytes, page_numbers)
+
+        for _, page in results.values():
+            parsed.replace_page(page)
+        failed = [number for number in page_numbers if number not in results]
+
+        if not self.rewrites_pdf or not results:
+            return pdf_bytes, failed
+        return self._merge_pages(pdf_bytes, {n: ocr_pdf for n, (ocr_pdf, _) in results.items()}), failed
+
+    def build_searchable_pdf(self, pdf_bytes: bytes, page_numbers: List[int]) -> bytes:
+        """Aggiunge il layer OCR (ocrmypdf) alle pagine indicate, indipendentemente da OCR_ENGINE."""
+        results = self._run_pages(_ocr_single_page, pdf_bytes, page_numbers)
+        if not results:
+            return pdf_bytes
+        return self._merge_pages(pdf_bytes, {n: ocr_pdf for n, (ocr_pdf, _) in results.items()})
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
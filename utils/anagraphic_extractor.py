@@ -0,0 +1,142 @@
+# utils/anagraphic_extractor.py
+# -*- coding: utf-8 -*-
+"""
+Anagraphic Extractor:
+Estrazione deterministica (regole + regex compilate) dei dati anagrafici che
+nelle lettere seguono diciture fisse, es.
+
+    Si dimette in data 02/09/2019
+    il Sig. BERTOLOTTI FRANCO
+    Nato il 27/03/1939 telefono 3479927663
+    ricoverato presso questo ospedale dal 27/08/2019
+    Numero Cartella 2019034139
+
+Viene eseguita subito dopo l'estrazione del testo, senza chiamate al modello:
+i campi non riconosciuti restano assenti e vengono lasciati all'LLM.
+"""
+
+import re
+from typing import Dict, Optional
+
+from utils.metadata_coherence_manager import MetadataCoherenceManager
+
+_DATE = r"(\d{1,2}[/.\-]\d{1,2}[/.\-]\d{2,4})"
+# Token di nome in maiuscolo, inclusi apostrofi e accenti (es. D'ANGELO, NICOLÒ)
+_NAME_TOKEN = r"[A-ZÀ-Ý][A-ZÀ-Ý']+"
+
+# Solo con un'etichetta esplicita ("Numero Cartella", "Cartella clinica n.") il numero è affidabile
+N_CARTELLA_PATTERNS = [
+    re.compile(r"\b(?:numero|n\.?|nr\.?|num\.?)\s*(?:di\s+)?cartella(?:\s+clinica)?\s*[:.]?\s*(\d{6,12})\b", re.IGNORECASE),
+    re.compile(r"\bcartella(?:\s+clinica)?\s*(?:n\.|nr\.?|numero)\s*[:.]?\s*(\d{6,12})\b", re.IGNORECASE),
+]
+# "cartella" seguita da un numero senza etichetta: solo un indizio, da confermare con l'LLM
+N_CARTELLA_HINT_PATTERN = re.compile(r"\bcartella(?:\s+clinica)?\s*[:.]?\s*(\d{6,12})\b", re.IGNORECASE)
+# Numeri di telefono/fax vicini alla dicitura non sono numeri di cartella
+_PHONE_CONTEXT = re.compile(r"\b(?:tel|telefono|fax|cell|cellulare)\b\.?[^\n]{0,20}$", re.IGNORECASE)
+
+# Il nome si ferma a fine riga o alla parola di un'etichetta successiva, con o senza
+# punteggiatura ("COGNOME: ROSSI NOME: MARIO", "NOME: MARIO NATO IL ...", "ETA' 70"),
+# e comprende al più 3 token
+_LABEL_WORDS = (
+    r"nome|cognome|data|nat[oa]|sesso|et[aà]|luogo|codice|c\.?f|residente|"
+    r"indirizzo|via|tel|telefono|cell|cartella|numero|paziente|reparto"
+)
+_NEXT_LABEL = rf"(?!(?i:{_LABEL_WORDS})(?![A-Za-zÀ-ÿ]))"
+_NAME = rf"{_NEXT_LABEL}{_NAME_TOKEN}(?:[ \t]+{_NEXT_LABEL}{_NAME_TOKEN}){{0,2}}"
+
+_SALUTATION = r"(?i:sig\.?\s*ra|signora|sig\.?|signor)"
+# Nel modello della lettera ("Si dimette in data 02/09/2019 il Sig. BERTOLOTTI FRANCO") l'ordine è COGNOME NOME
+DISCHARGE_SALUTATION_PATTERN = re.compile(
+    rf"\b(?i:si\s+dimette\s+in\s+data)\s+{_DATE}\s+(?i:il|la)\s+{_SALUTATION}\s+({_NAME})"
+)
+# Altrove ("Paziente: Sig. MARIO ROSSI") l'ordine non è noto
+SALUTATION_PATTERN = re.compile(rf"\b{_SALUTATION}\s+({_NAME})")
+COGNOME_PATTERN = re.compile(rf"\b(?i:cognome)\s*[:.]\s*({_NAME})")
+NOME_PATTERN = re.compile(rf"(?<![A-Za-z])(?i:nome)\s*[:.]\s*({_NAME})")
+
+DATE_PATTERNS = {
+    "data_di_nascita": re.compile(rf"\bnat[oa]\s+(?:a\s+[^\n]*?\s+)?il\s+{_DATE}", re.IGNORECASE),
+    "data_dimissione_cch": re.compile(rf"\bsi\s+dimette\s+in\s+data\s+{_DATE}", re.IGNORECASE),
+    "data_ingresso_cch": re.compile(rf"\bricoverat[oa]\s+presso\s+[^\n]*?\bdal\s+{_DATE}", re.IGNORECASE),
+}
+
+
+class AnagraphicExtractor:
+    """
+    Estrae i campi di coerenza (MetadataCoherenceManager.COHERENCE_FIELDS) e le date
+    di ricovero/dimissione/nascita con regole deterministiche.
+    """
+
+    COHERENCE_FIELDS = MetadataCoherenceManager.COHERENCE_FIELDS
+
+    @staticmethod
+    def _near_phone(text: str, start: int) -> bool:
+        return bool(_PHONE_CONTEXT.search(text[max(0, start - 30):start]))
+
+    def extract_n_cartella(self, text: str) -> Optional[str]:
+        """n_cartella con etichetta esplicita, utilizzabile come patient_id senza LLM."""
+        for pattern in N_CARTELLA_PATTERNS:
+            for match in pattern.finditer(text):
+                if not self._near_phone(text, match.start(1)):
+                    return match.group(1)
+        return None
+
+    def extract_n_cartella_hint(self, text: str) -> Optional[str]:
+        """Numero dopo "cartella" senza etichetta: candidato da confermare, mai usato da solo."""
+        for match in N_CARTELLA_HINT_PATTERN.finditer(text):
+            if not self._near_phone(text, match.start(1)):
+                return match.group(1)
+        return None
+
+    def extract_name(self, text: str) -> Dict[str, str]:
+        """
+        Nome e cognome: prima le etichette esplicite ("Cognome: ...", "Nome: ..."),
+        poi la formula di cortesia. L'ordine COGNOME NOME è certo solo nel modello
+        "Si dimette in data ... il Sig. COGNOME NOME"; altrove la formula si usa solo
+        se un'etichetta esplicita indica quale dei due token è il cognome o il nome.
+        Con più di due parole dopo il titolo la divisione è ambigua e si lascia all'LLM.
+        """
+        cognome = COGNOME_PATTERN.search(text)
+        nome = NOME_PATTERN.search(text)
+        if cognome and nome:
+            return {"cognome": cognome.group(1).strip(), "nome": nome.group(1).strip()}
+
+        match = DISCHARGE_SALUTATION_PATTERN.search(text)
+        if match:
+            tokens = match.group(2).split()
+            if len(tokens) == 2:
+                return {"cognome": tokens[0], "nome": tokens[1]}
+
+        labelled = ("cognome", cognome) if cognome else ("nome", nome) if nome else None
+        if labelled:
+            field, value = labelled[0], labelled[1].group(1).strip()
+            other = "nome" if field == "cognome" else "cognome"
+            for match in SALUTATION_PATTERN.finditer(text):
+                tokens = match.group(1).split()
+                if len(tokens) == 2 and value in tokens:
+                    return {field: value, other: tokens[1 - tokens.index(value)]}
+        return {}
+
+    def extract(self, text: str) -> Dict[str, str]:
+        """
+        Returns:
+            Dict con i soli campi riconosciuti (n_cartella, nome, cognome,
+            data_di_nascita, data_ingresso_cch, data_dimissione_cch)
+        """
+        if not text:
+            return {}
+
+        result: Dict[str, str] = {}
+        n_cartella = self.extract_n_cartella(text)
+        if n_cartella:
+            result["n_cartella"] = n_cartella
+        result.update(self.extract_name(text))
+        for field, pattern in DATE_PATTERNS.items():
+            match = pattern.search(text)
+            if match:
+                result[field] = match.group(1)
+        return result
+
+    def has_coherence_fields(self, anagraphic: Dict[str, str]) -> bool:
+        """True se tutti i campi di coerenza sono stati riconosciuti."""
+        return all(anagraphic.get(field) for field in self.COHERENCE_FIELDS)
@@ -0,0 +1,238 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from utils.parsed_document import ParsedDocument
+
+
+class ContentCache:
+    """
+    Cache indirizzata per contenuto (SHA-256 dei byte del PDF caricato).
+
+    Struttura:
+    <CONTENT_CACHE_FOLDER>/<sha[:2]>/<sha>/
+        parsed.json.gz      testo e word per pagina (dopo l'eventuale OCR), con i motori
+                            di estrazione del testo e OCR che li hanno prodotti
+        document.pdf        PDF con layer OCR, se l'OCR ha riscritto il file
+
+    Un PDF ricaricato (stesso contenuto) salta parsing e OCR; la chiamata al modello
+    è evitata dalla cache delle risposte di LLMExtractor (stesso testo).
+    Una voce prodotta con un altro TEXT_ENGINE o OCR_ENGINE non viene servita.
+    Come per LLMResponseCache, il mtime di parsed.json.gz è aggiornato ad ogni hit:
+    l'eviction per dimensione (CONTENT_CACHE_MAX_MB) rimuove le voci usate meno di
+    recente e quelle non lette da CONTENT_CACHE_MAX_AGE_DAYS. La cancellazione di un
+    documento rimuove la sua voce (invalidate).
+    """
+
+    # Intervallo minimo (secondi) tra due scansioni di eviction
+    EVICTION_INTERVAL = 60
+
+    def __init__(
+        self,
+        cache_folder: Optional[str] = None,
+        max_mb: Optional[float] = None,
+        max_age_days: Optional[float] = None,
+    ):
+        self.cache_folder = cache_folder or os.getenv("CONTENT_CACHE_FOLDER", "./cache")
+        self.max_bytes = (
+            max_mb if max_mb is not None else float(os.getenv("CONTENT_CACHE_MAX_MB", "2000"))
+        ) * 1024 * 1024
+        self.max_age = (
+            max_age_days if max_age_days is not None
+            else float(os.getenv("CONTENT_CACHE_MAX_AGE_DAYS", "30"))
+        ) * 86400
+        self.text_engine = os.getenv("TEXT_ENGINE", "pdfplumber").lower()
+        self.ocr_engine = os.getenv("OCR_ENGINE", "ocrmypdf").lower()
+        os.makedirs(self.cache_folder, exist_ok=True)
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._last_eviction = 0.0
+        self._stats = {
+            "uploads": 0,
+            "duplicate_uploads": 0,
+            "document_hits": 0,
+            "document_misses": 0,
+            "stale_engine": 0,
+            "evictions": 0,
+        }
+
+    def _entry_dir(self, content_hash: str) -> str:
+        return os.path.join(self.cache_folder, content_hash[:2], content_hash)
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += n
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    # ------------------------------------------------------------------ #
+    # Upload e documento parsato
+    # ------------------------------------------------------------------ #
+
+    def register_upload(self, content_hash: str) -> bool:
+        """Conta l'upload e restituisce True se lo stesso contenuto è già stato elaborato."""
+        duplicate = os.path.isdir(self._entry_dir(content_hash))
+        self._count("uploads")
+        if duplicate:
+            self._count("duplicate_uploads")
+            self.logger.info(f"Upload duplicato rilevato (sha256={content_hash[:12]})")
+        return duplicate
+
+    def load_document(self, content_hash: str) -> Optional[Tuple[ParsedDocument, Optional[bytes]]]:
+        """
+        Returns:
+            (documento parsato, PDF OCRizzato o None) se presente in cache, altrimenti None
+        """
+        entry = self._entry_dir(content_hash)
+        parsed_path = os.path.join(entry, "parsed.json.gz")
+        if not os.path.exists(parsed_path):
+            self._count("document_misses")
+            return None
+        try:
+            with gzip.open(parsed_path, "rt", encoding="utf-8") as f:
+                record = json.load(f)
+            if not self._same_engines(record):
+                self.logger.info(f"Voce di cache di {content_hash[:12]} prodotta con altri motori, ignorata")
+                self._count("stale_engine")
+                self._count("document_misses")
+                return None
+            parsed = ParsedDocument.from_dict(record)
+            pdf_bytes = None
+            pdf_path = os.path.join(entry, "document.pdf")
+            if os.path.exists(pdf_path):
+                with open(pdf_path, "rb") as f:
+                    pdf_bytes = f.read()
+        except Exception as e:
+            self.logger.warning(f"Voce di cache non leggibile per {content_hash[:12]}: {e}")
+            self._count("document_misses")
+            return None
+        # Aggiorna l'ultimo accesso per l'eviction LRU
+        try:
+            os.utime(parsed_path, None)
+        except OSError:
+            pass
+        self._count("document_hits")
+        return parsed, pdf_bytes
+
+    def _same_engines(self, record: Dict[str, Any]) -> bool:
+        """La voce è stata prodotta con i motori configurati (l'OCR solo se è stato eseguito)."""
+        if record.get("text_engine") != self.text_engine:
+            return False
+        ocr_engine = record.get("ocr_engine")
+        return ocr_engine is None or ocr_engine == self.ocr_engine
+
+    def store_document(
+        self,
+        content_hash: str,
+        parsed: ParsedDocument,
+        ocr_pdf: Optional[bytes] = None,
+        ocr_engine: Optional[str] = None
+    ) -> None:
+        """`ocr_engine`: motore con cui sono state OCRizzate le pagine, None senza OCR."""
+        entry = self._entry_dir(content_hash)
+        record = {**parsed.to_dict(), "text_engine": self.text_engine, "ocr_engine": ocr_engine}
+        try:
+            data = json.dumps(record, ensure_ascii=False).encode("utf-8")
+            self._write_atomic(os.path.join(entry, "parsed.json.gz"), gzip.compress(data))
+            if ocr_pdf is not None:
+                self._write_atomic(os.path.join(entry, "document.pdf"), ocr_pdf)
+        except Exception as e:
+            self.logger.warning(f"Impossibile salvare in cache il documento {content_hash[:12]}: {e}")
+            return
+        self._maybe_evict()
+
+    def invalidate(self, content_hash: str) -> None:
+        """Rimuove la voce di un contenuto (es. dopo la cancellazione del documento)."""
+        entry = self._entry_dir(content_hash)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+            self.logger.info(f"Voce di cache rimossa per {content_hash[:12]}")
+
+    # ------------------------------------------------------------------ #
+    # Eviction
+    # ------------------------------------------------------------------ #
+
+    def _maybe_evict(self) -> None:
+        now = time.time()
+        with self._lock:
+            if now - self._last_eviction < self.EVICTION_INTERVAL:
+                return
+            self._last_eviction = now
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        Rimuove le voci non lette da oltre CONTENT_CACHE_MAX_AGE_DAYS e, se la cache
+        supera la dimensione massima, quelle con accesso meno recente.
+
+        Returns:
+            Numero di voci rimosse
+        """
+        entries = []
+        now = time.time()
+        removed = 0
+        for root, _, files in os.walk(self.cache_folder):
+            if "parsed.json.gz" not in files:
+                continue
+            try:
+                last_access = os.stat(os.path.join(root, "parsed.json.gz")).st_mtime
+                size = sum(os.path.getsize(os.path.join(root, name)) for name in files)
+            except OSError:
+                continue
+            if now - last_access > self.max_age:
+                shutil.rmtree(root, ignore_errors=True)
+                removed += 1
+                continue
+            entries.append((last_access, size, root))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, root in sorted(entries):
+                shutil.rmtree(root, ignore_errors=True)
+                removed += 1
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+        if removed:
+            self._count("evictions", removed)
+            self.logger.info(f"Cache dei contenuti: rimosse {removed} voci")
+        return removed
+
+    # ------------------------------------------------------------------ #
+    # Statistiche
+    # ------------------------------------------------------------------ #
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Contatori del processo corrente e occupazione su disco della cache."""
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+
+        entries = 0
+        size_bytes = 0
+        for root, dirs, files in os.walk(self.cache_folder):
+            if os.path.exists(os.path.join(root, "parsed.json.gz")):
+                entries += 1
+            for name in files:
+                try:
+                    size_bytes += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+
+        stats["entries"] = entries
+        stats["size_bytes"] = size_bytes
+        stats["duplicate_rate"] = (
+            round(stats["duplicate_uploads"] / stats["uploads"], 3) if stats["uploads"] else 0.0
+        )
+        return stats
@@ -1,6 +1,14 @@
 import json
 import re
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+
+
+def compact_keys(entities: List[str]) -> Dict[str, str]:
+    """
+    Chiavi brevi del formato di output compatto: entità -> "c<indice nello schema completo>".
+    Deterministiche, così prompt e parser le ricavano dalla stessa lista di entità.
+    """
+    return {ent: f"c{index}" for index, ent in enumerate(entities)}
 
 
 class EntityExtractor:
@@ -9,8 +17,59 @@ class EntityExtractor:
     Garantisce che tutte le entità dello schema siano sempre presenti.
     """
 
-    def __init__(self, explicit_entities: List[str]):
+    def __init__(self, explicit_entities: List[str], short_keys: Optional[Dict[str, str]] = None):
         self.explicit = explicit_entities
+        # Chiavi brevi del formato compatto (LLM_OUTPUT_FORMAT=compact): per un sottoinsieme
+        # di entità vanno passate quelle dello schema completo, usate nella richiesta
+        self.short_keys = short_keys or compact_keys(explicit_entities)
+        # Valori discordanti tra i chunk dell'ultima estrazione map-reduce
+        self.conflicts: Dict[str, List[Any]] = {}
+
+    @staticmethod
+    def _is_empty(value: Any) -> bool:
+        return value is None or value == "" or value == [] or value == {}
+
+    def merge_results(self, partials: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], Dict[str, List[Any]]]:
+        """
+        Unione deterministica dei risultati per chunk (in ordine di documento):
+        vince il primo valore non nullo; i valori diversi trovati negli altri chunk
+        sono restituiti come lista di conflitti per entità.
+        """
+        merged: Dict[str, Any] = {ent: None for ent in self.explicit}
+        conflicts: Dict[str, List[Any]] = {}
+        for ent in self.explicit:
+            values: List[Any] = []
+            seen = set()
+            for partial in partials:
+                value = partial.get(ent)
+                if self._is_empty(value):
+                    continue
+                key = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+                if key not in seen:
+                    seen.add(key)
+                    values.append(value)
+            if values:
+                merged[ent] = values[0]
+            if len(values) > 1:
+                conflicts[ent] = values
+        return merged, conflicts
+
+    def parse_llm_responses(self, responses: List[str], texts: List[str]) -> Dict[str, Any]:
+        """
+        Parsing delle risposte di un'estrazione a chunk (una per chunk, con il relativo testo)
+        e unione in un unico risultato; i conflitti restano in `self.conflicts`.
+
+        Raises:
+            ValueError: se risposte e testi non sono allineati (una risposta andrebbe persa)
+        """
+        if len(responses) != len(texts):
+            raise ValueError(f"{len(responses)} risposte LLM per {len(texts)} testi: liste non allineate")
+        partials = [self.parse_llm_response(response, text) for response, text in zip(responses, texts)]
+        if len(partials) == 1:
+            self.conflicts = {}
+            return partials[0]
+        merged, self.conflicts = self.merge_results(partials)
+        return merged
 
     def parse_llm_response(self, response_str: str, text: str) -> Dict[str, Any]:
         """
@@ -32,11 +91,13 @@ class EntityExtractor:
                         result[ent] = val
                 return result
 
-            # Caso: dict diretto
+            # Caso: dict diretto, con i nomi dello schema o le chiavi brevi del formato compatto
             if isinstance(data, dict):
                 for ent in self.explicit:
                     if ent in data:
                         result[ent] = data.get(ent)
+                    elif self.short_keys[ent] in data:
+                        result[ent] = data.get(self.short_keys[ent])
                 return result
 
         except json.JSONDecodeError:
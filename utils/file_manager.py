@@ -1,9 +1,12 @@
 import os
+import gzip
 import json
 import shutil
 import re
+import hashlib
 import logging
 from datetime import datetime
+from utils.parsed_document import ParsedDocument
 # S3Manager moved to docs/unused - temporarily disabled
 # from .s3_manager import S3Manager
 
@@ -100,7 +103,70 @@ class FileManager:
         
         return True, normalized
 
-    def save_file(self, patient_id: str, document_type: str, filename: str, file_stream) -> tuple[str, dict | None]:
+    @staticmethod
+    def compute_sha256(data: bytes) -> str:
+        """Impronta del contenuto del file, usata per la deduplicazione degli upload."""
+        return hashlib.sha256(data).hexdigest()
+
+    def read_content_hash(self, filepath: str) -> str | None:
+        """Restituisce lo SHA-256 salvato nel meta.json del file (None per upload precedenti)."""
+        meta_path = filepath + ".meta.json"
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, encoding="utf-8") as mf:
+                return json.load(mf).get("sha256")
+        except Exception:
+            return None
+
+    # Testo e word per pagina estratti all'ingestione (dopo l'eventuale OCR),
+    # salvati accanto al PDF per non riparsarlo nei riprocessamenti
+    PAGES_SUFFIX = ".pages.json.gz"
+
+    def save_parsed_document(self, filepath: str, parsed: ParsedDocument) -> None:
+        pages_path = filepath + self.PAGES_SUFFIX
+        tmp_path = pages_path + ".tmp"
+        try:
+            data = json.dumps(parsed.to_dict(), ensure_ascii=False, separators=(",", ":"))
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, pages_path)
+        except Exception as e:
+            logging.warning(f"Impossibile salvare il testo estratto di {filepath}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load_parsed_document(self, filepath: str) -> ParsedDocument | None:
+        """Testo per pagina salvato all'ingestione (None per documenti caricati prima)."""
+        pages_path = filepath + self.PAGES_SUFFIX
+        if not os.path.exists(pages_path):
+            return None
+        try:
+            with gzip.open(pages_path, "rt", encoding="utf-8") as f:
+                return ParsedDocument.from_dict(json.load(f))
+        except Exception as e:
+            logging.warning(f"Testo estratto non leggibile per {filepath}: {e}")
+            return None
+
+    def remove_file(self, filepath: str) -> None:
+        """Rimuove il PDF insieme a meta.json e testo estratto."""
+        for path in (filepath, filepath + ".meta.json", filepath + self.PAGES_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def save_file(
+        self,
+        patient_id: str,
+        document_type: str,
+        filename: str,
+        file_stream,
+        content_hash: str | None = None
+    ) -> tuple[str, dict | None]:
+        """
+        Salva il PDF e il relativo meta.json.
+        `content_hash` è lo SHA-256 del file caricato: se il file salvato è stato
+        riscritto (es. dall'OCR) resta comunque la chiave della cache dei contenuti.
+        """
         # Validazione input
         if not patient_id or not document_type or not filename or not file_stream:
             raise ValueError("Tutti i parametri sono obbligatori")
@@ -127,8 +193,10 @@ class FileManager:
         # 2) scrivi su disco
         filepath = os.path.join(folder, filename)
         try:
+            data = file_stream.read()
+            sha256 = content_hash or self.compute_sha256(data)
             with open(filepath, "wb") as f:
-                f.write(file_stream.read())
+                f.write(data)
         except Exception as e:
             # Cleanup in caso di errore
             if os.path.exists(filepath):
@@ -139,7 +207,11 @@ class FileManager:
             raise Exception(f"Errore nel salvataggio del file: {str(e)}")
 
         # 3) metadati locali
-        meta = {"filename": filename, "upload_date": datetime.now().strftime("%Y-%m-%d")}
+        meta = {
+            "filename": filename,
+            "upload_date": datetime.now().strftime("%Y-%m-%d"),
+            "sha256": sha256
+        }
         meta_path = filepath + ".meta.json"
         try:
             with open(meta_path, "w", encoding="utf-8") as mf:
@@ -630,17 +702,19 @@ class FileManager:
 
         # Cancella PDF e meta
         pdf_path = os.path.join(folder, target_pdf)
+        # Impronta del contenuto, per rimuovere anche la voce della cache dei contenuti
+        content_hash = self.read_content_hash(pdf_path)
         try:
             if os.path.exists(pdf_path):
                 os.remove(pdf_path)
         except Exception as e:
             logging.warning(f"Impossibile rimuovere {pdf_path}: {e}")
-        meta_path = pdf_path + ".meta.json"
-        try:
-            if os.path.exists(meta_path):
-                os.remove(meta_path)
-        except Exception as e:
-            logging.warning(f"Impossibile rimuovere {meta_path}: {e}")
+        for sidecar_path in (pdf_path + ".meta.json", pdf_path + self.PAGES_SUFFIX):
+            try:
+                if os.path.exists(sidecar_path):
+                    os.remove(sidecar_path)
+            except Exception as e:
+                logging.warning(f"Impossibile rimuovere {sidecar_path}: {e}")
 
         # Cancella entities.json del document_type (poiché 1 documento per tipo)
         entities_path = os.path.join(folder, "entities.json")
@@ -673,7 +747,12 @@ class FileManager:
         except Exception as e:
             logging.warning(f"Impossibile rimuovere cartella paziente {patient_folder}: {e}")
 
-        return {"success": True, "patient_deleted": patient_deleted, "document_type_deleted": document_type_deleted}
+        return {
+            "success": True,
+            "patient_deleted": patient_deleted,
+            "document_type_deleted": document_type_deleted,
+            "content_hash": content_hash,
+        }
 
     def move_patient_folder(self, src_patient_id: str, dst_patient_id: str) -> bool:
         src = os.path.join(self.UPLOAD_FOLDER, str(src_patient_id))
@@ -799,6 +878,14 @@ class FileManager:
             except Exception as e:
                 logging.warning(f"Errore spostamento meta.json: {e}")
         
+        # Sposta il testo estratto all'ingestione se esiste
+        old_pages_path = old_pdf_path + self.PAGES_SUFFIX
+        if os.path.exists(old_pages_path):
+            try:
+                shutil.move(old_pages_path, new_pdf_path + self.PAGES_SUFFIX)
+            except Exception as e:
+                logging.warning(f"Errore spostamento testo estratto: {e}")
+        
         # Rimuovi eventuali file di errore
         error_folder = os.path.join(self.UPLOAD_FOLDER, patient_id, "errors")
         error_file = os.path.join(error_folder, "altro_error.json")
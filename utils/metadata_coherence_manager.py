@@ -265,6 +265,79 @@ class MetadataCoherenceManager:
             reason="Documento coerente con i metadati esistenti"
         )
     
+    def precheck_document_coherence(self, patient_id: str, document_type: str, partial_metadata: Dict[str, Any]) -> CoherenceResult:
+        """
+        Verifica preliminare, prima dell'estrazione LLM, con i soli campi anagrafici
+        ricavati a regole dal testo. Si confrontano solo i campi presenti sia nel nuovo
+        documento sia nel riferimento: un campo non riconosciuto non causa mai un rifiuto.
+
+        Il rifiuto anticipato avviene solo per un n_cartella con etichetta esplicita
+        diverso da quello di riferimento. Le differenze su nome e cognome (anche scambiati
+        tra loro) vengono solo riportate nel risultato "accepted": la decisione spetta
+        a check_document_coherence dopo l'estrazione LLM.
+        """
+        new_normalized = {
+            field: self.normalize_text(partial_metadata[field])
+            for field in self.COHERENCE_FIELDS
+            if partial_metadata.get(field)
+        }
+        if not new_normalized:
+            return CoherenceResult(status="accepted", reason="Nessun campo anagrafico per la verifica preliminare")
+        
+        # Riferimento: la LD per gli altri documenti, i documenti esistenti per la LD
+        references: List[Tuple[str, Dict[str, Any]]] = []
+        if document_type != "lettera_dimissione":
+            ld_entities = self.find_lettera_dimissione(patient_id)
+            if ld_entities:
+                references = [("lettera_dimissione", ld_entities)]
+        if not references:
+            references = [
+                (doc_type, entities)
+                for doc_type, entities in self.get_all_documents_metadata(patient_id)
+                if doc_type != document_type
+            ]
+        
+        incoerenti = []
+        for doc_type, entities in references:
+            ref_normalized = self.normalize_metadata(entities)
+            differences = {
+                field: {"atteso": ref_normalized[field], "trovato": value}
+                for field, value in new_normalized.items()
+                if ref_normalized.get(field) and ref_normalized[field] != value
+            }
+            # Nome e cognome scambiati tra loro sono lo stesso paziente
+            if (
+                new_normalized.get("nome") == ref_normalized.get("cognome")
+                and new_normalized.get("cognome") == ref_normalized.get("nome")
+            ):
+                differences.pop("nome", None)
+                differences.pop("cognome", None)
+            if differences:
+                incoerenti.append({"document_type": doc_type, "differences": differences})
+        
+        if not incoerenti:
+            return CoherenceResult(status="accepted", reason="Verifica preliminare superata")
+        
+        if not any("n_cartella" in item["differences"] for item in incoerenti):
+            return CoherenceResult(
+                status="accepted",
+                reason="Verifica preliminare: nome/cognome diversi dal riferimento, decide la verifica dopo l'LLM",
+                incoerenti=incoerenti
+            )
+        
+        if len(references) == 1 and references[0][0] == "lettera_dimissione":
+            return CoherenceResult(
+                status="rejected",
+                reason="ERRORE_COHERENCE_WITH_LD: I metadati del documento non corrispondono alla Lettera di Dimissione.",
+                diff=incoerenti[0]["differences"],
+                references="lettera_dimissione"
+            )
+        return CoherenceResult(
+            status="rejected",
+            reason="ERRORE_COHERENCE_WITH_EXISTING: I metadati del documento non corrispondono ai documenti già caricati.",
+            incoerenti=incoerenti
+        )
+    
     def check_multiple_sections_coherence(self, patient_id: str, sections_metadata: Dict[str, Dict[str, Any]]) -> CoherenceResult:
         """
         Verifica la coerenza tra multiple sezioni estratte dallo stesso documento.
@@ -0,0 +1,169 @@
+# utils/page_selector.py
+# -*- coding: utf-8 -*-
+"""
+Selezione delle pagine rilevanti prima dell'estrazione LLM.
+
+Un pacchetto di molte pagine classificato come un tipo di documento contiene spesso solo
+poche pagine pertinenti. Ogni pagina riceve un punteggio dai termini del tipo:
+- parole dei nomi di campo dello schema (PromptManager.SCHEMAS) e loro sinonimi;
+- parole chiave del tipo (DocumentTypeDetector.KEYWORDS), con peso maggiore.
+
+La selezione vale solo per i tipi in PAGE_SELECTION_TYPES, i referti brevi spesso inclusi in
+pacchetti più ampi; la lettera di dimissione ne è esclusa perché i suoi campi coprono tutto
+il documento, che resta affidato al chunking.
+
+Se il documento supera il budget di token (PAGE_SELECTION_TOKENS) si inviano solo le pagine
+con punteggio più alto, entro il budget e in ordine di documento (la prima pagina, con
+l'anagrafica, è sempre inclusa). Se le pagine scelte coprono meno di PAGE_SELECTION_MIN_RECALL
+del punteggio totale, o nessuna pagina ha punteggio, si usa il testo completo.
+"""
+
+import os
+import re
+import logging
+from typing import Dict, List, Optional, Set
+
+from llm.rate_limiter import estimate_tokens
+from services.document_type_detector import DocumentTypeDetector
+
+logger = logging.getLogger(__name__)
+
+# Parole dei nomi di campo troppo generiche per distinguere le pagine
+STOPWORDS = {
+    "pre", "post", "text", "del", "della", "dei", "alla", "all", "dell", "per", "con",
+    "tipo", "data", "numero", "nome", "cognome", "cartella", "momento", "ind", "min",
+}
+
+# Sinonimi e abbreviazioni dei termini dei campi nei referti
+SYNONYMS: Dict[str, List[str]] = {
+    "coro": ["coronarografia", "coronarica", "coronarie"],
+    "stenosi": ["stenosi", "stenotica", "occlusione"],
+    "iva": ["iva", "interventricolare anteriore", "discendente anteriore", "ida"],
+    "cx": ["cx", "circonflessa"],
+    "dx": ["coronaria destra", "cdx"],
+    "tc": ["tronco comune"],
+    "mo": ["marginale ottuso"],
+    "ivp": ["interventricolare posteriore"],
+    "plcx": ["posterolaterale"],
+    "fe": ["fe", "frazione di eiezione", "fevs"],
+    "vsx": ["ventricolo sinistro"],
+    "paps": ["pressione polmonare"],
+    "dimaorta": ["aorta", "aortico"],
+    "anulus": ["annulus"],
+    "cec": ["circolazione extracorporea", "cec"],
+    "bsa": ["superficie corporea"],
+    "eco": ["ecocardiogramma", "ecocardiografia"],
+    "tac": ["tc", "tomografia"],
+    "nyha": ["nyha"],
+    "iabp": ["contropulsatore", "iabp"],
+    "lasix": ["furosemide", "lasix"],
+    "betabloc": ["betabloccante", "bisoprololo", "metoprololo"],
+    "statine": ["statina", "atorvastatina", "rosuvastatina"],
+}
+
+KEYWORD_WEIGHT = 3
+
+
+class PageSelector:
+
+    def __init__(
+        self,
+        schemas: Dict[str, dict],
+        enabled: Optional[bool] = None,
+        max_tokens: Optional[int] = None,
+        min_recall: Optional[float] = None,
+        document_types: Optional[Set[str]] = None,
+    ):
+        self.schemas = schemas
+        self.document_types = document_types if document_types is not None else {
+            t.strip() for t in os.getenv(
+                "PAGE_SELECTION_TYPES", "coronarografia,eco_preoperatorio,eco_postoperatorio,tc_cuore"
+            ).split(",") if t.strip()
+        }
+        self.enabled = (
+            enabled if enabled is not None
+            else os.getenv("PAGE_SELECTION_ENABLED", "true").lower() == "true"
+        )
+        self.max_tokens = max_tokens or int(os.getenv("PAGE_SELECTION_TOKENS", "12000"))
+        self.min_recall = min_recall if min_recall is not None else float(os.getenv("PAGE_SELECTION_MIN_RECALL", "0.6"))
+        self._patterns: Dict[str, Optional[re.Pattern]] = {}
+
+    # ------------------------------------------------------------------ #
+    # Punteggio
+    # ------------------------------------------------------------------ #
+
+    def terms_for(self, document_type: str) -> Set[str]:
+        """Termini dai nomi di campo dello schema (senza cifre) e dai loro sinonimi."""
+        terms: Set[str] = set()
+        for field in self.schemas.get(document_type, {}).get("properties", {}):
+            for word in re.split(r"[_\s]+", re.sub(r"\d+", "", field.lower())):
+                if len(word) < 2 or word in STOPWORDS:
+                    continue
+                if len(word) >= 4:
+                    terms.add(word)
+                terms.update(SYNONYMS.get(word, []))
+        return terms
+
+    def _pattern(self, document_type: str) -> Optional[re.Pattern]:
+        if document_type not in self._patterns:
+            terms = sorted(self.terms_for(document_type), key=len, reverse=True)
+            self._patterns[document_type] = (
+                re.compile(r"\b(?:" + "|".join(re.escape(t) for t in terms) + r")\b") if terms else None
+            )
+        return self._patterns[document_type]
+
+    def score_page(self, text: str, document_type: str) -> int:
+        """Termini distinti dello schema presenti nella pagina, più le parole chiave del tipo."""
+        text = text.lower()
+        pattern = self._pattern(document_type)
+        score = len(set(pattern.findall(text))) if pattern else 0
+        for keyword in DocumentTypeDetector.keywords_for(document_type):
+            if re.search(r"\b" + re.escape(keyword) + r"\b", text):
+                score += KEYWORD_WEIGHT
+        return score
+
+    # ------------------------------------------------------------------ #
+    # Selezione
+    # ------------------------------------------------------------------ #
+
+    def select(self, pages: List[str], document_type: str) -> List[str]:
+        """
+        Returns:
+            Le pagine da inviare al modello, in ordine di documento (tutte per i tipi non
+            in PAGE_SELECTION_TYPES, se il documento sta nel budget o la copertura stimata è bassa)
+        """
+        if not self.enabled or document_type not in self.document_types or len(pages) < 2:
+            return pages
+        tokens = [estimate_tokens(page) for page in pages]
+        if sum(tokens) <= self.max_tokens:
+            return pages
+
+        scores = [self.score_page(page, document_type) for page in pages]
+        total = sum(scores)
+        if total == 0:
+            logger.info(f"Selezione pagine {document_type}: nessuna pagina rilevante, testo completo")
+            return pages
+
+        selected = {0}
+        budget = self.max_tokens - tokens[0]
+        ranked = sorted(range(1, len(pages)), key=lambda i: (-scores[i], i))
+        for index in ranked:
+            if scores[index] == 0:
+                break
+            if tokens[index] <= budget:
+                selected.add(index)
+                budget -= tokens[index]
+
+        recall = sum(scores[i] for i in selected) / total
+        if recall < self.min_recall:
+            logger.info(
+                f"Selezione pagine {document_type}: copertura stimata {recall:.0%} "
+                f"< {self.min_recall:.0%}, testo completo"
+            )
+            return pages
+
+        logger.info(
+            f"Selezione pagine {document_type}: {len(selected)}/{len(pages)} pagine, "
+            f"{sum(tokens[i] for i in selected)}/{sum(tokens)} token stimati, copertura {recall:.0%}"
+        )
+        return [pages[i] for i in sorted(selected)]
@@ -0,0 +1,95 @@
+import io
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Union
+
+
+# Chiavi delle word di pdfplumber effettivamente usate a valle (bbox + testo)
+WORD_KEYS = ("text", "x0", "x1", "top", "bottom")
+
+# Caratteri sotto i quali una pagina con immagini è considerata scansionata: intestazioni
+# timbrate, numeri di pagina o etichette di barcode non sono il testo del documento
+DEFAULT_OCR_MIN_PAGE_CHARS = 100
+
+
+@dataclass
+class ParsedPage:
+    """Contenuto di una singola pagina estratto in un solo passaggio."""
+    number: int  # 1-based
+    text: str
+    words: List[Dict[str, Any]] = field(default_factory=list)
+    chars_count: int = 0
+    images_count: int = 0
+
+    @property
+    def has_text_layer(self) -> bool:
+        return self.chars_count > 0
+
+
+@dataclass
+class ParsedDocument:
+    """
+    Artefatto di parsing per documento: testo, word con bbox e numero di caratteri per pagina.
+    Viene costruito una sola volta e condiviso tra upload, estrazione entità e
+    ricerca delle posizioni, evitando di riaprire il PDF con pdfplumber ad ogni stadio.
+    """
+    pages: List[ParsedPage] = field(default_factory=list)
+
+    @property
+    def page_count(self) -> int:
+        return len(self.pages)
+
+    @property
+    def text(self) -> str:
+        return "\n".join(page.text for page in self.pages)
+
+    @property
+    def has_text_layer(self) -> bool:
+        return any(page.has_text_layer for page in self.pages)
+
+    def pages_needing_ocr(self, min_chars: int = None) -> List[int]:
+        """
+        Numeri di pagina (1-based) senza un vero layer di testo da passare all'OCR.
+        Nei documenti misti si considerano solo le pagine scansionate (con immagini)
+        con meno di `min_chars` caratteri (default OCR_MIN_PAGE_CHARS), così le pagine
+        bianche non vengono rasterizzate e una scansione con un'intestazione testuale
+        non viene scambiata per una pagina digitale; se nessuna pagina ha testo si
+        OCRizza tutto il documento.
+        """
+        if not self.has_text_layer:
+            return [page.number for page in self.pages]
+        if min_chars is None:
+            min_chars = int(os.getenv("OCR_MIN_PAGE_CHARS", str(DEFAULT_OCR_MIN_PAGE_CHARS)))
+        return [
+            page.number for page in self.pages
+            if page.chars_count < min_chars and page.images_count > 0
+        ]
+
+    def replace_page(self, page: ParsedPage) -> None:
+        """Sostituisce una pagina (es. con il risultato OCR) mantenendo l'ordine."""
+        self.pages[page.number - 1] = page
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"pages": [asdict(page) for page in self.pages]}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ParsedDocument":
+        return cls(pages=[ParsedPage(**page) for page in data.get("pages", [])])
+
+    @classmethod
+    def from_bytes(cls, data: bytes, engine: str = None) -> "ParsedDocument":
+        return cls.from_source(io.BytesIO(data), engine)
+
+    @classmethod
+    def from_path(cls, path: str, engine: str = None) -> "ParsedDocument":
+        return cls.from_source(path, engine)
+
+    @classmethod
+    def from_source(cls, source: Union[str, io.BytesIO], engine: str = None) -> "ParsedDocument":
+        """
+        Apre il PDF una volta sola ed estrae tutto ciò che serve alla pipeline,
+        con il motore indicato o quello configurato in TEXT_ENGINE.
+        """
+        from utils.text_engines import get_text_engine
+
+        return cls(pages=get_text_engine(engine).extract(source))
@@ -1,24 +1,45 @@
-import pdfplumber
 import re
 from typing import Dict, Any, List, Optional, Tuple
 from rapidfuzz import fuzz
 
+from utils.parsed_document import ParsedDocument
+
 
 class PDFPositionExtractor:
     """
     Estrae le coordinate delle entità trovate nel PDF.
-    Utilizza pdfplumber per trovare la posizione (x, y, width, height, page) di ogni entità.
+    Lavora sulle word già estratte in ParsedDocument per trovare la posizione
+    (x, y, width, height, page) di ogni entità; il PDF viene aperto al massimo una volta.
     """
     
-    def __init__(self, pdf_path: str):
+    def __init__(self, pdf_path: str, parsed_document: Optional[ParsedDocument] = None):
         self.pdf_path = pdf_path
-        self._chars_cache = None
-        self._pages_cache = []
+        self._parsed = parsed_document
+        self._tokens_cache: Dict[int, List[Dict[str, Any]]] = {}
+
+    @property
+    def parsed(self) -> ParsedDocument:
+        """Documento parsato (costruito alla prima richiesta se non fornito)."""
+        if self._parsed is None:
+            self._parsed = ParsedDocument.from_path(self.pdf_path)
+        return self._parsed
     
     def _get_page_count(self) -> int:
         """Ottiene il numero totale di pagine nel PDF."""
-        with pdfplumber.open(self.pdf_path) as pdf:
-            return len(pdf.pages)
+        return self.parsed.page_count
+
+    def _get_page_tokens(self, page_idx: int) -> List[Dict[str, Any]]:
+        """Token normalizzati della pagina (0-based), calcolati una volta e riusati per tutte le entità."""
+        if page_idx not in self._tokens_cache:
+            words = self._merge_hyphenation(self.parsed.pages[page_idx].words)
+            tokens: List[Dict[str, Any]] = []
+            for w in words:
+                norm = self._normalize_text(w["text"])
+                if not norm:
+                    continue
+                tokens.append({"norm": norm, "word": w})
+            self._tokens_cache[page_idx] = tokens
+        return self._tokens_cache[page_idx]
 
     def _normalize_text(self, text: str) -> str:
         """Normalizza il testo per il confronto (rimuove spazi extra, lowercase)."""
@@ -116,85 +137,72 @@ class PDFPositionExtractor:
 
         best: Optional[Dict[str, Any]] = None  # {"score": ..., "page": ..., "x0": ..., ...}
 
-        # ------------------ Scansione PDF ------------------ #
+        # ------------------ Scansione pagine ------------------ #
+
+        page_count = self._get_page_count()
+        for page_idx in pages_to_search:
+            if page_idx < 0 or page_idx >= page_count:
+                continue
+
+            # token normalizzati + riferimento alla word originale
+            tokens = self._get_page_tokens(page_idx)
+            if not tokens:
+                continue
+
+            # ------------------ Caso: entità di 1 parola ------------------ #
+            if len(entity_tokens) == 1:
+                target = entity_tokens[0]
+                for tok in tokens:
+                    t = tok["norm"]
+                    if numeric_mode:
+                        # per numeri/date preferisci uguaglianza, altrimenti ratio
+                        if t == target:
+                            score = 100.0
+                        else:
+                            score = float(fuzz.ratio(target, t))
+                    else:
+                        score = float(fuzz.ratio(target, t))
 
-        with pdfplumber.open(self.pdf_path) as pdf:
-            for page_idx in pages_to_search:
-                if page_idx < 0 or page_idx >= len(pdf.pages):
-                    continue
+                    if score < min_score:
+                        continue
 
-                page = pdf.pages[page_idx]
-                words = page.extract_words() or []
-                if not words:
-                    continue
+                    if (best is None) or (score > best["score"]):
+                        x0, y0, x1, y1 = self._bbox_from_words([tok["word"]])
+                        best = {
+                            "score": score,
+                            "page": page_idx,
+                            "x0": x0,
+                            "y0": y0,
+                            "x1": x1,
+                            "y1": y1,
+                        }
+
+            # ------------------ Caso: entità multi-parola ------------------ #
+            else:
+                win_len = min((len(entity_tokens)),5)
+                for i in range(0, len(tokens) - win_len + 1):
+                    window_tokens = tokens[i:i + win_len]
+                    cand_text = " ".join(t["norm"] for t in window_tokens)
 
-                words = self._merge_hyphenation(words)
+                    if numeric_mode:
+                        score = float(fuzz.ratio(entity_norm, cand_text))
+                    else:
+                        score = float(fuzz.token_set_ratio(entity_norm, cand_text))
 
-                # costruiamo una lista di token normalizzati + riferimento alla word originale
-                tokens: List[Dict[str, Any]] = []
-                for w in words:
-                    norm = self._normalize_text(w["text"])
-                    if not norm:
+                    if score < min_score:
                         continue
-                    tokens.append({"norm": norm, "word": w})
-
-                if not tokens:
-                    continue
 
-                # ------------------ Caso: entità di 1 parola ------------------ #
-                if len(entity_tokens) == 1:
-                    target = entity_tokens[0]
-                    for tok in tokens:
-                        t = tok["norm"]
-                        if numeric_mode:
-                            # per numeri/date preferisci uguaglianza, altrimenti ratio
-                            if t == target:
-                                score = 100.0
-                            else:
-                                score = float(fuzz.ratio(target, t))
-                        else:
-                            score = float(fuzz.ratio(target, t))
-
-                        if score < min_score:
-                            continue
-
-                        if (best is None) or (score > best["score"]):
-                            x0, y0, x1, y1 = self._bbox_from_words([tok["word"]])
-                            best = {
-                                "score": score,
-                                "page": page_idx,
-                                "x0": x0,
-                                "y0": y0,
-                                "x1": x1,
-                                "y1": y1,
-                            }
-
-                # ------------------ Caso: entità multi-parola ------------------ #
-                else:
-                    win_len = min((len(entity_tokens)),5)
-                    for i in range(0, len(tokens) - win_len + 1):
-                        window_tokens = tokens[i:i + win_len]
-                        cand_text = " ".join(t["norm"] for t in window_tokens)
-
-                        if numeric_mode:
-                            score = float(fuzz.ratio(entity_norm, cand_text))
-                        else:
-                            score = float(fuzz.token_set_ratio(entity_norm, cand_text))
-
-                        if score < min_score:
-                            continue
-
-                        if (best is None) or (score > best["score"]):
-                            words_subset = [t["word"] for t in window_tokens]
-                            x0, y0, x1, y1 = self._bbox_from_words(words_subset)
-                            best = {
-                                "score": score,
-                                "page": page_idx,
-                                "x0": x0,
-                                "y0": y0,
-                                "x1": x1,
-                                "y1": y1,
-                            }
+                    if (best is None) or (score > best["score"]):
+                        words_subset = [t["word"] for t in window_tokens]
+                        x0, y0, x1, y1 = self._bbox_from_words(words_subset)
+                        best = {
+                            "score": score,
+                            "page": page_idx,
+                            "x0": x0,
+                            "y0": y0,
+                            "x1": x1,
+                            "y1": y1,
+                        }
 
         # ------------------ Ritorno bbox migliore ------------------ #
 
@@ -0,0 +1,120 @@
+# utils/text_compactor.py
+# -*- coding: utf-8 -*-
+"""
+Compattazione del testo per pagina prima dell'estrazione LLM.
+
+Le lettere ripetono su ogni pagina intestazione del reparto, piè di pagina, indirizzi e
+numeri di pagina: inviarli al modello costa token senza aggiungere informazione.
+
+- righe di intestazione/piè di pagina ripetute su più pagine: resta la prima occorrenza
+  (può contenere dati anagrafici), le successive vengono rimosse;
+- numeri di pagina ("Pag. 2 di 5", "2/5", "- 2 -") nei margini della pagina;
+- righe identiche consecutive (es. una riga di tabella ripetuta a cavallo di pagina);
+- spazi multipli e righe vuote consecutive.
+
+Le righe del corpo non vengono mai deduplicate tra sezioni diverse: la stessa riga
+(es. un farmaco) sotto "Terapia domiciliare" e "Terapia alla dimissione" ha
+significati diversi per l'estrazione.
+"""
+
+import os
+import re
+import math
+from collections import Counter
+from typing import List, Optional, Set
+
+_WHITESPACE = re.compile(r"[ \t ]+")
+_INLINE_PAGE_NUMBER = re.compile(r"\bpag(?:ina|\.)?\s*\d{1,3}(?:\s*(?:di|/)\s*\d{1,3})?", re.IGNORECASE)
+_PAGE_NUMBER = re.compile(
+    r"^(?:pag(?:ina|\.)?\s*\d{1,3}(?:\s*(?:di|/)\s*\d{1,3})?|\d{1,3}\s*(?:di|/)\s*\d{1,3}|-\s*\d{1,3}\s*-)$",
+    re.IGNORECASE,
+)
+
+
+class TextCompactor:
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        margin_lines: Optional[int] = None,
+        repeat_ratio: Optional[float] = None,
+    ):
+        self.enabled = (
+            enabled if enabled is not None
+            else os.getenv("TEXT_COMPACTION_ENABLED", "true").lower() == "true"
+        )
+        # Righe in testa/coda alla pagina considerate intestazione o piè di pagina
+        self.margin_lines = margin_lines or int(os.getenv("TEXT_COMPACTION_MARGIN_LINES", "6"))
+        # Frazione minima di pagine su cui una riga deve ripetersi per essere boilerplate
+        self.repeat_ratio = repeat_ratio or float(os.getenv("TEXT_COMPACTION_REPEAT_RATIO", "0.5"))
+
+    @staticmethod
+    def _normalize(line: str) -> str:
+        return _WHITESPACE.sub(" ", line).strip().lower()
+
+    @classmethod
+    def _margin_key(cls, line: str) -> str:
+        """
+        Chiave per intestazioni/piè di pagina: confronto esatto, a parte il numero di pagina
+        (le altre cifre contano: "Creatinina 1.2" e "Creatinina 0.9" restano distinte).
+        """
+        return _INLINE_PAGE_NUMBER.sub("pag #", cls._normalize(line))
+
+    def _margins(self, lines: List[str]) -> Set[int]:
+        """
+        Indici delle righe di intestazione e piè di pagina. Nelle pagine corte i margini
+        si riducono (al più un quarto delle righe per lato), così il corpo non vi ricade.
+        """
+        count = len(lines)
+        size = min(self.margin_lines, count // 4)
+        return set(range(size)) | set(range(count - size, count))
+
+    def compact(self, pages: List[str]) -> List[str]:
+        """
+        Returns:
+            Testo compattato per pagina (stesso numero di pagine, eventualmente vuote)
+        """
+        if not self.enabled:
+            return pages
+
+        page_lines = [[line for line in page.splitlines()] for page in pages]
+
+        # Righe nei margini presenti su abbastanza pagine: intestazioni e piè di pagina
+        margin_counts: Counter = Counter()
+        for lines in page_lines:
+            margins = self._margins(lines)
+            keys = {self._margin_key(lines[i]) for i in margins if lines[i].strip()}
+            margin_counts.update(keys)
+        # Almeno 3 pagine: su 2 pagine una riga del corpo ripetuta è indistinguibile da un'intestazione
+        min_pages = max(3, math.ceil(self.repeat_ratio * len(pages)))
+        boilerplate = {key for key, count in margin_counts.items() if count >= min_pages}
+
+        seen_boilerplate: Set[str] = set()
+        # Ultima riga non vuota mantenuta (anche della pagina precedente)
+        previous: Optional[str] = None
+        compacted: List[str] = []
+        for lines in page_lines:
+            margins = self._margins(lines)
+            kept: List[str] = []
+            for index, raw in enumerate(lines):
+                line = _WHITESPACE.sub(" ", raw).strip()
+                if not line:
+                    if kept and kept[-1] != "":
+                        kept.append("")
+                    continue
+                in_margin = index in margins
+                if in_margin and _PAGE_NUMBER.match(line):
+                    continue
+                if in_margin:
+                    key = self._margin_key(line)
+                    if key in boilerplate:
+                        if key in seen_boilerplate:
+                            continue
+                        seen_boilerplate.add(key)
+                row_key = self._normalize(line)
+                if row_key == previous:
+                    continue
+                previous = row_key
+                kept.append(line)
+            compacted.append("\n".join(kept).strip())
+        return compacted